@@ -41,6 +41,7 @@ from zipfile import ZipFile
 from miro import app
 from miro import downloader
 from miro import eventloop
+from miro import feedparserpool
 from miro.gtcache import gettext as _
 from miro import httpauth
 from miro import httpclient
@@ -50,6 +51,7 @@ from miro import moviedata
 from miro import prefs
 from miro import signals
 from miro import conversions
+from miro import devices
 from miro.plat.utils import exit_miro
 
 BOGON_URL = "http://bogondeflector.pculture.org/index.php"
@@ -65,6 +67,8 @@ class Controller:
     def shutdown(self):
         logging.info("Shutting down video conversions manager")
         conversions.conversion_manager.shutdown()
+        logging.info("Writing device databases")
+        devices.flush_all_databases()
         logging.info("Shutting down Downloader...")
         downloader.shutdown_downloader(self.downloader_shutdown)
 
@@ -74,6 +78,8 @@ class Controller:
         httpclient.cleanup_libcurl()
         logging.info("Writing HTTP passwords")
         httpauth.write_to_file()
+        logging.info("Shutting down feedparser processes")
+        feedparserpool.shutdown()
         logging.info("Shutting down event loop thread")
         eventloop.shutdown()
         logging.info("Saving cached ItemInfo objects")
@@ -29,6 +29,7 @@
 import os
 import re
 import time
+import hashlib
 import Queue
 import shutil
 import logging
@@ -46,6 +47,7 @@ from miro import eventloop
 from miro import fileutil
 from miro import item
 from miro import models
+from miro import moviedatacache
 from miro import util
 from miro import prefs
 from miro import signals
@@ -213,10 +215,17 @@ class ConversionManager(signals.SignalEmitter):
         return self.converters.lookup_converter(converter_id)
 
     def start_conversion(self, converter_id, item_info, target_folder=None,
-                         create_item=True):
+                         create_item=True, use_cache=False):
+        """Start converting an item.
+
+        :param use_cache: store the output in the conversion cache when
+            the conversion finishes
+        """
         converter_info = self.converters.lookup_converter(converter_id)
         task = self._make_conversion_task(
             converter_info, item_info, target_folder, create_item)
+        if task is not None:
+            task.use_cache = use_cache
         if ((task is not None
              and task.get_executable() is not None
              and not self._has_running_task(task.key)
@@ -224,6 +233,7 @@ class ConversionManager(signals.SignalEmitter):
             self._check_task_loop()
             self.pending_tasks.append(task)
             self._notify_task_added(task)
+            self._enqueue_message("start_pending")
 
         return task
     
@@ -251,26 +261,42 @@ class ConversionManager(signals.SignalEmitter):
             self.task_loop.setDaemon(True)
             self.task_loop.start()
 
+    def _task_done(self, task):
+        """Called from a task's thread when its process has exited."""
+        self._enqueue_message("task_done", task=task)
+
     def _loop(self):
         self.emit('thread-will-start')
         self.emit('thread-started', threading.currentThread())
         self.emit('thread-did-start')
         while not self.quit_flag:
+            # sleep until someone sends us a message
+            msg = self.message_queue.get()
             self.emit('begin-loop')
-            self._run_loop_cycle()
+            self._run_loop_cycle(msg)
             self.emit('end-loop')
-            time.sleep(0.5)
         logging.debug("Conversions manager thread loop finished.")
         self.task_loop = None
-    
-    def _run_loop_cycle(self):
-        self._process_message_queue()
-        
+
+    def _run_loop_cycle(self, msg=None):
+        """Handle msg and every other message in the queue, then start as
+        many pending tasks as we have free slots for.
+        """
         notify_count = False
+        while msg is not None and not self.quit_flag:
+            if self._process_message(msg):
+                notify_count = True
+            try:
+                msg = self.message_queue.get_nowait()
+            except Queue.Empty:
+                msg = None
+        if self.quit_flag:
+            return
+
         max_concurrent_tasks = int(app.config.get(
                 prefs.MAX_CONCURRENT_CONVERSIONS))
-        if ((self.pending_tasks_count() > 0
-             and self.running_tasks_count() < max_concurrent_tasks)):
+        while (self.pending_tasks_count() > 0
+               and self.running_tasks_count() < max_concurrent_tasks):
             task = self.pending_tasks.pop()
             if not self._has_running_task(task.key):
                 self.running_tasks.append(task)
@@ -278,25 +304,35 @@ class ConversionManager(signals.SignalEmitter):
                 self._notify_task_changed(task)
                 notify_count = True
 
-        for task in list(self.running_tasks):
-            if task.done_running():
-                self._notify_task_changed(task)
-                self.running_tasks.remove(task)
-                self.finished_tasks.append(task)
-                notify_count = True
-                if task.is_finished():
-                    self.schedule_staging(task.key)
-        
         if notify_count:
             self._notify_tasks_count()
-                
-    def _process_message_queue(self):
-        try:
-            msg = self.message_queue.get_nowait()
-        except Queue.Empty:
-            return
 
-        if msg['message'] == 'get_tasks_list':
+    def _process_message(self, msg):
+        """Handle a message from the queue.
+
+        :returns: True if the task counts changed and we haven't told the
+            frontend yet
+        """
+        if msg['message'] == 'start_pending':
+            # _run_loop_cycle() starts the pending tasks
+            pass
+
+        elif msg['message'] == 'task_done':
+            task = msg['task']
+            if task not in self.running_tasks:
+                # the task was canceled
+                return False
+            # the thread is about to exit, wait for it so that
+            # done_running() is True
+            task.thread.join()
+            self._notify_task_changed(task)
+            self.running_tasks.remove(task)
+            self.finished_tasks.append(task)
+            if task.is_finished():
+                self.schedule_staging(task.key)
+            return True
+
+        elif msg['message'] == 'get_tasks_list':
             self._notify_tasks_list()
 
         elif msg['message'] == 'cancel':
@@ -351,6 +387,8 @@ class ConversionManager(signals.SignalEmitter):
             conversion_name = task.converter_info.name
 
             if os.path.exists(source):
+                if task.use_cache:
+                    self._cache_finished_file(task, source)
                 self._move_finished_file(source, destination)
                 if task.create_item:
                     _create_item_for_conversion(destination,
@@ -365,6 +403,14 @@ class ConversionManager(signals.SignalEmitter):
             fp.close()
             self.emit('task-staged', task)
 
+    def _cache_finished_file(self, task, source):
+        try:
+            conversion_cache.store(task.converter_info, task.input_path,
+                                   source)
+        except EnvironmentError:
+            logging.warn("error storing %s in the conversion cache", source,
+                         exc_info=True)
+
     def _move_finished_file(self, source, destination):
         try:
             shutil.move(source, destination)
@@ -567,6 +613,7 @@ class ConversionTask(object):
         self.log_file = None
         self.process_handle = None
         self.error = None
+        self.use_cache = False
         self.start_time = time.time()
     
     def get_executable(self):
@@ -635,6 +682,12 @@ class ConversionTask(object):
         try:
             self.process_handle = subprocess.Popen(args, **kwargs)
             self.process_output(line_reader(self.process_handle.stdout))
+            # process_output() stops at the end of the conversion or at the
+            # first error.  Read the rest of the output so the process can
+            # exit, then wait for it so that the manager hears about it as
+            # soon as it's done.
+            self._log_progress(self.process_handle.stdout.read())
+            self.process_handle.wait()
 
         except OSError, ose:
             if ose.errno == errno.ENOENT:
@@ -647,6 +700,7 @@ class ConversionTask(object):
             self._stop_logging(self.progress < 1.0)
             if self.is_failed():
                 conversion_manager._notify_tasks_count()
+            conversion_manager._task_done(self)
 
     def process_output(self, lines_generator):
         """Takes a function that's a generator of lines, iterates
@@ -845,6 +899,111 @@ def _create_item_for_conversion(filename, source_info, conversion_name):
     models.FileItem(filename, feed_id=manual_feed.id,
                     fp_values=fp_values)
 
+class ConversionCache(object):
+    """Keeps copies of converted files, so that syncing the same file to
+    another device (or the same one again) doesn't convert it again.
+
+    Files are named after a hash of the source file's fingerprint (see
+    moviedatacache.calc_key()), the converter's executable and its
+    parameters.  When the cache gets bigger than CONVERSION_CACHE_SIZE, the
+    least recently used files are removed.
+    """
+    def __init__(self, directory=None):
+        self._directory = directory
+        self.lock = threading.Lock()
+
+    def get_directory(self):
+        if self._directory is None:
+            return os.path.join(get_conversions_folder(), 'cache')
+        return self._directory
+
+    def calc_key(self, converter_info, input_path):
+        """:returns: key string, or None if we can't read input_path"""
+        source_key = moviedatacache.calc_key(input_path)
+        if source_key is None:
+            return None
+        parameters = build_parameters('{input}', '{output}', converter_info)
+        parts = [source_key, converter_info.executable] + parameters
+        return hashlib.sha1(repr(parts)).hexdigest()
+
+    def _path(self, key, converter_info):
+        return os.path.join(self.get_directory(),
+                            '%s.%s' % (key, converter_info.extension))
+
+    def lookup(self, converter_info, input_path):
+        """Find the cached output for converting a file.
+
+        :returns: path to the converted file, or None
+        """
+        key = self.calc_key(converter_info, input_path)
+        if key is None:
+            return None
+        path = self._path(key, converter_info)
+        if not os.path.exists(path):
+            return None
+        try:
+            # the modification time tells shrink() when we last used it
+            os.utime(path, None)
+        except OSError:
+            pass
+        return path
+
+    def store(self, converter_info, input_path, output_path):
+        """Store a copy of a converted file.
+
+        NOTE: This can throw IOError or OSError.
+        """
+        key = self.calc_key(converter_info, input_path)
+        if key is None:
+            return
+        directory = self.get_directory()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        path = self._path(key, converter_info)
+        temp_path = path + '.tmp'
+        shutil.copyfile(output_path, temp_path)
+        if os.path.exists(path):
+            # windows won't rename over an existing file
+            os.remove(path)
+        os.rename(temp_path, path)
+        self.shrink()
+
+    def shrink(self):
+        """Remove the least recently used files until the cache is under
+        CONVERSION_CACHE_SIZE.
+        """
+        max_size = app.config.get(prefs.CONVERSION_CACHE_SIZE) * 1024 * 1024
+        directory = self.get_directory()
+        self.lock.acquire()
+        try:
+            entries = []
+            total_size = 0
+            for filename in os.listdir(directory):
+                if filename.endswith('.tmp'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat_result = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat_result.st_mtime, stat_result.st_size,
+                                path))
+                total_size += stat_result.st_size
+            entries.sort()
+            for mtime, size, path in entries:
+                if total_size <= max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    logging.warn("error removing %s from the conversion "
+                                 "cache", path, exc_info=True)
+                else:
+                    total_size -= size
+        finally:
+            self.lock.release()
+
 # FIXME - this should be in an init() and not module-level
 utils.setup_ffmpeg_presets()
 conversion_manager = ConversionManager()
+conversion_cache = ConversionCache()
@@ -2906,3 +2906,42 @@ def upgrade126(cursor):
         cursor.execute("UPDATE item SET feed_id=? WHERE feed_id=?",
                        (manual_feed_id, single_feed_id))
         cursor.execute("DELETE FROM feed WHERE origURL='dtv:singleFeed'")
+
+def upgrade127(cursor):
+    """Add columns to store digests of the last feed body and of the
+    entry each item was created from.
+    """
+    cursor.execute("ALTER TABLE rss_feed_impl ADD COLUMN body_digest text")
+    cursor.execute("ALTER TABLE item ADD COLUMN entry_digest text")
+
+def upgrade128(cursor):
+    """Move fast resume data out of the database and into the files that
+    the downloader now uses.
+    """
+    from miro import download_utils
+    cursor.execute("SELECT id, status, metainfo, fast_resume_data "
+                   "FROM remote_downloader "
+                   "WHERE fast_resume_data IS NOT NULL")
+    for row in cursor.fetchall():
+        id, status_repr, metainfo, fast_resume_data = row
+        if metainfo is None:
+            # we can't figure out the info hash, so we can't use the data
+            continue
+        try:
+            info_hash = util.get_metainfo_info_hash(str(metainfo))
+        except ValueError:
+            continue
+        try:
+            download_utils.save_fast_resume_data(info_hash.encode('hex'),
+                                                 str(fast_resume_data))
+        except (IOError, OSError):
+            logging.exception("upgrade128: error saving fast resume data")
+            continue
+        try:
+            status = eval_container(status_repr)
+        except StandardError:
+            status = {}
+        status['fastResumeVersion'] = 1
+        cursor.execute("UPDATE remote_downloader SET status=? WHERE id=?",
+                       (repr(status), id))
+    remove_column(cursor, 'remote_downloader', ['fast_resume_data'])
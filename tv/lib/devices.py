@@ -34,6 +34,7 @@ import shutil
 import time
 
 from miro import app
+from miro import eventloop
 from miro import item
 from miro import fileutil
 from miro import filetypes
@@ -215,6 +216,8 @@ class DeviceSyncManager(object):
         self.etas = {}
         self.signal_handles = []
         self.waiting = set()
+        # cached conversions that we're copying to the device
+        self.copying = set()
 
         self.device.is_updating = True # start the spinner
         messages.TabsChanged('devices', [], [self.device],
@@ -268,7 +271,15 @@ class DeviceSyncManager(object):
         conversion_manager = conversions.conversion_manager
         start_conversion = conversion_manager.start_conversion
 
-        if not self.waiting:
+        converter_info = conversion_manager.lookup_converter(conversion)
+        cached_path = conversions.conversion_cache.lookup(converter_info,
+                                                          info.video_path)
+        if cached_path is not None:
+            self.copy_cached_conversion(cached_path, converter_info, info,
+                                        target)
+            return
+
+        if not self.signal_handles:
             for signal, callback in (
                 ('task-changed', self._conversion_changed_callback),
                 ('task-staged', self._conversion_staged_callback),
@@ -278,9 +289,30 @@ class DeviceSyncManager(object):
                         signal, callback))
 
         task = start_conversion(conversion, info, target,
-                                create_item=False)
+                                create_item=False, use_cache=True)
         self.waiting.add(task.key)
 
+    def copy_cached_conversion(self, cached_path, converter_info, info,
+                               target):
+        final_path, temp_path = conversions.build_output_paths(
+            info, target, converter_info)
+        self.copying.add(final_path)
+
+        def callback(result):
+            self.copying.discard(final_path)
+            self._add_item(final_path, info)
+            self._check_finished()
+
+        def errback(error):
+            logging.warn("error copying cached conversion %s to %s: %s",
+                         cached_path, final_path, error)
+            self.copying.discard(final_path)
+            self._check_finished()
+
+        eventloop.call_in_thread(callback, errback, shutil.copyfile,
+                                 "Copy cached conversion", cached_path,
+                                 final_path, pool_name='fileio')
+
     def _exists(self, item_info):
         if item_info.file_type not in self.device.database:
             return False
@@ -362,7 +394,7 @@ class DeviceSyncManager(object):
                               [], []).send_to_frontend() # changed, removed
 
     def _check_finished(self):
-        if not self.waiting:
+        if not self.waiting and not self.copying:
             # finished!
             for handle in self.signal_handles:
                 conversions.conversion_manager.disconnect(handle)
@@ -378,7 +410,7 @@ class DeviceSyncManager(object):
         message.send_to_frontend()
 
     def is_finished(self):
-        if self.waiting:
+        if self.waiting or self.copying:
             return False
         return self.device.id not in app.device_manager.syncs_in_progress
 
@@ -412,6 +444,8 @@ class DeviceDatabase(dict, signals.SignalEmitter):
         signals.SignalEmitter.__init__(self, 'changed')
         self.parent = parent
         self.bulk_mode = False
+        # set by load_database() for the top-level database
+        self.save_manager = None
 
     def __getitem__(self, key):
         value = super(DeviceDatabase, self).__getitem__(key)
@@ -436,14 +470,77 @@ class DeviceDatabase(dict, signals.SignalEmitter):
             self.notify_changed()
 
 
+# how long to wait after a change before writing the database to the device
+SAVE_DELAY = 5
+
+# maps mount -> DatabaseSaveManager for the databases we've loaded
+_save_managers = {}
+
 class DatabaseSaveManager(object):
+    """Writes a device database a little while after it changes, so that a
+    burst of changes (like syncing a bunch of items) only writes the file
+    once.
+    """
     def __init__(self, mount, database):
         self.mount = mount
-        database.connect('changed', self.database_changed)
+        self.database = database
+        self.write_dc = None
+        self.handle = database.connect('changed', self.database_changed)
 
     def database_changed(self, database):
-        write_database(self.mount, database)
+        if self.write_dc is None:
+            self.write_dc = eventloop.add_timeout(
+                SAVE_DELAY, self._write_timeout,
+                'writing device database for %s' % self.mount)
+
+    def _write_timeout(self):
+        self.write_dc = None
+        write_database(self.mount, self.database)
+
+    def flush(self):
+        """Write the database now if it has unsaved changes."""
+        if self.write_dc is not None:
+            self.write_dc.cancel()
+            self._write_timeout()
+
+    def close(self):
+        """Write any unsaved changes and stop watching the database."""
+        self.flush()
+        self.database.disconnect(self.handle)
+
+    def discard(self):
+        """Drop any unsaved changes and stop watching the database.
+
+        Use this when the device is already gone.  Writing then would fail,
+        or put the database in the empty mount point directory.
+        """
+        if self.write_dc is not None:
+            self.write_dc.cancel()
+            self.write_dc = None
+        self.database.disconnect(self.handle)
+
+
+def _close_save_manager(mount, write=True):
+    save_manager = _save_managers.pop(mount, None)
+    if save_manager is not None:
+        if write:
+            save_manager.close()
+        else:
+            save_manager.discard()
+
+def flush_database(database):
+    """
+    Writes any unsaved changes to the given device database.
+    """
+    if database.save_manager is not None:
+        database.save_manager.flush()
 
+def flush_all_databases():
+    """
+    Writes any unsaved changes to the databases on all devices.
+    """
+    for save_manager in _save_managers.values():
+        save_manager.flush()
 
 def load_database(mount):
     """
@@ -451,6 +548,9 @@ def load_database(mount):
 
     The database lives at [MOUNT]/.miro/json
     """
+    # make sure the file has the changes from the last time we loaded it,
+    # and that the old database object doesn't write over it later
+    _close_save_manager(mount)
     file_name = os.path.join(mount, '.miro', 'json')
     if not os.path.exists(file_name):
         db = {}
@@ -461,7 +561,8 @@ def load_database(mount):
             logging.exception('error loading JSON db on %s' % mount)
             db = {}
     ddb = DeviceDatabase(db)
-    DatabaseSaveManager(mount, ddb)
+    ddb.save_manager = DatabaseSaveManager(mount, ddb)
+    _save_managers[mount] = ddb.save_manager
     return ddb
 
 def write_database(mount, database):
@@ -477,9 +578,27 @@ def write_database(mount, database):
         os.makedirs(os.path.join(mount, '.miro'))
     except OSError:
         pass
+    # write to a temporary file and rename it, so that unplugging the
+    # device in the middle of a write doesn't leave a truncated database
+    file_name = os.path.join(mount, '.miro', 'json')
+    temp_name = file_name + '.tmp'
     try:
-        json.dump(database, file(os.path.join(mount, '.miro', 'json'), 'wb'))
-    except IOError:
+        f = file(temp_name, 'wb')
+        try:
+            json.dump(database, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        try:
+            os.rename(temp_name, file_name)
+        except OSError:
+            # windows won't rename over an existing file
+            if not os.path.exists(file_name):
+                raise
+            os.remove(file_name)
+            os.rename(temp_name, file_name)
+    except EnvironmentError:
         # couldn't write to the device
         # XXX throw up an error?
         pass
@@ -524,6 +643,14 @@ def device_disconnected(info):
                                                           create=False)
     if sync_manager:
         sync_manager.cancel()
+    if info.mount:
+        # pending changes were written when the device was ejected, it's
+        # too late now
+        _close_save_manager(info.mount, write=False)
+        scanner = _scanners.pop(info.mount, None)
+        if scanner is not None:
+            # the device is gone, so throw away whatever the scan finds
+            scanner.cancel()
 
     message = messages.TabsChanged('devices',
                                   [],
@@ -531,45 +658,200 @@ def device_disconnected(info):
                                   [info.id])
     message.send_to_frontend()
 
-def clean_database(device):
-    def _exists(item_path):
-        return os.path.exists(os.path.join(device.mount,
-                                           item_path))
-    known_files = set()
-    to_remove = []
-    for item_type in ('video', 'audio', 'other'):
-        device.database.setdefault(item_type, {})
-        for item_path in device.database[item_type]:
-            if _exists(item_path):
-                known_files.add(os.path.normcase(item_path))
-            else:
-                to_remove.append((item_type, item_path))
+# how many new files we find before sending them to the backend
+SCAN_BATCH_SIZE = 100
 
-    if to_remove:
-        device.database.set_bulk_mode(True)
-        for item_type, item_path in to_remove:
-            del device.database[item_type][item_path]
-        device.database.set_bulk_mode(False)
+# FAT stores modification times with a 2 second resolution, so we can't
+# trust the mtime of a directory that changed more recently than this
+MTIME_RESOLUTION = 2
 
-    return known_files
+# maps mount -> DeviceScanner for the scans in progress
+_scanners = {}
 
 def scan_device_for_files(device):
-    known_files = clean_database(device)
-
-    device.database.set_bulk_mode(True)
-    device.database.setdefault('sync', {})
-
-    for filename in fileutil.miro_allfiles(device.mount):
-        short_filename = filename[len(device.mount):]
-        ufilename = filename_to_unicode(short_filename)
-        if os.path.normcase(ufilename) in known_files:
-            continue
-        if filetypes.is_video_filename(ufilename):
-            item_type = 'video'
-        elif filetypes.is_audio_filename(ufilename):
-            item_type = 'audio'
-        else:
-            continue
-        device.database[item_type][ufilename] = {}
+    """
+    Starts looking for new and removed files on a device.
+
+    If we're already scanning the device, it gets scanned again once the
+    current scan finishes.
+    """
+    scanner = _scanners.get(device.mount)
+    if scanner is not None:
+        scanner.rescan_device = device
+        return
+    scanner = _scanners[device.mount] = DeviceScanner(device)
+    scanner.start()
+
+def _get_item_type(ufilename):
+    if filetypes.is_video_filename(ufilename):
+        return 'video'
+    elif filetypes.is_audio_filename(ufilename):
+        return 'audio'
+    else:
+        return None
+
+class DeviceScanner(object):
+    """Finds the media files on a device and updates its database.
+
+    The database stores an index of the directories on the device, which
+    maps each directory to its modification time and its subdirectories.
+    Adding or removing a file changes the mtime of its directory, so if a
+    directory's mtime hasn't changed we don't need to look at its files
+    again.  We still list it to find its subdirectories.
+
+    The walk runs in the fileio thread pool and sends new files back in
+    batches, so the backend doesn't block on a big device.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.rescan_device = None
+        self.canceled = False
+
+    def cancel(self):
+        """Stop the scan and ignore its results.
+
+        Call this after removing the scanner from _scanners.
+        """
+        self.canceled = True
+
+    def start(self):
+        database = self.device.database
+        database.setdefault('sync', {})
+        known_files = set()
+        for item_type in ('video', 'audio', 'other'):
+            database.setdefault(item_type, {})
+            for item_path in database[item_type]:
+                known_files.add(os.path.normcase(item_path))
+        old_index = dict(database.get('directories', {}))
+        eventloop.call_in_thread(self._scan_finished, self._scan_error,
+                                 self.scan, "Scan device %s" %
+                                 self.device.mount, old_index, known_files,
+                                 pool_name='fileio')
+
+    def scan(self, old_index, known_files):
+        """Walk the device.
+
+        This runs in a worker thread, so it can't touch the database.
+
+        :param old_index: directory index from the last scan
+        :param known_files: normcased paths of the files in the database
+        :returns: (new directory index, normcased paths of known files that
+                  are gone, new files that haven't been sent yet) tuple
+        """
+        mount = self.device.mount
+        stable_time = time.time() - MTIME_RESOLUTION
+        new_index = {}
+        listed_directories = set()
+        seen_files = set()
+        batch = []
+        to_scan = [mount[:0]]
+        while to_scan and not self.canceled:
+            directory = to_scan.pop()
+            try:
+                mtime = os.stat(os.path.join(mount, directory)).st_mtime
+                names = os.listdir(os.path.join(mount, directory))
+            except OSError:
+                continue
+            key = os.path.normcase(filename_to_unicode(directory))
+            old_entry = old_index.get(key)
+            if (old_entry is not None and old_entry[0] is not None and
+                    old_entry[0] == mtime):
+                # no files were added or removed, just look for the
+                # subdirectories
+                subdirectories = set(old_entry[1])
+                for name in names:
+                    uname = os.path.normcase(filename_to_unicode(name))
+                    if uname in subdirectories:
+                        to_scan.append(os.path.join(directory, name))
+                new_index[key] = old_entry
+                continue
+
+            listed_directories.add(key)
+            subdirectories = []
+            for name in names:
+                if fileutil.is_ignored_filename(name):
+                    continue
+                path = os.path.join(directory, os.path.normcase(name))
+                try:
+                    is_dir = os.path.isdir(os.path.join(mount, path))
+                except OSError:
+                    continue
+                if is_dir:
+                    subdirectories.append(
+                        os.path.normcase(filename_to_unicode(name)))
+                    to_scan.append(path)
+                    continue
+                ufilename = filename_to_unicode(path)
+                seen_files.add(os.path.normcase(ufilename))
+                if os.path.normcase(ufilename) in known_files:
+                    continue
+                item_type = _get_item_type(ufilename)
+                if item_type is None:
+                    continue
+                batch.append((item_type, ufilename))
+                if len(batch) >= SCAN_BATCH_SIZE:
+                    eventloop.add_idle(self._add_files,
+                                       "Add files from device scan",
+                                       args=(batch,))
+                    batch = []
+            if mtime > stable_time:
+                # don't trust this mtime next time
+                mtime = None
+            new_index[key] = [mtime, subdirectories]
+
+        if u'' not in new_index:
+            # couldn't read the device, so don't remove anything
+            return new_index, set(), batch
+
+        missing_files = set()
+        for item_path in known_files:
+            directory = os.path.dirname(item_path)
+            if directory in listed_directories:
+                if item_path not in seen_files:
+                    missing_files.add(item_path)
+            elif directory not in new_index:
+                # the directory is gone, or it's one we skip
+                if not os.path.exists(os.path.join(mount, item_path)):
+                    missing_files.add(item_path)
+        return new_index, missing_files, batch
+
+    def _add_files(self, files):
+        if self.canceled:
+            return
+        database = self.device.database
+        database.set_bulk_mode(True)
+        for item_type, ufilename in files:
+            if ufilename not in database[item_type]:
+                database[item_type][ufilename] = {}
+        database.set_bulk_mode(False)
+
+    def _scan_finished(self, result):
+        if self.canceled:
+            return
+        new_index, missing_files, batch = result
+        self._add_files(batch)
+        database = self.device.database
+        database.set_bulk_mode(True)
+        for item_type in ('video', 'audio', 'other'):
+            for item_path in list(database[item_type]):
+                if os.path.normcase(item_path) in missing_files:
+                    del database[item_type][item_path]
+        if new_index:
+            database['directories'] = new_index
+        database.set_bulk_mode(False)
+        self._finish()
+
+    def _scan_error(self, error):
+        if self.canceled:
+            return
+        logging.warn("error scanning %s: %s", self.device.mount, error)
+        self._finish()
 
-    device.database.set_bulk_mode(False)
+    def _finish(self):
+        del _scanners[self.device.mount]
+        if self.rescan_device is not None:
+            scan_device_for_files(self.rescan_device)
+        else:
+            messages.TabsChanged('devices', [], [self.device],
+                                 []).send_to_frontend()
+            messages.DeviceChanged(self.device).send_to_frontend()
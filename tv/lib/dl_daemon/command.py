@@ -27,7 +27,7 @@
 # statement from all source files in the program, then also delete it here.
 
 import time
-import random
+import itertools
 import threading
 import logging
 
@@ -39,10 +39,12 @@ from miro import eventloop
 # BitTorrent trackers.
 DAEMONIC_THREAD_TIMEOUT = 2
 
+_command_ids = itertools.count()
+
 class Command(object):
     spammy = False
     def __init__(self, daemon, *args, **kws):
-        self.command_id = "cmd%08d" % random.randint(0, 99999999)
+        self.command_id = _command_ids.next()
         self.orig = True
         self.args = args
         self.kws = kws
@@ -120,6 +122,16 @@ class BatchUpdateDownloadStatus(Command):
         for status in self.args[0]:
             RemoteDownloader.update_status(status)
 
+class ForgetDownloadStatusCommand(Command):
+    """The downloader daemon removed a download.
+
+    FrameEncoder and FrameDecoder drop the last status they have for the
+    dlid when this command goes through them, so there's nothing left to
+    do here.
+    """
+    def action(self):
+        pass
+
 class DownloaderErrorCommand(Command):
     def action(self):
         from miro import signals
@@ -163,6 +175,12 @@ class UpdateConfigCommand(Command):
     def action(self):
         app.config.set_key(*self.args, **self.kws)
 
+class UpdateInteractiveRateCommand(Command):
+    spammy = True
+    def action(self):
+        from miro import httpclient
+        httpclient.set_external_interactive_rate(*self.args)
+
 class UpdateHTTPPasswordsCommand(Command):
     def action(self):
         from miro.dl_daemon.private import httpauth
@@ -203,6 +221,19 @@ class GetDownloadStatusCommand(Command):
         from miro.dl_daemon import download
         return download.get_download_status(*self.args, **self.kws)
 
+class ResyncDownloadStatusCommand(Command):
+    """The app lost some download statuses.
+
+    Drop the last status we sent for each dlid, so that the next one goes out
+    in full, and queue that update.
+    """
+    def action(self):
+        dlids = self.args[0]
+        for dlid in dlids:
+            self.daemon.encoder.forget(dlid)
+        from miro.dl_daemon import download
+        return download.resync_download_status(dlids)
+
 class RestoreDownloaderCommand(Command):
     def action(self):
         from miro.dl_daemon import download
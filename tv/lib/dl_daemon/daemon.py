@@ -27,8 +27,8 @@
 # statement from all source files in the program, then also delete it here.
 
 from miro.dl_daemon import command
+from miro.dl_daemon import protocol
 import os
-import cPickle
 from struct import pack, unpack, calcsize
 import tempfile
 from miro import app
@@ -44,6 +44,9 @@ from miro.net import ConnectionHandler
 from miro import util
 
 SIZE_OF_INT = calcsize("I")
+# how often we tell the downloader how fast our interactive transfers are
+# going, in seconds
+INTERACTIVE_RATE_INTERVAL = 2
 
 class DaemonError(Exception):
     """Exception while communicating to a daemon (either controller or
@@ -140,6 +143,10 @@ class Daemon(ConnectionHandler):
         self.states['ready'] = self.on_size
         self.states['command'] = self.on_command
         self.queued_commands = []
+        self.outgoing_commands = []
+        self.flush_scheduled = False
+        self.encoder = protocol.FrameEncoder()
+        self.decoder = protocol.FrameDecoder()
         self.shutdown = False
         # disable read timeouts for the downloader daemon
         # communication.  Our normal state is to wait for long periods
@@ -168,11 +175,15 @@ class Daemon(ConnectionHandler):
     def on_command(self):
         if self.buffer.length >= self.size:
             try:
-                comm = cPickle.loads(self.buffer.read(self.size))
-            except cPickle.UnpicklingError:
-                logging.exception("WARNING: error unpickling command.")
+                commands = self.decoder.decode(self.buffer.read(self.size))
+            except protocol.ProtocolError:
+                logging.exception("WARNING: error decoding commands.")
             else:
-                self.process_command(comm)
+                for comm in commands:
+                    self.process_command(comm)
+            dlids = self.decoder.pop_resync_dlids()
+            if dlids:
+                command.ResyncDownloadStatusCommand(self, dlids).send()
             self.change_state('ready')
 
     def process_command(self, comm):
@@ -190,8 +201,34 @@ class Daemon(ConnectionHandler):
         if self.state == 'initializing':
             self.queued_commands.append((comm, callback))
         else:
-            raw = cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
-            self.send_data(pack("I", len(raw)) + raw, callback)
+            # Wait until the current batch of idle callbacks has run, then
+            # send everything that's been queued up in a single frame.
+            self.outgoing_commands.append((comm, callback))
+            if not self.flush_scheduled:
+                self.flush_scheduled = True
+                eventloop.add_idle(self.flush_commands,
+                                   "sending daemon commands")
+
+    def flush_commands(self):
+        self.flush_scheduled = False
+        outgoing = self.outgoing_commands
+        self.outgoing_commands = []
+        while outgoing:
+            batch = outgoing[:protocol.MAX_RECORDS_PER_FRAME]
+            outgoing = outgoing[protocol.MAX_RECORDS_PER_FRAME:]
+            raw = self.encoder.encode([comm for comm, callback in batch])
+            callbacks = [callback for comm, callback in batch
+                         if callback is not None]
+            self.send_data(pack("I", len(raw)) + raw,
+                           self._make_send_callback(callbacks))
+
+    def _make_send_callback(self, callbacks):
+        if not callbacks:
+            return None
+        def callback():
+            for cb in callbacks:
+                cb()
+        return callback
 
 class DownloaderDaemon(Daemon):
     def __init__(self, host, port, short_app_name):
@@ -237,6 +274,8 @@ class ControllerDaemon(Daemon):
         self._setup_httpauth()
         self.shutdown_callback = None
         self.shutdown_timeout_dc = None
+        self.last_interactive_rate = 0
+        self._send_interactive_rate()
 
     def start_downloader_daemon(self):
         start_download_daemon(self.read_pid(), self.addr, self.port)
@@ -268,8 +307,15 @@ class ControllerDaemon(Daemon):
             prefs.GETTEXT_PATHNAME,
             prefs.LIMIT_UPLOAD_RATIO,
             prefs.UPLOAD_RATIO,
+            prefs.BT_ACTIVE_DOWNLOADS_LIMIT,
+            prefs.BT_ACTIVE_SEEDS_LIMIT,
             prefs.LIMIT_CONNECTIONS_BT,
             prefs.CONNECTION_LIMIT_BT_NUM,
+            prefs.LIMIT_DOWNSTREAM_HTTP,
+            prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS,
+            prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS,
+            prefs.HTTP_DOWNLOAD_SEGMENTS,
+            prefs.HTTP_WRITE_BUFFER_SIZE,
             ]
 
         data = {}
@@ -301,6 +347,21 @@ class ControllerDaemon(Daemon):
         c = command.UpdateHTTPPasswordsCommand(self, passwords)
         c.send()
 
+    def _send_interactive_rate(self):
+        """Tell the downloader how much bandwidth our feed updates, icon
+        downloads, etc. are using, so it can fit its downloads under the
+        global limit.
+        """
+        if self.shutdown:
+            return
+        # round to the nearest KB, so we don't send updates for tiny changes
+        rate = int(round(httpclient.get_interactive_rate() / 1024.0)) * 1024
+        if rate != self.last_interactive_rate:
+            command.UpdateInteractiveRateCommand(self, rate).send()
+            self.last_interactive_rate = rate
+        eventloop.add_timeout(INTERACTIVE_RATE_INTERVAL,
+                self._send_interactive_rate, "Send interactive HTTP rate")
+
     def read_pid(self):
         short_app_name = app.config.get(prefs.SHORT_APP_NAME)
         return read_pid(short_app_name)
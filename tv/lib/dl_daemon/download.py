@@ -29,10 +29,11 @@
 import os
 import re
 import stat
-from threading import RLock
+from threading import Lock, RLock
 from copy import copy
 import sys
 import datetime
+import itertools
 import logging
 
 from miro.gtcache import gettext as _
@@ -41,7 +42,8 @@ import libtorrent as lt
 from miro.clock import clock
 from miro.download_utils import (
     clean_filename, next_free_filename, check_filename_extension,
-    filter_directory_name, filename_from_url, get_file_url_path)
+    filter_directory_name, filename_from_url, get_file_url_path,
+    save_fast_resume_data, load_fast_resume_data, delete_fast_resume_data)
 from miro import eventloop
 from miro import httpclient
 from miro import fileutil
@@ -52,7 +54,8 @@ from miro import prefs
 from miro.dl_daemon import command
 from miro.dl_daemon import daemon
 from miro.util import check_f, check_u, stringify, MAX_TORRENT_SIZE
-from miro.plat.utils import get_available_bytes_for_movies, utf8_to_filename
+from miro.plat.utils import (
+    get_available_bytes_for_movies, utf8_to_filename, preallocate_file)
 
 chatter = True
 
@@ -120,7 +123,9 @@ def stop_download(dlid, delete):
     finally:
         _lock.release()
 
-    return download.stop(delete)
+    retval = download.stop(delete)
+    DOWNLOAD_UPDATER.forget(download)
+    return retval
 
 def stop_upload(dlid):
     _lock.acquire()
@@ -134,7 +139,9 @@ def stop_upload(dlid):
         return
     finally:
         _lock.release()
-    return download.stop_upload()
+    retval = download.stop_upload()
+    DOWNLOAD_UPDATER.forget(download)
+    return retval
 
 def pause_upload(dlid):
     _lock.acquire()
@@ -148,7 +155,9 @@ def pause_upload(dlid):
         return
     finally:
         _lock.release()
-    return download.pause_upload()
+    retval = download.pause_upload()
+    DOWNLOAD_UPDATER.forget(download)
+    return retval
 
 def migrate_download(dlid, directory):
     check_f(directory)
@@ -171,10 +180,18 @@ def get_download_status(dlids=None):
                 pass
     return statuses
 
+def resync_download_status(dlids):
+    for dlid in dlids:
+        try:
+            DOWNLOAD_UPDATER.queue_update(_downloads[dlid])
+        except KeyError:
+            pass
+
 def startup():
     logging.info("Starting downloaders")
     DOWNLOAD_UPDATER.start_updates()
     TORRENT_SESSION.startup()
+    HTTP_BANDWIDTH.startup()
 
 def shutdown():
     logging.info("Shutting down downloaders...")
@@ -182,6 +199,7 @@ def shutdown():
         _downloads[dlid].shutdown()
     logging.info("Shutting down torrent session...")
     TORRENT_SESSION.shutdown()
+    HTTP_BANDWIDTH.shutdown()
     logging.info("shutdown() finished")
 
 def restore_downloader(downloader):
@@ -207,10 +225,40 @@ def restore_downloader(downloader):
 class TorrentSession(object):
     """Contains the bittorrent session and handles updating all
     running bittorrents.
+
+    We use libtorrent's alerts to find out which torrents changed.  With
+    libtorrent versions that have post_torrent_updates(), we get the status
+    for only the torrents that changed in a state_update_alert.  With older
+    versions we get state_changed_alerts and poll the torrents, but seeders
+    that aren't uploading anything get polled much less often.
+
+    We also decide which torrents are active, since we don't let libtorrent
+    auto-manage them.  See manage_queue().
     """
+    # how often to poll seeding torrents that aren't uploading (in seconds)
+    IDLE_SEEDER_UPDATE_INTERVAL = 30
+    # how often to rotate the torrent queue (in seconds)
+    QUEUE_UPDATE_INTERVAL = 10
+    # how long an active seed keeps its slot before it can be queued in
+    # favor of another seed (in seconds)
+    SEED_ROTATION_INTERVAL = 60 * 15
+    # how many torrents can hash check their files at once
+    CHECKING_SLOTS = 1
+
     def __init__(self):
         self.torrents = set()
         self.info_hash_to_downloader = {}
+        # maps downloaders -> time when we should next poll their status
+        self.next_poll_time = {}
+        self.use_update_alerts = False
+        # torrents that we paused because they were over the active limits
+        self.queued = set()
+        # maps downloaders -> when they got their active slot
+        self.active_since = {}
+        # maps downloaders -> their place in line for download slots
+        self.queue_position = {}
+        self.queue_counter = itertools.count()
+        self.next_queue_update = 0
         self.session = None
         self.pnp_on = None
         self.pe_set = None
@@ -224,9 +272,19 @@ class TorrentSession(object):
         self.set_upload_limit()
         self.set_download_limit()
         self.set_encryption()
+        self.setup_alerts()
         self.callback_handle = app.downloader_config_watcher.connect('changed',
                 self.on_config_changed)
 
+    def setup_alerts(self):
+        self.use_update_alerts = hasattr(self.session, 'post_torrent_updates')
+        if hasattr(self.session, 'set_alert_mask'):
+            self.session.set_alert_mask(
+                    lt.alert.category_t.status_notification)
+        else:
+            # libtorrent 0.13 doesn't have alert categories
+            self.session.set_severity_level(lt.alert.severity_levels.info)
+
     def listen(self):
         self.session.listen_on(app.config.get(prefs.BT_MIN_PORT),
                                app.config.get(prefs.BT_MAX_PORT))
@@ -308,6 +366,9 @@ class TorrentSession(object):
         elif key in (prefs.LIMIT_CONNECTIONS_BT.key,
                      prefs.CONNECTION_LIMIT_BT_NUM.key):
             self.set_connection_limit()
+        elif key in (prefs.BT_ACTIVE_DOWNLOADS_LIMIT.key,
+                     prefs.BT_ACTIVE_SEEDS_LIMIT.key):
+            self.manage_queue()
 
     def find_duplicate_torrent(self, torrent_info):
         info_hash = info_hash_to_long(torrent_info.info_hash())
@@ -317,21 +378,214 @@ class TorrentSession(object):
         self.torrents.add(downloader)
         info_hash = info_hash_to_long(downloader.torrent.info_hash())
         self.info_hash_to_downloader[info_hash] = downloader
+        if downloader not in self.queue_position:
+            self.queue_position[downloader] = self.queue_counter.next()
+        # Run the queue now, so that new torrents over the limits get paused
+        # before they start hash-checking or connecting to peers.
+        self.manage_queue()
 
     def remove_torrent(self, downloader):
         if downloader in self.torrents:
             self.torrents.remove(downloader)
             info_hash = info_hash_to_long(downloader.torrent.info_hash())
             del self.info_hash_to_downloader[info_hash]
+            self.next_poll_time.pop(downloader, None)
+            self.active_since.pop(downloader, None)
+            if downloader in self.queued:
+                self.queued.remove(downloader)
+                downloader.set_queued(False)
+            # a slot may have opened up
+            self.next_queue_update = 0
+
+    def forget_torrent(self, downloader):
+        """Forget about a torrent that isn't coming back, so it loses its
+        place in line.
+        """
+        self.remove_torrent(downloader)
+        self.queue_position.pop(downloader, None)
 
     def update_torrents(self):
+        """Update the status of torrents that changed since the last call.
+        """
+        changed = {}
+        for alert in self.pop_alerts():
+            self.handle_alert(alert, changed)
         # Copy this set into a list in case any of the torrents gets
         # removed during the iteration.
+        now = clock()
         for torrent in [x for x in self.torrents]:
-            torrent.update_status()
+            category = self.queue_category(torrent)
+            if torrent in changed:
+                torrent.update_status(changed[torrent])
+            elif (not self.use_update_alerts and
+                    now >= self.next_poll_time.get(torrent, 0)):
+                torrent.update_status()
+            else:
+                continue
+            if torrent in self.torrents:
+                self.schedule_poll(torrent, now)
+                if self.queue_category(torrent) != category:
+                    # finished checking or downloading, rerun the queue now
+                    # rather than leaving a slot empty
+                    self.next_queue_update = 0
+        if now >= self.next_queue_update:
+            self.manage_queue()
+        if self.use_update_alerts:
+            # the results come back as a state_update_alert
+            self.session.post_torrent_updates()
+
+    def schedule_poll(self, torrent, now):
+        if torrent.is_idle():
+            self.next_poll_time[torrent] = (now +
+                    self.IDLE_SEEDER_UPDATE_INTERVAL)
+        else:
+            self.next_poll_time[torrent] = now
+
+    def pop_alerts(self):
+        if hasattr(self.session, 'pop_alerts'):
+            return self.session.pop_alerts()
+        alerts = []
+        alert = self.session.pop_alert()
+        while alert is not None:
+            alerts.append(alert)
+            alert = self.session.pop_alert()
+        return alerts
+
+    def handle_alert(self, alert, changed):
+        """Handle an alert from libtorrent.
+
+        changed maps downloaders to their new torrent status.  If an alert
+        tells us that a torrent changed but doesn't include its status, the
+        status is None.
+        """
+        alert_type = alert.__class__.__name__
+        if alert_type == 'state_update_alert':
+            for status in alert.status:
+                downloader = self.downloader_for_handle(status.handle)
+                if downloader is not None:
+                    changed[downloader] = status
+        elif alert_type == 'state_changed_alert':
+            downloader = self.downloader_for_handle(alert.handle)
+            if downloader is not None and downloader not in changed:
+                changed[downloader] = None
+
+    def queue_category(self, downloader):
+        if downloader.is_checking():
+            return 'checking'
+        elif downloader.state == 'uploading':
+            return 'seeding'
+        else:
+            return 'downloading'
+
+    def manage_queue(self):
+        """Decide which torrents should be active and pause the rest.
+
+        Torrents checking their files get their own slots, so that we don't
+        hash-check lots of torrents in parallel and thrash the disk.  The
+        others are split into downloads and seeds, each with their own limit.
+        Downloads get slots in the order they were added.  Seeds that have
+        had a slot for SEED_ROTATION_INTERVAL can lose it to seeds that have
+        peers waiting for data or a lower upload ratio.
+        """
+        now = clock()
+        self.next_queue_update = now + self.QUEUE_UPDATE_INTERVAL
+        categories = {'checking': [], 'downloading': [], 'seeding': []}
+        for torrent in self.torrents:
+            categories[self.queue_category(torrent)].append(torrent)
+        active = set()
+        active.update(self._pick(categories['checking'],
+                self.CHECKING_SLOTS, self._download_rank))
+        active.update(self._pick(categories['downloading'],
+                app.config.get(prefs.BT_ACTIVE_DOWNLOADS_LIMIT),
+                self._download_rank))
+        active.update(self._pick(categories['seeding'],
+                app.config.get(prefs.BT_ACTIVE_SEEDS_LIMIT),
+                lambda torrent: self._seed_rank(torrent, now)))
+        for torrent in self.torrents:
+            if torrent in active:
+                self._activate(torrent, now)
+            else:
+                self._deactivate(torrent)
+
+    def _pick(self, torrents, limit, rank):
+        if limit < 0 or len(torrents) <= limit:
+            return torrents
+        torrents.sort(key=rank)
+        return torrents[:limit]
+
+    def _download_rank(self, torrent):
+        # active torrents keep their slots, then first come first served
+        return (torrent in self.queued, self.queue_position[torrent])
+
+    def _seed_rank(self, torrent, now):
+        # seeds that recently got a slot keep it, so that we don't keep
+        # pausing and resuming them
+        protected = (torrent in self.active_since and
+                now - self.active_since[torrent] <
+                self.SEED_ROTATION_INTERVAL)
+        # leechers is -1 if we don't know, give those seeds a chance
+        return (not protected, torrent.leechers == 0,
+                torrent.get_upload_ratio(), self.queue_position[torrent])
+
+    def _activate(self, torrent, now):
+        if torrent in self.queued:
+            self.queued.remove(torrent)
+            torrent.torrent.resume()
+            torrent.set_queued(False)
+            self.active_since[torrent] = now
+        elif torrent not in self.active_since:
+            self.active_since[torrent] = now
+
+    def _deactivate(self, torrent):
+        if torrent not in self.queued:
+            self.queued.add(torrent)
+            torrent.torrent.pause()
+            torrent.set_queued(True)
+            self.active_since.pop(torrent, None)
+
+    def downloader_for_handle(self, handle):
+        try:
+            info_hash = info_hash_to_long(handle.info_hash())
+        except RuntimeError:
+            # invalid handle, the torrent was removed
+            return None
+        return self.info_hash_to_downloader.get(info_hash)
 
 TORRENT_SESSION = TorrentSession()
 
+class HTTPBandwidth(object):
+    """Keeps httpclient's bandwidth limits in sync with the prefs."""
+
+    LIMIT_PREFS = (prefs.LIMIT_DOWNSTREAM_HTTP,
+            prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS,
+            prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS)
+
+    def startup(self):
+        self.set_limits()
+        self.callback_handle = app.downloader_config_watcher.connect('changed',
+                self.on_config_changed)
+
+    def shutdown(self):
+        app.downloader_config_watcher.disconnect(self.callback_handle)
+
+    def set_limits(self):
+        global_limit = 0
+        if app.config.get(prefs.LIMIT_DOWNSTREAM_HTTP):
+            global_limit = app.config.get(prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS)
+            global_limit = global_limit * (2 ** 10)
+        # the per-download limit works without the global one, 0 turns it
+        # off.
+        transfer_limit = app.config.get(
+                prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS)
+        transfer_limit = transfer_limit * (2 ** 10)
+        httpclient.set_bandwidth_limits(global_limit, transfer_limit)
+
+    def on_config_changed(self, obj, key, value):
+        if key in [pref.key for pref in self.LIMIT_PREFS]:
+            self.set_limits()
+
+HTTP_BANDWIDTH = HTTPBandwidth()
+
 class DownloadStatusUpdater(object):
     """Handles updating status for all in progress downloaders.
 
@@ -378,6 +632,16 @@ class DownloadStatusUpdater(object):
     def queue_update(self, downloader):
         self.to_update.add(downloader)
 
+    def forget(self, downloader):
+        """Stop sending updates for a downloader that we've removed.
+
+        This also tells the app that we're done with its dlid, so that the
+        protocol code can throw away the last status it has for it.
+        """
+        self.to_update.discard(downloader)
+        command.ForgetDownloadStatusCommand(daemon.LAST_DAEMON,
+                downloader.dlid).send()
+
 DOWNLOAD_UPDATER = DownloadStatusUpdater()
 
 RETRY_TIMES = (
@@ -580,14 +844,144 @@ class BGDownloader(object):
             accept = (size <= available)
         return accept
 
+class DownloadSegment(object):
+    """One byte range of a segmented HTTP download.
+
+    Segments write directly into the (preallocated) download file.  write()
+    gets called in the libcurl thread, everything else happens in the
+    eventloop.
+
+    :param start: file position of the first byte of the segment
+    :param end: file position right after the last byte of the segment
+    :param done: number of bytes from start that we've already downloaded
+    :param finished_callback: called in the eventloop with the segment once
+        all of its data is written
+    """
+    def __init__(self, filename, start, end, done, finished_callback):
+        self.filename = filename
+        self.start = start
+        self.end = end
+        self.done = done
+        self.finished_callback = finished_callback
+        self.lock = Lock()
+        self.client = None
+        self.retries = 0
+        self.finished = False
+        self._filehandle = None
+
+    def __str__(self):
+        return "DownloadSegment(%s-%s done: %s)" % (self.start, self.end,
+                self.done)
+
+    def remaining(self):
+        self.lock.acquire()
+        try:
+            return self.end - self.start - self.done
+        finally:
+            self.lock.release()
+
+    def is_complete(self):
+        return self.remaining() <= 0
+
+    def next_range(self):
+        """Get the (first, last) byte range we still need to request."""
+        self.lock.acquire()
+        try:
+            return (self.start + self.done, self.end - 1)
+        finally:
+            self.lock.release()
+
+    def open(self):
+        if self._filehandle is not None:
+            return
+        self._filehandle = fileutil.open_file(self.filename, 'r+b')
+        self._filehandle.seek(self.start + self.done)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self._filehandle is not None:
+                self._filehandle.close()
+                self._filehandle = None
+        finally:
+            self.lock.release()
+
+    def write(self, data):
+        self.lock.acquire()
+        try:
+            if self._filehandle is None:
+                return
+            remaining = self.end - self.start - self.done
+            if remaining <= 0:
+                # we've been split and the data we're getting now belongs
+                # to another segment.  Just drop it.
+                return
+            data = data[:remaining]
+            self._filehandle.write(data)
+            self.done += len(data)
+            complete = (self.done == self.end - self.start)
+        finally:
+            self.lock.release()
+        if complete:
+            eventloop.add_idle(self.finished_callback,
+                    'download segment finished', args=(self,))
+
+    def split(self, min_size):
+        """Give away the second half of the data left in this segment.
+
+        :returns: (start, end) for a new segment or None if there's not
+            enough data left to be worth splitting.
+        """
+        self.lock.acquire()
+        try:
+            pos = self.start + self.done
+            if self.end - pos < min_size * 2:
+                return None
+            old_end = self.end
+            self.end = pos + (old_end - pos) // 2
+            return (self.end, old_end)
+        finally:
+            self.lock.release()
+
+def format_segment_map(segments):
+    """Convert a list of DownloadSegments to a unicode string that we can
+    store in the download status.
+    """
+    return u','.join(u'%d-%d:%d' % (s.start, s.end, s.done)
+            for s in segments)
+
+def parse_segment_map(segment_map):
+    """Inverse of format_segment_map().
+
+    :returns: list of (start, end, done) tuples
+    :raises ValueError: segment_map isn't valid
+    """
+    rv = []
+    for part in segment_map.split(u','):
+        byte_range, done = part.split(u':')
+        start, end = byte_range.split(u'-')
+        start, end, done = int(start), int(end), int(done)
+        if not (0 <= start < end and 0 <= done <= end - start):
+            raise ValueError("invalid segment: %r" % part)
+        rv.append((start, end, done))
+    return rv
+
 class HTTPDownloader(BGDownloader):
     CHECK_STATS_TIMEOUT = 1.0
+    # don't bother splitting downloads into segments smaller than this
+    MIN_SEGMENT_SIZE = 2 ** 20
+    # number of times we retry a segment that ends before all of its data
+    # arrives
+    MAX_SEGMENT_RETRIES = 3
 
     def __init__(self, url=None, dlid=None, restore=None,
                  expectedContentType=None):
         self.retryDC = None
         self.channelName = None
         self.expectedContentType = expectedContentType
+        # string version of the segments for segmented downloads, see
+        # format_segment_map()
+        self.segmentMap = None
         if restore is not None:
             if not isinstance(restore.get('totalSize', 0), int):
                 # Sometimes restoring old downloaders caused errors
@@ -599,6 +993,10 @@ class HTTPDownloader(BGDownloader):
             BGDownloader.__init__(self, url, dlid)
             self.restartOnError = False
         self.client = None
+        self.segments = []
+        # set to False if a segmented download fails because the server
+        # doesn't really support ranges
+        self.allow_segments = True
         self.rate = 0
         if self.state == 'downloading':
             self.start_download()
@@ -611,13 +1009,27 @@ class HTTPDownloader(BGDownloader):
         """Start a download, discarding any existing data"""
         self.currentSize = 0
         self.totalSize = -1
+        self.segmentMap = None
         self.start_download(resume=False)
 
     def start_download(self, resume=True):
         if self.retryDC:
             self.retryDC.cancel()
             self.retryDC = None
-        if resume:
+        if not resume:
+            self.segmentMap = None
+        elif self.segmentMap:
+            if self._segment_resume_sanity_check():
+                logging.info("start_download (segmented): %s", self.url)
+                self.start_segments(parse_segment_map(self.segmentMap))
+                eventloop.add_timeout(self.CHECK_STATS_TIMEOUT,
+                        self.update_stats, 'update http downloader stats')
+                return
+            # can't resume the segments, start over
+            self.segmentMap = None
+            self.currentSize = 0
+            resume = False
+        elif resume:
             resume = self._resume_sanity_check()
 
         logging.info("start_download: %s", self.url)
@@ -625,11 +1037,129 @@ class HTTPDownloader(BGDownloader):
         self.client = httpclient.grab_url(
             self.url, self.on_download_finished, self.on_download_error,
             header_callback=self.on_headers, write_file=self.filename,
-            resume=resume)
+            resume=resume, bulk=True)
         self.update_client()
         eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
                 'update http downloader stats')
 
+    def _segment_resume_sanity_check(self):
+        """Check if we can continue a segmented download.
+
+        :returns: If we should resume the segments in segmentMap
+        """
+        try:
+            segments = parse_segment_map(self.segmentMap)
+        except ValueError:
+            logging.warn("Invalid segment map: %r", self.segmentMap)
+            return False
+        if not os.path.exists(self.filename):
+            return False
+        # the file was preallocated when we started, so it should always be
+        # exactly totalSize bytes.
+        file_size = os.stat(self.filename)[stat.ST_SIZE]
+        if file_size != self.totalSize:
+            logging.warn("Segmented download is the wrong size.  "
+                    "url: %s, path: %s.", self.url, self.filename)
+            return False
+        if max(end for (start, end, done) in segments) != self.totalSize:
+            return False
+        return True
+
+    def should_use_segments(self, info):
+        """Decide if we should switch to a segmented download after
+        seeing the headers for our initial request.
+        """
+        if (not self.allow_segments or
+                app.config.get(prefs.HTTP_DOWNLOAD_SEGMENTS) < 2):
+            return False
+        # only split up fresh downloads of servers that say they support
+        # ranges.
+        return (info['status'] == 200 and
+                'bytes' in info.get('accept-ranges', '').lower() and
+                'content-encoding' not in info and
+                self.totalSize >= self.MIN_SEGMENT_SIZE * 2)
+
+    def start_segmented_download(self):
+        """Switch from our initial request to several range requests."""
+        self.client.cancel(remove_file=False)
+        self.client = None
+        # preallocate the file, so that each segment can write its data
+        # into place.  truncate() sets the size, preallocate_file() reserves
+        # the disk space so the segments don't end up fragmented.
+        try:
+            f = fileutil.open_file(self.filename, 'wb')
+            try:
+                preallocate_file(f, 0, self.totalSize)
+                f.truncate(self.totalSize)
+            finally:
+                f.close()
+        except IOError, e:
+            self.handle_write_error(e)
+            return
+        count = min(app.config.get(prefs.HTTP_DOWNLOAD_SEGMENTS),
+                self.totalSize // self.MIN_SEGMENT_SIZE)
+        segment_size = self.totalSize // count
+        segments = []
+        for i in xrange(count):
+            start = i * segment_size
+            if i == count - 1:
+                end = self.totalSize
+            else:
+                end = start + segment_size
+            segments.append((start, end, 0))
+        logging.info("starting segmented download (%d segments): %s",
+                count, self.url)
+        self.start_segments(segments)
+
+    def start_segments(self, segment_list):
+        """Start downloading a list of (start, end, done) segments."""
+        self.segments = []
+        for start, end, done in segment_list:
+            segment = DownloadSegment(self.filename, start, end, done,
+                    self.on_segment_finished)
+            self.segments.append(segment)
+            if segment.is_complete():
+                segment.finished = True
+        self.segmentMap = format_segment_map(self.segments)
+        try:
+            for segment in self.segments:
+                if not segment.finished:
+                    self.start_segment(segment)
+        except IOError, e:
+            self.handle_write_error(e)
+            return
+        self.update_client()
+        if self._all_segments_finished():
+            self._finish_download()
+
+    def start_segment(self, segment):
+        segment.open()
+        def callback(response):
+            self.on_segment_transfer_finished(segment, client)
+        def errback(error):
+            self.on_segment_error(segment, client, error)
+        client = httpclient.grab_url(self.url, callback, errback,
+                body_callback=segment.write, byte_range=segment.next_range(),
+                compressed=False, bulk=True)
+        segment.client = client
+
+    def _cancel_segments(self):
+        for segment in self.segments:
+            if segment.client is not None:
+                segment.client.cancel(remove_file=False)
+                segment.client = None
+            segment.close()
+        self.segments = []
+
+    def _segment_progress(self):
+        return sum(s.done for s in self.segments)
+
+    def _all_segments_finished(self):
+        for segment in self.segments:
+            if not segment.finished:
+                return False
+        return True
+
     def _resume_sanity_check(self):
         """Do sanity checks to test if we should try HTTP Resume.
 
@@ -666,6 +1196,16 @@ class HTTPDownloader(BGDownloader):
         if self.client is not None:
             self.client.cancel(remove_file=remove_file)
             self.destroy_client()
+        if self.segments:
+            self.currentSize = self._segment_progress()
+            self.segmentMap = format_segment_map(self.segments)
+            self._cancel_segments()
+            if remove_file:
+                self.segmentMap = None
+                try:
+                    fileutil.remove(self.filename)
+                except OSError:
+                    pass
         # if it's in a retrying state, we want to nix that, too
         if self.retryDC:
             self.retryDC.cancel()
@@ -681,6 +1221,7 @@ class HTTPDownloader(BGDownloader):
                 pass
         self.currentSize = 0
         self.totalSize = -1
+        self.segmentMap = None
 
     def handle_temporary_error(self, shortReason, reason):
         self.cancel_request()
@@ -711,8 +1252,14 @@ class HTTPDownloader(BGDownloader):
             ext_content_type = info.get('content-type')
         self.shortFilename = check_filename_extension(self.shortFilename,
                 ext_content_type)
+        if self.client is not None and self.should_use_segments(info):
+            self.start_segmented_download()
 
     def on_download_error(self, error):
+        if self.client is None:
+            # we switched to a segmented download and canceled the
+            # original request
+            return
         if isinstance(error, httpclient.ResumeFailed):
             # try starting from scratch
             self.currentSize = 0
@@ -721,6 +1268,11 @@ class HTTPDownloader(BGDownloader):
         elif isinstance(error, httpclient.AuthorizationCanceled):
             self.destroy_client()
             self.stop(False)
+        elif isinstance(error, httpclient.DiskFull):
+            # no point in retrying this one
+            self.destroy_client()
+            self.handle_error(error.getFriendlyDescription(),
+                              error.getLongDescription())
         elif self.restartOnError:
             self.restartOnError = False
             self.start_download()
@@ -729,7 +1281,86 @@ class HTTPDownloader(BGDownloader):
             self.handle_network_error(error)
 
     def on_download_finished(self, response):
+        if self.client is None:
+            # we switched to a segmented download and canceled the
+            # original request
+            return
         self.destroy_client()
+        self._finish_download()
+
+    def on_segment_finished(self, segment):
+        """Called when all of the data for a segment is written."""
+        if segment.finished or segment not in self.segments:
+            return
+        segment.finished = True
+        if segment.client is not None:
+            # we probably split the segment, so there's still more data
+            # coming that we don't need
+            segment.client.cancel(remove_file=False)
+            segment.client = None
+        segment.close()
+        if self._all_segments_finished():
+            self.currentSize = self._segment_progress()
+            self._cancel_segments()
+            self.segmentMap = None
+            self._finish_download()
+        else:
+            self.rebalance_segments()
+
+    def rebalance_segments(self):
+        """Split the biggest segment that's still downloading so that we
+        keep all our connections busy.
+        """
+        active = [s for s in self.segments if not s.finished]
+        biggest = max(active, key=lambda s: s.remaining())
+        new_range = biggest.split(self.MIN_SEGMENT_SIZE)
+        if new_range is None:
+            return
+        start, end = new_range
+        segment = DownloadSegment(self.filename, start, end, 0,
+                self.on_segment_finished)
+        self.segments.append(segment)
+        self.segmentMap = format_segment_map(self.segments)
+        try:
+            self.start_segment(segment)
+        except IOError, e:
+            self.handle_write_error(e)
+
+    def on_segment_transfer_finished(self, segment, client):
+        if segment.client is not client:
+            return
+        segment.client = None
+        if segment.is_complete():
+            # on_segment_finished() will handle this
+            return
+        # The server closed the connection before sending the whole range,
+        # try again from where we left off.
+        segment.retries += 1
+        if segment.retries > self.MAX_SEGMENT_RETRIES:
+            self.on_segment_error(segment, None,
+                    httpclient.PossiblyTemporaryError(_("no content")))
+            return
+        self.start_segment(segment)
+
+    def on_segment_error(self, segment, client, error):
+        if segment.client is not client or segment not in self.segments:
+            return
+        segment.client = None
+        if isinstance(error, httpclient.UnexpectedStatusCode):
+            # The server doesn't handle ranges the way we expected.  Fall
+            # back to a normal download.
+            logging.info("segmented download failed, restarting: %s",
+                    self.url)
+            self._cancel_segments()
+            self.allow_segments = False
+            self.start_new_download()
+        else:
+            self.currentSize = self._segment_progress()
+            self.segmentMap = format_segment_map(self.segments)
+            self._cancel_segments()
+            self.handle_network_error(error)
+
+    def _finish_download(self):
         self.state = "finished"
         self.endTime = clock()
         # bug 14131 -- if there's nothing here, treat it like a temporary
@@ -749,12 +1380,18 @@ class HTTPDownloader(BGDownloader):
     def get_status(self):
         data = BGDownloader.get_status(self)
         data['dlerType'] = 'HTTP'
+        if self.segments:
+            self.segmentMap = format_segment_map(self.segments)
+        data['segmentMap'] = self.segmentMap
         return data
 
     def update_stats(self):
         """Update the download rate and eta based on receiving length
         bytes.
         """
+        if self.segments and self.state == 'downloading':
+            self.update_segment_stats()
+            return
         if self.client is None or self.state != 'downloading':
             return
         stats = self.client.get_stats()
@@ -767,6 +1404,16 @@ class HTTPDownloader(BGDownloader):
                 'update http downloader stats')
         DOWNLOAD_UPDATER.queue_update(self)
 
+    def update_segment_stats(self):
+        self.currentSize = self._segment_progress()
+        self.rate = 0
+        for segment in self.segments:
+            if segment.client is not None:
+                self.rate += segment.client.get_stats().download_rate
+        eventloop.add_timeout(self.CHECK_STATS_TIMEOUT, self.update_stats,
+                'update http downloader stats')
+        DOWNLOAD_UPDATER.queue_update(self)
+
     def pause(self):
         """Pauses the download.
         """
@@ -821,15 +1468,23 @@ class BTDownloader(BGDownloader):
         self.rate = self.eta = 0
         self.upRate = self.uploaded = 0
         self.activity = None
-        self.fastResumeData = None
+        # Fast resume data is stored in a file, see save_fast_resume_data().
+        # We send the app this number, which goes up every time we write the
+        # file.  0 means we never wrote it.
+        self.fastResumeVersion = 0
+        self.info_hash = None
         self.retryDC = None
         self.channelName = None
         self.uploadedStart = 0
         self.restarting = False
         self.seeders = -1
         self.leechers = -1
+        # the last libtorrent state we saw, None until we get a status
+        self.torrent_state = None
+        # set when TORRENT_SESSION pauses us because we're over the limits
+        self.queued = False
         self.last_fast_resume_update = clock()
-        self.metainfo_updated = self.fast_resume_data_updated = False
+        self.metainfo_updated = False
         if restore is not None:
             self.firstTime = False
             self.restore_state(restore)
@@ -858,15 +1513,21 @@ class BTDownloader(BGDownloader):
                 return
 
             save_path = os.path.dirname(fileutil.expand_filename(self.filename))
-            if self.fastResumeData:
+            self.info_hash = str(torrent_info.info_hash())
+            fast_resume_data = None
+            if self.fastResumeVersion:
+                fast_resume_data = load_fast_resume_data(self.info_hash)
+            if fast_resume_data:
                 self.torrent = TORRENT_SESSION.session.add_torrent(
-                    torrent_info, save_path, lt.bdecode(self.fastResumeData),
+                    torrent_info, save_path, lt.bdecode(fast_resume_data),
                     lt.storage_mode_t.storage_mode_allocate)
                 self.torrent.resume()
             else:
                 self.torrent = TORRENT_SESSION.session.add_torrent(
                     torrent_info, save_path, None,
                     lt.storage_mode_t.storage_mode_allocate)
+            # TORRENT_SESSION decides which torrents are active, so turn off
+            # libtorrent's own queueing.
             try:
                 if (lt.version_major, lt.version_minor) > (0, 13):
                     logging.debug(
@@ -886,7 +1547,7 @@ class BTDownloader(BGDownloader):
 
     def _shutdown_torrent(self):
         try:
-            TORRENT_SESSION.remove_torrent(self)
+            TORRENT_SESSION.forget_torrent(self)
             if self.torrent is not None:
                 self.torrent.pause()
                 self.update_fast_resume_data()
@@ -920,8 +1581,10 @@ class BTDownloader(BGDownloader):
         except:
             logging.exception("Error resuming torrent")
 
-    def update_status(self):
-        """
+    def update_status(self, status=None):
+        """Update our attributes from a libtorrent torrent_status.  If status
+        is None, we ask the torrent for it.
+
         activity -- string specifying what's currently happening or None for
                 normal operations.
         upRate -- upload rate in B/s
@@ -932,19 +1595,23 @@ class BTDownloader(BGDownloader):
         timeEst -- estimated completion time, in seconds.
         totalSize -- total size of the torrent in bytes
         """
-        status = self.torrent.status()
+        if status is None:
+            status = self.torrent.status()
         self.totalSize = status.total_wanted
         self.rate = status.download_payload_rate
         self.upRate = status.upload_payload_rate
         self.uploaded = status.total_payload_upload + self.uploadedStart
         self.seeders = status.num_complete
         self.leechers = status.num_incomplete
+        self.torrent_state = status.state
         try:
             self.eta = ((status.total_wanted - status.total_wanted_done) /
                         float(status.download_payload_rate))
         except ZeroDivisionError:
             self.eta = 0
-        if status.state == lt.torrent_status.states.queued_for_checking:
+        if self.queued:
+            self.activity = "queued"
+        elif status.state == lt.torrent_status.states.queued_for_checking:
             self.activity = "waiting to check existing files"
         elif status.state == lt.torrent_status.states.checking_files:
             self.activity = "checking existing files"
@@ -971,14 +1638,49 @@ class BTDownloader(BGDownloader):
         if self.should_update_fast_resume_data():
             self.update_fast_resume_data()
 
+    def is_idle(self):
+        """Are we seeding without uploading anything?"""
+        return self.state == 'uploading' and self.upRate == 0
+
+    def is_checking(self):
+        """Are we hash checking our files right now?
+
+        Torrents that are waiting to be checked don't count.  libtorrent
+        queues those itself, and holding them back would keep restored
+        torrents with good fast resume data from starting.
+        """
+        return self.torrent_state == lt.torrent_status.states.checking_files
+
+    def get_upload_ratio(self):
+        if not self.totalSize:
+            return 0.0
+        return float(self.uploaded) / self.totalSize
+
+    def set_queued(self, queued):
+        """Called by TORRENT_SESSION when it pauses or resumes us to keep
+        within the active torrent limits.
+        """
+        self.queued = queued
+        if queued:
+            self.activity = "queued"
+            self.rate = self.upRate = self.eta = 0
+        else:
+            self.activity = None
+        DOWNLOAD_UPDATER.queue_update(self)
+
     def should_update_fast_resume_data(self):
         return (clock() - self.last_fast_resume_update >
                 self.FAST_RESUME_UPDATE_INTERVAL)
 
     def update_fast_resume_data(self):
         self.last_fast_resume_update = clock()
-        self.fastResumeData = lt.bencode(self.torrent.write_resume_data())
-        self.fast_resume_data_updated = True
+        data = lt.bencode(self.torrent.write_resume_data())
+        try:
+            save_fast_resume_data(self.info_hash, data)
+        except (IOError, OSError):
+            logging.exception("Error saving fast resume data")
+        else:
+            self.fastResumeVersion += 1
 
     def handle_error(self, shortReason, reason):
         self._shutdown_torrent()
@@ -1013,9 +1715,7 @@ class BTDownloader(BGDownloader):
         if self.metainfo_updated:
             data['metainfo'] = self.metainfo
             self.metainfo_updated = False
-        if self.fast_resume_data_updated:
-            data['fastResumeData'] = self.fastResumeData
-            self.fast_resume_data_updated = False
+        data['fastResumeVersion'] = self.fastResumeVersion
         data['activity'] = self.activity
         data['dlerType'] = 'BitTorrent'
         data['seeders'] = self.seeders
@@ -1039,6 +1739,8 @@ class BTDownloader(BGDownloader):
         self._shutdown_torrent()
         self.update_client()
         if delete:
+            if self.info_hash is not None:
+                delete_fast_resume_data(self.info_hash)
             try:
                 if fileutil.isdir(self.filename):
                     fileutil.rmtree(self.filename)
@@ -0,0 +1,381 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005-2010 Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""protocol.py -- Wire format for app <-> downloader daemon communication.
+
+Each message on the socket is a size prefix (written by Daemon) followed by a
+frame.  A frame starts with a header holding the protocol version and the
+number of records it contains, so several commands can share one frame.  Each
+record has a type tag and a length, followed by its payload.
+
+Download status updates are the bulk of the traffic, so they get their own
+record types.  Status dicts are flattened using the fixed STATUS_FIELDS
+schema, and fields whose value hasn't changed since the last status we sent
+for that download are left out.  The decoder remembers the last status it saw
+for each download and fills those fields back in, so the receiving side still
+gets complete status dicts.  When the daemon removes a download it sends a
+ForgetDownloadStatusCommand, and both sides drop what they remember for it as
+that command passes through them.
+
+A record that can't be decoded is skipped, the rest of the frame is still
+used.  If we lose a status that way, the decoder forgets what it has for the
+download and lists its dlid in resync_dlids.  Daemon sends those back in a
+ResyncDownloadStatusCommand, which makes the encoder send the next status in
+full.
+
+All other commands are sent as a pickled (class name, args, kws) tuple.
+
+Encoders and decoders are stateful: use one of each per connection.
+"""
+
+import cPickle
+import logging
+from struct import Struct
+
+from miro.dl_daemon import command
+
+PROTOCOL_VERSION = 2
+
+# version, record count
+FRAME_HEADER = Struct("!BH")
+# record type, payload length
+RECORD_HEADER = Struct("!BI")
+
+RECORD_COMMAND = 1
+RECORD_STATUS = 2
+RECORD_STATUS_BATCH = 3
+
+MAX_RECORDS_PER_FRAME = 0xffff
+
+# Fields of a download status, in wire order.  The second value says if we
+# can leave the field out when it's unchanged.  metainfo is only included by
+# the downloader when it changes and can be large, so we don't keep copies of
+# it around.
+STATUS_FIELDS = (
+    ('url', True),
+    ('state', True),
+    ('totalSize', True),
+    ('currentSize', True),
+    ('eta', True),
+    ('rate', True),
+    ('uploaded', True),
+    ('filename', True),
+    ('startTime', True),
+    ('endTime', True),
+    ('shortFilename', True),
+    ('reasonFailed', True),
+    ('shortReasonFailed', True),
+    ('dlerType', True),
+    ('retryTime', True),
+    ('retryCount', True),
+    ('channelName', True),
+    ('segmentMap', True),
+    ('upRate', True),
+    ('activity', True),
+    ('seeders', True),
+    ('leechers', True),
+    ('fastResumeVersion', True),
+    ('metainfo', False),
+)
+
+_FIELD_BITS = tuple((1 << i, name)
+        for i, (name, can_omit) in enumerate(STATUS_FIELDS))
+_KNOWN_KEYS = frozenset(['dlid'] +
+        [name for name, can_omit in STATUS_FIELDS])
+_ALWAYS_SENT = tuple(name for name, can_omit in STATUS_FIELDS
+        if not can_omit)
+_MISSING = object()
+
+def _omittable_fields(status):
+    """Copy the fields of status that we can leave out next time if they
+    don't change.
+    """
+    fields = status.copy()
+    for name in _ALWAYS_SENT:
+        fields.pop(name, None)
+    return fields
+
+class ProtocolError(Exception):
+    """Raised when we can't decode a frame."""
+    pass
+
+def _is_status_command(comm):
+    return not comm.kws and len(comm.args) == 1
+
+class FrameEncoder(object):
+    """Turns lists of commands into frames."""
+
+    def __init__(self):
+        # maps dlid -> the omittable fields of the last status we sent
+        self.sent_statuses = {}
+
+    def encode(self, commands):
+        """Encode a list of commands into a single frame.
+
+        :returns: frame data as a string
+        """
+        if len(commands) > MAX_RECORDS_PER_FRAME:
+            raise ValueError("too many commands for one frame: %d" %
+                    len(commands))
+        parts = [FRAME_HEADER.pack(PROTOCOL_VERSION, len(commands))]
+        for comm in commands:
+            record_type, payload = self.encode_command(comm)
+            parts.append(RECORD_HEADER.pack(record_type, len(payload)))
+            parts.append(payload)
+        return ''.join(parts)
+
+    def encode_command(self, comm):
+        """Encode a single command.
+
+        :returns: (record type, payload) tuple
+        """
+        if (type(comm) is command.BatchUpdateDownloadStatus and
+                _is_status_command(comm)):
+            rows = [self.encode_status(status) for status in comm.args[0]]
+            return RECORD_STATUS_BATCH, self._dumps(rows)
+        elif (type(comm) is command.UpdateDownloadStatus and
+                _is_status_command(comm)):
+            rows = [self.encode_status(comm.args[0])]
+            return RECORD_STATUS, self._dumps(rows)
+        else:
+            if type(comm) is command.ForgetDownloadStatusCommand:
+                self.forget(comm.args[0])
+            data = (comm.__class__.__name__, comm.args, comm.kws)
+            return RECORD_COMMAND, self._dumps(data)
+
+    def encode_status(self, status):
+        """Flatten a status dict into a row.
+
+        A row is a (dlid, present, sent, values, extras) tuple.  present and
+        sent are bitmaps over STATUS_FIELDS for the fields in the status and
+        the fields included in values.  extras holds any fields that aren't
+        part of the schema, or None.
+        """
+        dlid = status['dlid']
+        get_last = self.sent_statuses.get(dlid, {}).get
+        present = sent = 0
+        values = []
+        for bit, name in _FIELD_BITS:
+            if name not in status:
+                continue
+            value = status[name]
+            present |= bit
+            old_value = get_last(name, _MISSING)
+            if old_value == value and type(old_value) is type(value):
+                continue
+            sent |= bit
+            values.append(value)
+        self.sent_statuses[dlid] = _omittable_fields(status)
+        extras = None
+        if not _KNOWN_KEYS.issuperset(status):
+            extras = dict((key, value) for key, value in status.iteritems()
+                    if key not in _KNOWN_KEYS)
+        return (dlid, present, sent, tuple(values), extras)
+
+    def forget(self, dlid):
+        """Forget the last status sent for dlid."""
+        self.sent_statuses.pop(dlid, None)
+
+    def _dumps(self, obj):
+        return cPickle.dumps(obj, cPickle.HIGHEST_PROTOCOL)
+
+class FrameDecoder(object):
+    """Turns frames back into lists of commands."""
+
+    def __init__(self):
+        # maps dlid -> the omittable fields of the last status we received
+        self.received_statuses = {}
+        # dlids we lost a status for, see resync()
+        self.resync_dlids = set()
+
+    def decode(self, data):
+        """Decode a frame created by FrameEncoder.encode().
+
+        The commands returned don't have a daemon set.  Records that can't be
+        decoded are logged and left out.
+
+        :raises ProtocolError: if the frame is invalid
+        :returns: list of commands
+        """
+        try:
+            records = self.split_frame(data)
+        except ProtocolError:
+            # we don't know which statuses we lost
+            self.resync_all()
+            raise
+        commands = []
+        for record_type, payload in records:
+            try:
+                comm = self.decode_record(record_type, payload)
+            except ProtocolError, e:
+                logging.warning("skipping bad record: %s", e)
+                if record_type != RECORD_COMMAND:
+                    self.resync_all()
+            else:
+                if comm is not None:
+                    commands.append(comm)
+        return commands
+
+    def split_frame(self, data):
+        """Split a frame into a list of (record type, payload) tuples."""
+        if len(data) < FRAME_HEADER.size:
+            raise ProtocolError("frame too short")
+        version, count = FRAME_HEADER.unpack_from(data)
+        if version != PROTOCOL_VERSION:
+            raise ProtocolError("unsupported protocol version: %d" % version)
+        pos = FRAME_HEADER.size
+        records = []
+        for i in xrange(count):
+            if len(data) < pos + RECORD_HEADER.size:
+                raise ProtocolError("truncated record header")
+            record_type, length = RECORD_HEADER.unpack_from(data, pos)
+            pos += RECORD_HEADER.size
+            if len(data) < pos + length:
+                raise ProtocolError("truncated record")
+            records.append((record_type, data[pos:pos+length]))
+            pos += length
+        if pos != len(data):
+            raise ProtocolError("extra data after last record")
+        return records
+
+    def decode_record(self, record_type, payload):
+        """Decode a single record.
+
+        :raises ProtocolError: if the record is invalid
+        :returns: a command, or None if none of the statuses in it could be
+            decoded
+        """
+        try:
+            data = cPickle.loads(payload)
+        except (cPickle.UnpicklingError, EOFError, ValueError), e:
+            raise ProtocolError("error unpickling record: %s" % e)
+        if record_type == RECORD_COMMAND:
+            return self.decode_command(data)
+        elif record_type == RECORD_STATUS:
+            statuses = self.decode_statuses(data)
+            if len(statuses) != 1:
+                return None
+            return command.UpdateDownloadStatus(None, statuses[0])
+        elif record_type == RECORD_STATUS_BATCH:
+            statuses = self.decode_statuses(data)
+            if not statuses:
+                return None
+            return command.BatchUpdateDownloadStatus(None, statuses)
+        else:
+            raise ProtocolError("unknown record type: %d" % record_type)
+
+    def decode_command(self, data):
+        try:
+            class_name, args, kws = data
+        except (TypeError, ValueError):
+            raise ProtocolError("bad command record")
+        cls = getattr(command, class_name, None)
+        if not (isinstance(cls, type) and issubclass(cls, command.Command)):
+            raise ProtocolError("unknown command: %r" % (class_name,))
+        try:
+            if cls is command.ForgetDownloadStatusCommand:
+                self.forget(args[0])
+            return cls(None, *args, **kws)
+        except (TypeError, ValueError, IndexError, KeyError), e:
+            raise ProtocolError("bad arguments for %s: %s" % (class_name, e))
+
+    def decode_statuses(self, rows):
+        """Decode the rows of a status record, leaving out the bad ones."""
+        if not isinstance(rows, list):
+            raise ProtocolError("bad status record")
+        statuses = []
+        for row in rows:
+            try:
+                statuses.append(self.decode_status(row))
+            except ProtocolError, e:
+                logging.warning("skipping bad status: %s", e)
+        return statuses
+
+    def decode_status(self, row):
+        """Rebuild a status dict from a row made by
+        FrameEncoder.encode_status().
+
+        Always returns a new dict, so callers are free to change it.
+        """
+        try:
+            dlid, present, sent, values, extras = row
+            hash(dlid)
+        except (TypeError, ValueError):
+            # we can't tell which download this was for
+            self.resync_all()
+            raise ProtocolError("bad status row")
+        last = self.received_statuses.get(dlid, {})
+        status = {'dlid': dlid}
+        try:
+            next_value = iter(values).next
+            for bit, name in _FIELD_BITS:
+                if not present & bit:
+                    continue
+                if sent & bit:
+                    status[name] = next_value()
+                else:
+                    status[name] = last[name]
+        except (StopIteration, KeyError, TypeError):
+            self.resync(dlid)
+            raise ProtocolError("bad status row for %r" % (dlid,))
+        if extras is not None and not isinstance(extras, dict):
+            self.resync(dlid)
+            raise ProtocolError("bad extra fields for %r" % (dlid,))
+        self.received_statuses[dlid] = _omittable_fields(status)
+        if extras:
+            status.update(extras)
+        return status
+
+    def forget(self, dlid):
+        """Forget the last status received for dlid."""
+        self.received_statuses.pop(dlid, None)
+
+    def resync(self, dlid):
+        """Forget the last status received for dlid and ask for the next one
+        in full.
+        """
+        self.forget(dlid)
+        self.resync_dlids.add(dlid)
+
+    def resync_all(self):
+        """Call resync() for every download we have a status for.
+
+        Downloads we don't have anything for can't get out of sync: we'll
+        fail to decode their next status unless it's complete.
+        """
+        for dlid in self.received_statuses.keys():
+            self.resync(dlid)
+
+    def pop_resync_dlids(self):
+        """Get the dlids that need a resync and clear the list.
+
+        :returns: list of dlids
+        """
+        dlids = list(self.resync_dlids)
+        self.resync_dlids.clear()
+        return dlids
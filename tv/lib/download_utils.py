@@ -34,7 +34,9 @@ import os.path
 import re
 import logging
 
+from miro import app
 from miro import filetypes
+from miro import prefs
 from miro import util
 
 from miro.util import check_f, check_u, returns_filename, returns_file
@@ -238,3 +240,66 @@ def filter_directory_name(name):
     into platform specific pathname limitations.
     """
     return re.sub(r'[^a-zA-Z0-9]', '-', name)
+
+def fast_resume_directory():
+    """Directory where the downloader stores BitTorrent fast resume data.
+    """
+    return os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+                        'fast-resume')
+
+def fast_resume_path(info_hash):
+    """Path of the fast resume file for a torrent.
+
+    :param info_hash: the torrent's info hash, as a hex string
+    """
+    return os.path.join(fast_resume_directory(), '%s.fastresume' % info_hash)
+
+def save_fast_resume_data(info_hash, data):
+    """Write fast resume data for a torrent.
+
+    The data gets written to a temporary file which then replaces the old
+    file, so we never leave a partially written file behind.
+
+    NOTE: This can throw IOError or OSError.  Make sure you catch these in
+    the caller.
+    """
+    directory = fast_resume_directory()
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    path = fast_resume_path(info_hash)
+    temp_path = path + '.tmp'
+    f = open(temp_path, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    try:
+        os.rename(temp_path, path)
+    except OSError:
+        # windows won't rename over an existing file
+        if not os.path.exists(path):
+            raise
+        os.remove(path)
+        os.rename(temp_path, path)
+
+def load_fast_resume_data(info_hash):
+    """Read the fast resume data for a torrent.
+
+    :returns: the data, or None if we can't read it
+    """
+    try:
+        f = open(fast_resume_path(info_hash), 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+    except IOError:
+        return None
+
+def delete_fast_resume_data(info_hash):
+    try:
+        os.remove(fast_resume_path(info_hash))
+    except OSError:
+        pass
@@ -36,9 +36,11 @@ from miro.gtcache import gettext as _
 from miro.database import DDBObject, ObjectNotFoundError
 from miro.dl_daemon import daemon, command
 from miro.download_utils import (next_free_filename, get_file_url_path,
-                                 filter_directory_name)
-from miro.util import (get_torrent_info_hash, returns_unicode, check_u,
-                       returns_filename, unicodify, check_f, to_uni)
+                                 filter_directory_name,
+                                 delete_fast_resume_data)
+from miro.util import (get_torrent_info_hash, get_metainfo_info_hash,
+                       returns_unicode, check_u, returns_filename, unicodify,
+                       check_f, to_uni)
 from miro import app
 from miro import dialogs
 from miro import displaytext
@@ -58,6 +60,29 @@ _downloads = {}
 total_up_rate = 0
 total_down_rate = 0
 
+# status fields that change constantly and are only used for display.  If
+# only these change, we don't signal items that nobody is looking at.
+RATE_FIELDS = frozenset(['rate', 'upRate', 'eta'])
+
+# database view trackers for items that the frontend is displaying.  See
+# add_item_display_tracker().
+_item_display_trackers = set()
+
+def add_item_display_tracker(tracker):
+    """Tell the downloader module about a view tracker for items that are
+    currently being displayed.
+    """
+    _item_display_trackers.add(tracker)
+
+def remove_item_display_tracker(tracker):
+    _item_display_trackers.discard(tracker)
+
+def is_item_displayed(item_id):
+    for tracker in _item_display_trackers:
+        if item_id in tracker.current_ids:
+            return True
+    return False
+
 def get_downloader_by_dlid(dlid):
     try:
         return RemoteDownloader.get_by_dlid(dlid)
@@ -83,7 +108,7 @@ class RemoteDownloader(DDBObject):
         self.main_item_id = None
         self.dlid = generate_dlid()
         self.status = {}
-        self.metainfo = self.fast_resume_data = None
+        self.metainfo = None
         self.state = u'downloading'
         if contentType is None:
             # HACK: Some servers report the wrong content-type for
@@ -238,47 +263,56 @@ class RemoteDownloader(DDBObject):
 
     @classmethod
     def update_status(cls, data):
+        """Apply a status update from the downloader daemon.
+
+        data is always a complete status dict, the protocol code fills in
+        any fields that the daemon left out.  We keep track of which fields
+        changed so that we can skip signalling items when only the rates did.
+        """
         for field in data:
             if field not in ['filename', 'shortFilename', 'channelName',
-                             'metainfo', 'fastResumeData']:
+                             'metainfo']:
                 data[field] = unicodify(data[field])
         self = get_downloader_by_dlid(dlid=data['dlid'])
         # print data
         if self is not None:
             # FIXME - this should get fixed.
             metainfo = data.pop('metainfo', self.metainfo)
-            fast_resume_data = data.pop('fastResumeData',
-                    self.fast_resume_data)
-            # for metainfo and fast_resume_data, the downloader process
-            # doesn't send the keys if they haven't changed.  Therefore, use
-            # our current values if the key isn't present
-            current = (self.status, self.metainfo, self.fast_resume_data)
-            new = (data, metainfo, fast_resume_data)
+            # for metainfo, the downloader process doesn't send the key if it
+            # hasn't changed.  Therefore, use our current value if the key
+            # isn't present.  Fast resume data is stored in a file by the
+            # downloader, we just get the fastResumeVersion field.
+
+            # FIXME: how do we get all of the possible bit torrent
+            # activity strings into gettext? --NN
+            if data.has_key('activity') and data['activity']:
+                data['activity'] = _(data['activity'])
+
             try:
-                if current == new:
-                    return
+                changed = set(key for key, value in data.iteritems()
+                        if (key not in self.status or
+                            self.status[key] != value))
+                changed.update(key for key in self.status if key not in data)
+                other_changed = (metainfo != self.metainfo)
             except Exception:
                 # This is a known bug with the way we used to save
                 # fast resume data
                 logging.exception("RemoteDownloader.update_status: exception when comparing status")
+                changed = set(data.keys())
+                other_changed = True
+            if not changed and not other_changed:
+                return
 
             was_finished = self.is_finished()
             old_filename = self.get_filename()
             self.before_changing_status()
 
-            # FIXME: how do we get all of the possible bit torrent
-            # activity strings into gettext? --NN
-            if data.has_key('activity') and data['activity']:
-                data['activity'] = _(data['activity'])
-
             # only set attributes if something's changed.  This makes our
             # UPDATE statments contain less data
-            if data != self.status:
+            if changed:
                 self.status = data
             if metainfo != self.metainfo:
                 self.metainfo = metainfo
-            if fast_resume_data != self.fast_resume_data:
-                self.fast_resume_data = fast_resume_data
             self._recalc_state()
 
             # Store the time the download finished
@@ -286,6 +320,11 @@ class RemoteDownloader(DDBObject):
             file_migrated = (self.is_finished() and
                              self.get_filename() != old_filename)
             needs_signal_item = not (finished or file_migrated)
+            if (needs_signal_item and not other_changed and
+                    changed.issubset(RATE_FIELDS) and
+                    not self._items_displayed()):
+                # only the rates changed and nobody is looking at them
+                needs_signal_item = False
             self.after_changing_status()
 
             if ((self.get_state() == u'uploading'
@@ -310,6 +349,12 @@ class RemoteDownloader(DDBObject):
             elif file_migrated:
                 self._file_migrated(old_filename)
 
+    def _items_displayed(self):
+        for item in self.item_list:
+            if is_item_displayed(item.id):
+                return True
+        return False
+
     def run_downloader(self):
         """This is the actual download thread.
         """
@@ -371,6 +416,7 @@ class RemoteDownloader(DDBObject):
             self.signal_change()
 
     def delete(self):
+        self._delete_fast_resume_data()
         if "filename" in self.status:
             filename = self.status['filename']
         else:
@@ -394,6 +440,15 @@ class RemoteDownloader(DDBObject):
                 logging.exception("Error deleting empty download directory: %s",
                                   to_uni(parent))
 
+    def _delete_fast_resume_data(self):
+        if not self.status.get('fastResumeVersion') or self.metainfo is None:
+            return
+        try:
+            info_hash = get_metainfo_info_hash(self.metainfo)
+        except ValueError:
+            return
+        delete_fast_resume_data(info_hash.encode('hex'))
+
     def start(self):
         """Continues a paused, stopped, or failed download thread
         """
@@ -674,9 +729,8 @@ class RemoteDownloader(DDBObject):
                 self.run_downloader()
         else:
             _downloads[self.dlid] = self
-            dler_status = self.status
+            dler_status = self.status.copy()
             dler_status['metainfo'] = self.metainfo
-            dler_status['fastResumeData'] = self.fast_resume_data
             c = command.RestoreDownloaderCommand(RemoteDownloader.dldaemon,
                                                  dler_status)
             c.send()
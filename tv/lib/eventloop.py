@@ -44,13 +44,14 @@ import logging
 import traceback
 from miro import app
 from miro import config
+from miro import prefs
 from miro import trapcall
 from miro import signals
 from miro import util
 
 from miro.clock import clock
 
-from miro.plat.utils import thread_body
+from miro.plat.utils import thread_body, get_logical_cpu_count
 
 cumulative = {}
 
@@ -155,30 +156,112 @@ class ThreadPool(object):
     that block and there's no asynchronous workaround.  What we do
     instead is call them in a separate thread and return the result in
     a callback that executes in the event loop.
+
+    Each pool keeps some simple statistics about how it's being used,
+    see ``get_stats()``.
     """
     THREADS = 3
 
-    def __init__(self, event_loop):
+    def __init__(self, event_loop, name='default', size=None):
         self.event_loop = event_loop
+        self.name = name
+        if size is None:
+            size = ThreadPool.THREADS
+        self.size = size
         self.queue = Queue.Queue()
         self.threads = []
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats_lock.acquire()
+        try:
+            self.stats_start = clock()
+            self.calls_finished = 0
+            self.busy_threads = 0
+            self.total_wait_time = 0.0
+            self.max_wait_time = 0.0
+            self.total_busy_time = 0.0
+        finally:
+            self.stats_lock.release()
+
+    def get_stats(self):
+        """Get statistics for this pool.
+
+        :returns: dict with these keys:
+
+        * **size** -- number of threads in the pool
+        * **queue_depth** -- number of calls waiting for a thread
+        * **busy_threads** -- number of threads currently running a call
+        * **calls_finished** -- number of calls that have finished
+        * **avg_wait_time** -- average time calls waited in the queue
+        * **max_wait_time** -- longest time a call waited in the queue
+        * **utilization** -- fraction of the available thread time that
+          was spent running calls (0.0 - 1.0)
+        """
+        self.stats_lock.acquire()
+        try:
+            if self.calls_finished > 0:
+                avg_wait_time = self.total_wait_time / self.calls_finished
+            else:
+                avg_wait_time = 0.0
+            elapsed = clock() - self.stats_start
+            if elapsed > 0 and self.size > 0:
+                utilization = min(1.0,
+                        self.total_busy_time / (elapsed * self.size))
+            else:
+                utilization = 0.0
+            return {
+                'size': self.size,
+                'queue_depth': self.queue.qsize(),
+                'busy_threads': self.busy_threads,
+                'calls_finished': self.calls_finished,
+                'avg_wait_time': avg_wait_time,
+                'max_wait_time': self.max_wait_time,
+                'utilization': utilization,
+            }
+        finally:
+            self.stats_lock.release()
 
     def init_threads(self):
-        while len(self.threads) < ThreadPool.THREADS:
-            t = threading.Thread(name='ThreadPool - %d' % len(self.threads),
+        while len(self.threads) < self.size:
+            t = threading.Thread(name='ThreadPool (%s) - %d' %
+                                 (self.name, len(self.threads)),
                                  target=thread_body,
                                  args=[self.thread_loop])
             t.setDaemon(True)
             t.start()
             self.threads.append(t)
 
+    def _call_started(self, queued_at):
+        self.stats_lock.acquire()
+        try:
+            wait_time = clock() - queued_at
+            self.total_wait_time += wait_time
+            self.max_wait_time = max(self.max_wait_time, wait_time)
+            self.busy_threads += 1
+        finally:
+            self.stats_lock.release()
+
+    def _call_finished(self, run_time):
+        self.stats_lock.acquire()
+        try:
+            self.busy_threads -= 1
+            self.calls_finished += 1
+            self.total_busy_time += run_time
+        finally:
+            self.stats_lock.release()
+
     def thread_loop(self):
         while True:
             next_item = self.queue.get()
             if next_item == "QUIT":
                 break
             else:
-                callback, errback, func, name, args, kwargs, = next_item
+                (callback, errback, func, name, args, kwargs,
+                        queued_at) = next_item
+            self._call_started(queued_at)
+            start = clock()
             try:
                 result = func(*args, **kwargs)
             except KeyboardInterrupt:
@@ -194,12 +277,14 @@ class ThreadPool(object):
                 func = callback
                 name = 'Thread Pool Callback (%s)' % name
                 args = (result,)
+            self._call_finished(clock() - start)
             if not self.event_loop.quit_flag:
                 self.event_loop.idle_queue.add_idle(func, name, args=args)
                 self.event_loop.wakeup()
 
     def queue_call(self, callback, errback, function, name, *args, **kwargs):
-        self.queue.put((callback, errback, function, name, args, kwargs))
+        self.queue.put((callback, errback, function, name, args, kwargs,
+                        clock()))
 
     def close_threads(self):
         for x in xrange(len(self.threads)):
@@ -213,6 +298,93 @@ class ThreadPool(object):
             except:
                 pass
 
+def _default_pool_size():
+    return max(ThreadPool.THREADS, get_logical_cpu_count())
+
+def _dns_pool_size():
+    # DNS lookups spend their time waiting on the network, so the cpu
+    # count is only a rough guide here.
+    return max(4, get_logical_cpu_count())
+
+def _parse_pool_size():
+    # parsing is cpu-bound and holds the GIL for most of its work, so
+    # more threads than cpus just adds contention.
+    return max(1, get_logical_cpu_count() // 2)
+
+def _fileio_pool_size():
+    return max(2, get_logical_cpu_count())
+
+# maps pool name -> (pref that sets the size, function to calculate the
+# default size)
+THREAD_POOLS = {
+    'default': (prefs.THREAD_POOL_DEFAULT_SIZE, _default_pool_size),
+    'dns': (prefs.THREAD_POOL_DNS_SIZE, _dns_pool_size),
+    'parse': (prefs.THREAD_POOL_PARSE_SIZE, _parse_pool_size),
+    'fileio': (prefs.THREAD_POOL_FILEIO_SIZE, _fileio_pool_size),
+}
+
+class ThreadPoolSet(object):
+    """Collection of named ``ThreadPool`` objects.
+
+    Each kind of blocking work gets its own pool so that, for example, a
+    couple of slow feed parses can't hold up DNS lookups.  Pool sizes
+    come from the prefs in ``THREAD_POOLS``, or are calculated from the
+    number of cpus if the pref isn't set.
+    """
+    def __init__(self, event_loop):
+        self.event_loop = event_loop
+        self.pools = {}
+        for name in THREAD_POOLS:
+            self.pools[name] = ThreadPool(event_loop, name)
+
+    def get_pool(self, name):
+        try:
+            return self.pools[name]
+        except KeyError:
+            raise ValueError("Unknown thread pool: %s" % name)
+
+    def calc_size(self, name):
+        pref, calc_default = THREAD_POOLS[name]
+        size = None
+        try:
+            size = app.config.get(pref)
+        except AttributeError:
+            # app.config not setup yet
+            pass
+        if not size or size < 1:
+            size = calc_default()
+        return int(size)
+
+    def init_threads(self):
+        for name, pool in self.pools.items():
+            if not pool.threads:
+                pool.size = self.calc_size(name)
+            pool.init_threads()
+
+    def queue_call(self, pool_name, callback, errback, function, name,
+                   *args, **kwargs):
+        self.get_pool(pool_name).queue_call(callback, errback, function,
+                                            name, *args, **kwargs)
+
+    def all_queues_empty(self):
+        for pool in self.pools.values():
+            if not pool.queue.empty():
+                return False
+        return True
+
+    def get_stats(self):
+        """Get statistics for each pool.
+
+        :returns: dict mapping pool names to ``ThreadPool.get_stats()``
+            results.
+        """
+        return dict((name, pool.get_stats())
+                    for name, pool in self.pools.items())
+
+    def close_threads(self):
+        for pool in self.pools.values():
+            pool.close_threads()
+
 class SimpleEventLoop(signals.SignalEmitter):
     def __init__(self):
         signals.SignalEmitter.__init__(self, 'thread-will-start',
@@ -268,7 +440,7 @@ class EventLoop(SimpleEventLoop):
         self.scheduler = Scheduler()
         self.idle_queue = CallQueue()
         self.urgent_queue = CallQueue()
-        self.threadpool = ThreadPool(self)
+        self.threadpools = ThreadPoolSet(self)
         self.read_callbacks = {}
         self.write_callbacks = {}
         self.clear_removed_callbacks()
@@ -293,8 +465,9 @@ class EventLoop(SimpleEventLoop):
 
     def call_in_thread(self, callback, errback, function, name,
                        *args, **kwargs):
-        self.threadpool.queue_call(callback, errback, function, name,
-                                  *args, **kwargs)
+        pool_name = kwargs.pop('pool_name', 'default')
+        self.threadpools.queue_call(pool_name, callback, errback, function,
+                                    name, *args, **kwargs)
 
     def process_events(self, read_fds_ready, write_fds_ready, exc_fds_ready):
         self._process_urgent_events()
@@ -439,6 +612,10 @@ def add_urgent_call(function, name, args=None, kwargs=None):
 def call_in_thread(callback, errback, function, name, *args, **kwargs):
     """Schedule a function to be called in a separate thread.
 
+    Pass the ``pool_name`` keyword argument to pick which thread pool
+    runs the function (one of the keys of ``THREAD_POOLS``).  It's not
+    passed on to ``function``.  By default the "default" pool is used.
+
     .. Warning::
 
        Do not put code that accesses the database or the UI here!
@@ -489,10 +666,17 @@ def disconnect(signal, callback):
     _eventloop.disconnect(signal, callback)
 
 def thread_pool_quit():
-    _eventloop.threadpool.close_threads()
+    _eventloop.threadpools.close_threads()
 
 def thread_pool_init():
-    _eventloop.threadpool.init_threads()
+    _eventloop.threadpools.init_threads()
+
+def thread_pool_stats():
+    """Get usage statistics for the thread pools.
+
+    See ``ThreadPoolSet.get_stats()``.
+    """
+    return _eventloop.threadpools.get_stats()
 
 def as_idle(func):
     """Decorator to make a methods run as an idle function
@@ -39,12 +39,13 @@ from miro.feedparser import FeedParserDict
 from urlparse import urljoin
 from miro.xhtmltools import (unescape, xhtmlify, fix_xml_header,
                              fix_html_header, urlencode)
+import hashlib
 import os
 import re
 import xml
 
 from miro.database import DDBObject, ObjectNotFoundError
-from miro.httpclient import grab_url
+from miro.httpclient import grab_url, BodyBuffer
 from miro import app
 from miro import autodler
 from miro import iconcache
@@ -52,6 +53,8 @@ from miro import databaselog
 from miro import dialogs
 from miro import download_utils
 from miro import eventloop
+from miro import feedparserpool
+from miro import feedparserutil
 from miro import feedupdate
 from miro import flashscraper
 from miro import models
@@ -126,6 +129,38 @@ def add_feed_from_web_page(url):
         logging.warning ("unhandled error in add_feed_from_web_page: %s", error)
     grab_url(url, callback, errback)
 
+def _add_to_index(index, key, item):
+    """Add an item to one of the indexes used by
+    RSSFeedImplBase._create_items_for_parsed().
+    """
+    try:
+        index.setdefault(key, []).append(item)
+    except TypeError:
+        # unhashable value in key, we won't be able to match this item.
+        pass
+
+def _lookup_in_index(index, key):
+    try:
+        return index.get(key, [])
+    except TypeError:
+        # unhashable values, or values that can't be compared to each
+        # other, like offset-naive and offset-aware datetimes.
+        return []
+
+def _move_in_index(index, old_key, new_key, item):
+    try:
+        index[old_key].remove(item)
+    except (KeyError, ValueError, TypeError):
+        pass
+    _add_to_index(index, new_key, item)
+
+# counts of RSSFeedImpl updates where the feed body was the same as the
+# last one we parsed
+_body_digest_stats = {'unchanged': 0, 'changed': 0}
+
+def _calc_body_digest(html):
+    return unicode(hashlib.sha1(html).hexdigest())
+
 FILE_MATCH_RE = re.compile(r"^file://.")
 SEARCH_URL_MATCH_RE = re.compile('^dtv:savedsearch/(.*)\?q=(.*)')
 
@@ -1218,20 +1253,40 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
             self.thumbURL = parsed.feed.image.url
             self.ufeed.icon_cache.request_update(is_vital=True)
 
+        items_by_digest = {}
         items_byid = {}
         items_byURLTitle = {}
-        items_nokey = []
+        # Items without an rss_id are also indexed by the values that
+        # compare_to_item() and compare_to_item_enclosures() check, so we
+        # don't need to compare each entry against each of them.
+        items_by_content = {}
+        items_by_enclosure = {}
         for item in self.items:
-            try:
-                items_byid[item.get_rss_id()] = item
-            except KeyError:
-                items_nokey.append(item)
+            if item.entry_digest is not None:
+                items_by_digest[item.entry_digest] = item
+            rss_id = item.get_rss_id()
+            if rss_id is not None:
+                items_byid[rss_id] = item
+            else:
+                _add_to_index(items_by_content,
+                        FeedParserValues.item_content_key(item), item)
+                _add_to_index(items_by_enclosure,
+                        FeedParserValues.item_enclosure_key(item), item)
             by_url_title_key = (item.url, item.entry_title)
             if by_url_title_key != (None, None):
                 items_byURLTitle[by_url_title_key] = item
+        new_entries = []
+        unchanged_count = 0
         for entry in parsed.entries:
             entry = self.add_scraped_thumbnail(entry)
-            fp_values = FeedParserValues(entry)
+            digest = feedparserutil.entry_digest(entry)
+            if digest in items_by_digest:
+                # the item was created/updated from this exact entry,
+                # there's nothing to compare.
+                unchanged_count += 1
+                self.old_items.discard(items_by_digest[digest])
+                continue
+            fp_values = FeedParserValues(entry, entry_digest=digest)
             new = True
             if fp_values.data['rss_id'] is not None:
                 id_ = fp_values.data['rss_id']
@@ -1239,6 +1294,8 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                     item = items_byid[id_]
                     if not fp_values.compare_to_item(item):
                         item.update_from_feed_parser_values(fp_values)
+                    else:
+                        item.set_entry_digest(digest)
                     new = False
                     self.old_items.discard(item)
             if new:
@@ -1249,24 +1306,35 @@ class RSSFeedImplBase(ThrottledUpdateFeedImpl):
                         item = items_byURLTitle[by_url_title_key]
                         if not fp_values.compare_to_item(item):
                             item.update_from_feed_parser_values(fp_values)
+                        else:
+                            item.set_entry_digest(digest)
                         new = False
                         self.old_items.discard(item)
             if new:
-                for item in items_nokey:
-                    if fp_values.compare_to_item(item):
-                        new = False
-                    else:
-                        try:
-                            if fp_values.compare_to_item_enclosures(item):
-                                item.update_from_feed_parser_values(fp_values)
-                                new = False
-                                self.old_items.discard(item)
-                        except (SystemExit, KeyboardInterrupt):
-                            raise
-                        except:
-                            pass
+                same_content = _lookup_in_index(items_by_content,
+                        fp_values.content_key())
+                if same_content:
+                    new = False
+                for item in same_content:
+                    item.set_entry_digest(digest)
+                    self.old_items.discard(item)
+                for item in _lookup_in_index(items_by_enclosure,
+                        fp_values.enclosure_key()):
+                    if item in same_content:
+                        continue
+                    old_key = FeedParserValues.item_content_key(item)
+                    item.update_from_feed_parser_values(fp_values)
+                    _move_in_index(items_by_content, old_key,
+                            fp_values.content_key(), item)
+                    new = False
+                    self.old_items.discard(item)
             if new and fp_values.first_video_enclosure is not None:
-                self._handle_new_entry(entry, fp_values, channelTitle)
+                new_entries.append((entry, fp_values))
+        for entry, fp_values in new_entries:
+            self._handle_new_entry(entry, fp_values, channelTitle)
+        if unchanged_count:
+            logging.debug("%s: %d of %d entries unchanged", self.url,
+                          unchanged_count, len(parsed.entries))
 
     def _allow_feed_to_override_title(self):
         """Should the RSS feed override the default title?
@@ -1352,6 +1420,8 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.initialHTML = initialHTML
         self.etag = etag
         self.modified = modified
+        self.body_digest = None
+        self.pending_body_digest = None
         self.download = None
 
     @returns_unicode
@@ -1395,9 +1465,10 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.feedparser_finished()
             return
         start = clock()
-        parsed = self.parsed = unicodify(parsed)
+        self.parsed = parsed
         self.remember_old_items()
         self.create_items_for_parsed(parsed)
+        self.body_digest = self.pending_body_digest
 
         try:
             updateFreq = self.parsed["feed"]["ttl"]
@@ -1413,10 +1484,9 @@ class RSSFeedImpl(RSSFeedImplBase):
 
     def call_feedparser(self, html):
         self.ufeed.confirm_db_thread()
-        eventloop.call_in_thread(self.feedparser_callback,
-                               self.feedparser_errback,
-                               feedparser.parse,
-                               "Feedparser callback - %s" % self.url, html)
+        feedparserpool.parse_in_thread(self.feedparser_callback,
+                                       self.feedparser_errback, html,
+                                       "Feedparser callback - %s" % self.url)
 
     def update(self):
         """Updates a feed
@@ -1432,6 +1502,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         if hasattr(self, 'initialHTML') and self.initialHTML is not None:
             html = self.initialHTML
             self.initialHTML = None
+            self.pending_body_digest = _calc_body_digest(html)
             self.call_feedparser(html)
         else:
             try:
@@ -1443,9 +1514,14 @@ class RSSFeedImpl(RSSFeedImplBase):
             except AttributeError:
                 modified = None
             logging.info("updating %s", self.url)
-            self.download = grab_url(self.url, self._update_callback,
+            # Collect the body in a BodyBuffer so that we calculate its
+            # digest as it comes in.
+            body = BodyBuffer()
+            self.download = grab_url(self.url,
+                    lambda info: self._update_callback(info, body),
                     self._update_errback, etag=etag, modified=modified,
-                                    default_mime_type=u'application/rss+xml')
+                    default_mime_type=u'application/rss+xml',
+                    body_callback=body.write)
 
     def _update_errback(self, error):
         if not self.ufeed.id_exists():
@@ -1456,7 +1532,7 @@ class RSSFeedImpl(RSSFeedImplBase):
         self.updating = False
         self.ufeed.signal_change(needs_save=False)
 
-    def _update_callback(self, info):
+    def _update_callback(self, info, body):
         if not self.ufeed.id_exists():
             return
         if info.get('status') == 304:
@@ -1464,9 +1540,6 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.updating = False
             self.ufeed.signal_change()
             return
-        html = info['body']
-        if info.has_key('charset'):
-            html = fix_xml_header(html, info['charset'])
 
         # FIXME HTML can be non-unicode here --NN
         self.url = unicodify(info['updated-url'])
@@ -1478,6 +1551,25 @@ class RSSFeedImpl(RSSFeedImplBase):
             self.modified = unicodify(info['last-modified'])
         else:
             self.modified = None
+        body_digest = unicode(body.hexdigest())
+        # Lots of servers ignore etag/last-modified and send us the same
+        # body every time.  If we've already parsed it, skip the update.
+        # We still need to parse once after startup to set self.parsed.
+        if body_digest == self.body_digest and hasattr(self, 'parsed'):
+            _body_digest_stats['unchanged'] += 1
+            logging.info("feed body unchanged for %s, not parsing "
+                         "(%d unchanged, %d changed)", self.url,
+                         _body_digest_stats['unchanged'],
+                         _body_digest_stats['changed'])
+            self.schedule_update_events(-1)
+            self.updating = False
+            self.ufeed.signal_change()
+            return
+        _body_digest_stats['changed'] += 1
+        self.pending_body_digest = body_digest
+        html = body.getvalue()
+        if info.has_key('charset'):
+            html = fix_xml_header(html, info['charset'])
         self.call_feedparser (html)
 
     @returns_unicode
@@ -1500,10 +1592,12 @@ class RSSFeedImpl(RSSFeedImplBase):
         """
         FeedImpl.setup_restored(self)
         self.download = None
+        self.pending_body_digest = None
 
     def clean_old_items(self):
         self.modified = None
         self.etag = None
+        self.body_digest = None
         self.update()
 
 class RSSMultiFeedBase(RSSFeedImplBase):
@@ -1559,7 +1653,6 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         if not self.ufeed.id_exists() or url not in self.download_dc:
             return
         start = clock()
-        parsed = unicodify(parsed)
         self.create_items_for_parsed(parsed)
         self.feedparser_finished(url)
         end = clock()
@@ -1572,7 +1665,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         in_thread = False
         if in_thread:
             try:
-                parsed = feedparser.parse(html)
+                parsed = feedparserpool.parse_in_process(html)
                 self.feedparser_callback(parsed, url)
             except (SystemExit, KeyboardInterrupt):
                 raise
@@ -1580,10 +1673,10 @@ class RSSMultiFeedBase(RSSFeedImplBase):
                 self.feedparser_errback(self, None, url)
                 raise
         else:
-            eventloop.call_in_thread(
+            feedparserpool.parse_in_thread(
                 lambda parsed, url=url: self.feedparser_callback(parsed, url),
                 lambda e, url=url: self.feedparser_errback(e, url),
-                feedparser.parse, "Feedparser callback - %s" % url, html)
+                html, "Feedparser callback - %s" % url)
 
     def update(self):
         self.ufeed.confirm_db_thread()
@@ -1595,12 +1688,15 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         for url in self.urls:
             etag = self.etag.get(url)
             modified = self.modified.get(url)
+            body = BodyBuffer()
             self.download_dc[url] = grab_url(
                 url,
-                lambda x, url=url: self._update_callback(x, url),
+                lambda x, url=url, body=body: self._update_callback(x, url,
+                                                                    body),
                 lambda x, url=url: self._update_errback(x, url),
                 etag=etag, modified=modified,
-                default_mime_type=u'application/rss+xml',)
+                default_mime_type=u'application/rss+xml',
+                body_callback=body.write)
             self.updating += 1
 
     def _update_errback(self, error, url):
@@ -1613,7 +1709,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
         self.check_update_finished()
         self.ufeed.signal_change(needs_save=False)
 
-    def _update_callback(self, info, url):
+    def _update_callback(self, info, url, body):
         if not self.ufeed.id_exists():
             return
         if info.get('status') == 304:
@@ -1622,7 +1718,7 @@ class RSSMultiFeedBase(RSSFeedImplBase):
             self.check_update_finished()
             self.ufeed.signal_change()
             return
-        html = info['body']
+        html = body.getvalue()
         if info.has_key('charset'):
             html = fix_xml_header(html, info['charset'])
 
@@ -1738,7 +1834,8 @@ class ScraperFeedImpl(ThrottledUpdateFeedImpl):
             logging.info("WARNING unhandled error for ScraperFeedImpl.get_html: %s", error)
             self.check_done()
         download = grab_url(url, callback, errback, etag=etag,
-                modified=modified, default_mime_type='text/html')
+                modified=modified, default_mime_type='text/html',
+                use_cache=True)
         self.downloads.add(download)
 
     def process_downloaded_html(self, info, urlList, depth, linkNumber,
@@ -0,0 +1,309 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005-2010 Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.feedparserpool`` -- Runs feedparser in worker processes.
+
+feedparser is pure python, so parsing a large feed holds the GIL for a
+long time and slows down both the event loop and the UI.  This module
+parses feeds in a small ``multiprocessing`` pool instead.  The workers
+unicodify the result, convert it with
+``feedparserutil.normalize_feedparser_dict()`` and send it back as a
+pickled string.  We turn it back into ``FeedParserDict`` objects on our
+side, so callers see the same thing that ``feedparser.parse()`` returns.
+
+If we can't use worker processes (no multiprocessing module, frozen
+executables, the pool is disabled in prefs, or the pool breaks), the
+feed is parsed in the calling thread instead.
+"""
+
+import cPickle
+import logging
+import sys
+import threading
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+from miro import app
+from miro import eventloop
+from miro.clock import clock
+from miro import feedparser
+from miro import prefs
+from miro.feedparserutil import normalize_feedparser_dict
+from miro.util import unicodify
+from miro.plat.utils import get_logical_cpu_count
+
+# how long parses running when we shut down get to finish
+SHUTDOWN_WAIT = 2
+# how often parse() checks if we're shutting down
+POLL_INTERVAL = 0.5
+
+class ParseTimeout(Exception):
+    """A worker process took too long to parse a feed."""
+    pass
+
+def parse_in_process(html):
+    """Parse a feed in the current process.
+
+    :returns: unicodified ``FeedParserDict``
+    """
+    return unicodify(feedparser.parse(html))
+
+def _parse_and_serialize(html):
+    """Parse a feed and pickle the normalized result.
+
+    This runs in the worker processes.
+    """
+    parsed = parse_in_process(html)
+    # exceptions don't survive normalize_feedparser_dict() and we don't
+    # use this anywhere.
+    if 'bozo_exception' in parsed:
+        del parsed['bozo_exception']
+    return cPickle.dumps(normalize_feedparser_dict(parsed),
+                         cPickle.HIGHEST_PROTOCOL)
+
+def _to_feedparser_dict(obj):
+    """Inverse of ``normalize_feedparser_dict()``."""
+    if isinstance(obj, dict):
+        return feedparser.FeedParserDict(
+            dict((k, _to_feedparser_dict(v)) for (k, v) in obj.items()))
+    elif isinstance(obj, list):
+        return [_to_feedparser_dict(o) for o in obj]
+    elif isinstance(obj, tuple):
+        return tuple(_to_feedparser_dict(o) for o in obj)
+    return obj
+
+def unserialize(data):
+    """Turn the string returned by a worker process back into a
+    ``FeedParserDict``.
+    """
+    return _to_feedparser_dict(cPickle.loads(data))
+
+class FeedParserPool(object):
+    """Pool of worker processes that run feedparser.
+
+    The pool is created the first time it's needed.  ``parse()`` blocks
+    until the feed has been parsed, so it should be called from a thread
+    pool thread, not the event loop.
+
+    When a parse times out, the pool gets retired: new parses go to a
+    fresh pool, and the old one is terminated once the other parses
+    running in it are done.  That way one stuck feed doesn't kill the
+    parses that share its pool.  ``shutdown()`` retires the pools the same
+    way, but only gives the running parses ``SHUTDOWN_WAIT`` more seconds.
+    """
+    def __init__(self):
+        self.pool = None
+        self.disabled = False
+        self.lock = threading.Lock()
+        # maps pool -> number of parses using it
+        self.users = {}
+        # pools that we stopped using because a parse timed out
+        self.retired = set()
+        # retired pools that shutdown() wants gone soon
+        self.closing = set()
+
+    def calc_process_count(self):
+        count = app.config.get(prefs.FEEDPARSER_PROCESSES)
+        return min(count, get_logical_cpu_count())
+
+    def _can_use_processes(self):
+        if self.disabled or multiprocessing is None:
+            return False
+        # multiprocessing needs to re-run the main script to start
+        # processes on windows, which doesn't work with py2exe.
+        if getattr(sys, 'frozen', False):
+            return False
+        return self.calc_process_count() > 0
+
+    def _acquire_pool(self):
+        """Get the pool to parse a feed with.
+
+        Call _release_pool() when the parse is done.
+        """
+        if not self._can_use_processes():
+            # the pool might have been disabled after it was started
+            self._retire_pool(self.pool)
+            return None
+        self.lock.acquire()
+        try:
+            if self.pool is None:
+                try:
+                    self.pool = multiprocessing.Pool(
+                        self.calc_process_count())
+                except (OSError, ImportError), e:
+                    logging.warn("Can't start feedparser processes (%s), "
+                                 "parsing feeds in process", e)
+                    self.disabled = True
+                    return None
+                self.users[self.pool] = 0
+            self.users[self.pool] += 1
+            return self.pool
+        finally:
+            self.lock.release()
+
+    def _release_pool(self, pool):
+        self.lock.acquire()
+        try:
+            if pool not in self.users:
+                # shouldn't happen, but don't let it break the parse
+                logging.warn("releasing unknown feedparser pool")
+                return
+            self.users[pool] -= 1
+            finished = pool in self.retired and self.users[pool] == 0
+            if finished:
+                self.retired.remove(pool)
+                self.closing.discard(pool)
+                del self.users[pool]
+        finally:
+            self.lock.release()
+        if finished:
+            self._terminate(pool)
+
+    def _retire_pool(self, pool):
+        """Stop giving out pool and terminate it once nobody is using it.
+        """
+        if pool is None:
+            return
+        self.lock.acquire()
+        try:
+            if self.pool is not pool:
+                # already retired
+                return
+            self.pool = None
+            unused = self.users[pool] == 0
+            if unused:
+                del self.users[pool]
+            else:
+                self.retired.add(pool)
+        finally:
+            self.lock.release()
+        if unused:
+            self._terminate(pool)
+
+    def _terminate(self, pool):
+        pool.terminate()
+        pool.join()
+
+    def parse(self, html):
+        """Parse a feed.
+
+        :returns: unicodified ``FeedParserDict``
+        :raises ParseTimeout: if the worker took longer than the
+            ``FEEDPARSER_TIMEOUT`` pref
+        """
+        pool = self._acquire_pool()
+        if pool is None:
+            return parse_in_process(html)
+        timeout = app.config.get(prefs.FEEDPARSER_TIMEOUT)
+        try:
+            try:
+                data = self._wait(pool,
+                    pool.apply_async(_parse_and_serialize, (html,)), timeout)
+            except multiprocessing.TimeoutError:
+                # the worker is stuck, use a fresh pool from now on.  The
+                # old one gets terminated when the other parses are done.
+                self._retire_pool(pool)
+                raise ParseTimeout("feedparser took more than %s secs" %
+                                   timeout)
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except Exception, e:
+                logging.warn("Error in feedparser process (%s), "
+                             "parsing in process", e)
+                return parse_in_process(html)
+        finally:
+            self._release_pool(pool)
+        return unserialize(data)
+
+    def _wait(self, pool, result, timeout):
+        """Wait for the result of a parse running in pool.
+
+        :raises multiprocessing.TimeoutError: if the parse takes longer than
+            timeout, or more than SHUTDOWN_WAIT after we start shutting down
+        """
+        end = clock() + timeout
+        closing = False
+        while not result.ready():
+            now = clock()
+            if not closing and pool in self.closing:
+                closing = True
+                end = min(end, now + SHUTDOWN_WAIT)
+            if now >= end:
+                raise multiprocessing.TimeoutError()
+            result.wait(min(end - now, POLL_INTERVAL))
+        return result.get()
+
+    def shutdown(self):
+        """Retire all pools.
+
+        Unused pools are terminated right away, the others once the parses
+        running in them are done.
+        """
+        self.lock.acquire()
+        try:
+            self.pool = None
+            unused = []
+            for pool, count in self.users.items():
+                if count == 0:
+                    del self.users[pool]
+                    self.retired.discard(pool)
+                    unused.append(pool)
+                else:
+                    self.retired.add(pool)
+                    self.closing.add(pool)
+        finally:
+            self.lock.release()
+        for pool in unused:
+            self._terminate(pool)
+
+_feedparser_pool = FeedParserPool()
+
+def parse(html):
+    """Parse a feed using the feedparser processes.  This blocks until
+    the feed is parsed.
+
+    :returns: unicodified ``FeedParserDict``
+    """
+    return _feedparser_pool.parse(html)
+
+def parse_in_thread(callback, errback, html, name):
+    """Parse a feed without blocking the event loop.
+
+    callback will be called in the event loop with the unicodified
+    ``FeedParserDict``.  errback will be called with the exception if
+    something goes wrong.
+    """
+    eventloop.call_in_thread(callback, errback, parse, name, html,
+                             pool_name='parse')
+
+def shutdown():
+    """Stop the feedparser processes."""
+    _feedparser_pool.shutdown()
@@ -32,6 +32,7 @@
 from datetime import datetime
 from time import struct_time
 from types import NoneType
+import hashlib
 
 from miro import feedparser
 
@@ -70,3 +71,21 @@ def _convert_if_feedparser_dict(obj):
     if isinstance(obj, feedparser.FeedParserDict):
         return normalize_feedparser_dict(obj)
     return obj
+
+def entry_digest(entry):
+    """Calculate a digest for a feedparser entry.
+
+    Entries with the same contents get the same digest, no matter what
+    order their keys were added in.
+
+    :returns: unicode hex digest
+    """
+    return unicode(hashlib.sha1(_canonical_repr(entry)).hexdigest())
+
+def _canonical_repr(obj):
+    if isinstance(obj, dict):
+        return '{%s}' % ','.join('%r:%s' % (key, _canonical_repr(obj[key]))
+                                 for key in sorted(obj.keys()))
+    elif isinstance(obj, (list, tuple)):
+        return '[%s]' % ','.join(_canonical_repr(o) for o in obj)
+    return repr(obj)
@@ -25,28 +25,76 @@
 # but you are not obligated to do so. If you do not wish to do so, delete
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
-
 """feedupdate.py -- Handles updating feeds.
 
 Our basic strategy is to limit the number of feeds that are
-simultaniously updating at any given time.  Right now the limit is set
-to 3.
+simultaniously updating at any given time.  There are 2 limits:
+
+* a per-host limit, so that we don't hammer a single server when lots
+  of feeds come from it
+* a global limit, which adapts to how long updates are taking.  When
+  updates finish quickly we allow more of them to run at once, when
+  they start taking a long time we back off.
+
+Feeds that the user is looking at jump to the front of the queue.  To
+avoid having every feed update at the same moment, the delays passed
+to schedule_update() get some random jitter.
 """
 
+import random
+import urlparse
+
 from miro import eventloop
-from miro import datastructures
+from miro.clock import clock
+
+# limits for the number of simultaneous updates
+MIN_UPDATES = 3
+MAX_UPDATES = 12
+MAX_UPDATES_PER_HOST = 2
+# If the average update takes less than this many seconds, we allow
+# another update to run.  If it takes more, we cut the limit in half.
+TARGET_LATENCY = 10.0
+# weight given to the latest update when calculating the average latency
+LATENCY_WEIGHT = 0.2
+# fraction of the delay to randomly add/subtract in schedule_update()
+JITTER = 0.1
 
-MAX_UPDATES = 3
+def _feed_host(feed):
+    """Get the host that a feed updates from.
+
+    Feeds that don't use http (searches, directory feeds, etc.) return
+    None.  They only count towards the global limit.
+    """
+    try:
+        url = feed.get_url()
+    except (SystemExit, KeyboardInterrupt):
+        raise
+    except:
+        return None
+    if not url:
+        return None
+    host = urlparse.urlparse(url)[1]
+    if not host:
+        return None
+    return host.lower()
 
 class FeedUpdateQueue(object):
     def __init__(self):
-        self.update_queue = datastructures.Fifo()
+        self.update_queue = []
         self.timeouts = {}
         self.callback_handles = {}
         self.currently_updating = set()
+        self.priority_feed_ids = set()
+        # maps feed id -> (host, time the update started)
+        self.update_info = {}
+        self.host_counts = {}
+        self.max_updates = MIN_UPDATES
+        self.average_latency = None
 
     def schedule_update(self, delay, feed, update_callback):
         name = "Feed update (%s)" % feed.get_title()
+        if delay > 0:
+            delay += delay * random.uniform(-JITTER, JITTER)
         self.timeouts[feed.id] = eventloop.add_timeout(delay, self.do_update, 
                 name, args=(feed, update_callback))
 
@@ -58,27 +106,87 @@ class FeedUpdateQueue(object):
         else:
             timeout.cancel()
 
+    def set_priority(self, feed_id, priority):
+        """Set if a feed should be updated before the others in the
+        queue.
+        """
+        if priority:
+            self.priority_feed_ids.add(feed_id)
+        else:
+            self.priority_feed_ids.discard(feed_id)
+
     def do_update(self, feed, update_callback):
         del self.timeouts[feed.id]
-        self.update_queue.enqueue((feed, update_callback))
+        self.update_queue.append((feed, update_callback))
         self.run_update_queue()
 
     def update_finished(self, feed):
         for callback_handle in self.callback_handles.pop(feed.id):
             feed.disconnect(callback_handle)
         self.currently_updating.remove(feed)
+        host, start_time = self.update_info.pop(feed.id)
+        if host is not None:
+            self.host_counts[host] -= 1
+            if self.host_counts[host] == 0:
+                del self.host_counts[host]
+        self._adjust_max_updates(clock() - start_time)
         self.run_update_queue()
 
+    def _adjust_max_updates(self, latency):
+        if self.average_latency is None:
+            self.average_latency = latency
+        else:
+            self.average_latency = (LATENCY_WEIGHT * latency +
+                    (1.0 - LATENCY_WEIGHT) * self.average_latency)
+        if self.average_latency < TARGET_LATENCY:
+            self.max_updates = min(MAX_UPDATES, self.max_updates + 1)
+        else:
+            self.max_updates = max(MIN_UPDATES, self.max_updates // 2)
+
+    def _host_available(self, host):
+        return (host is None or
+                self.host_counts.get(host, 0) < MAX_UPDATES_PER_HOST)
+
+    def _next_update_index(self):
+        """Find the next feed in update_queue that we can start.
+
+        Priority feeds go first, then feeds in the order they were
+        queued.  Feeds whose host is already at its limit are skipped.
+
+        :returns: index into update_queue, or None
+        """
+        first_available = None
+        for i, (feed, update_callback) in enumerate(self.update_queue):
+            if feed in self.currently_updating:
+                # this feed will get removed when we dequeue it
+                return i
+            if not self._host_available(_feed_host(feed)):
+                continue
+            if feed.id in self.priority_feed_ids:
+                return i
+            if first_available is None:
+                first_available = i
+                if not self.priority_feed_ids:
+                    break
+        return first_available
+
     def run_update_queue(self):
         while (len(self.update_queue) > 0 and 
-               len(self.currently_updating) < MAX_UPDATES):
-            feed, update_callback = self.update_queue.dequeue()
+               len(self.currently_updating) < self.max_updates):
+            index = self._next_update_index()
+            if index is None:
+                break
+            feed, update_callback = self.update_queue.pop(index)
             if feed in self.currently_updating:
                 continue
+            host = _feed_host(feed)
             handle = feed.connect('update-finished', self.update_finished)
             handle2 = feed.connect('removed', self.update_finished)
             self.callback_handles[feed.id] = (handle, handle2)
             self.currently_updating.add(feed)
+            self.update_info[feed.id] = (host, clock())
+            if host is not None:
+                self.host_counts[host] = self.host_counts.get(host, 0) + 1
             update_callback()
 
 global_update_queue = FeedUpdateQueue()
@@ -92,3 +200,9 @@ def schedule_update(delay, feed, update_callback):
     the future.
     """
     global_update_queue.schedule_update(delay, feed, update_callback)
+
+def set_priority(feed_id, priority):
+    """Set if a feed should be updated before other feeds, for example
+    because the user is looking at it.
+    """
+    global_update_queue.set_priority(feed_id, priority)
@@ -244,6 +244,16 @@ def miro_listdir(directory):
             pass
     return files, directories
 
+def is_ignored_filename(name):
+    """Returns True if name is a file or directory that we never look
+    inside when searching for videos.
+    """
+    name_lower = name.lower()
+    # thumbs.db is a windows file that speeds up thumbnails.  We know it's
+    # not a movie file.
+    return (name.startswith('.') or name_lower == 'thumbs.db' or
+            name_lower == "incomplete downloads")
+
 def miro_allfiles(directory):
     """Directory listing that's safe and convenient for finding new
     videos in a directory.
@@ -263,11 +273,7 @@ def miro_allfiles(directory):
     except OSError:
         return []
     for name in listing:
-        name_lower = name.lower()
-        if (name.startswith('.') or name_lower == 'thumbs.db' or
-                name_lower == "incomplete downloads"):
-            # thumbs.db is a windows file that speeds up thumbnails.
-            # We know it's not a movie file.
+        if is_ignored_filename(name):
             continue
         path = os.path.join(directory, os.path.normcase(name))
         expanded_path = os.path.join(expanded_directory, os.path.normcase(name))
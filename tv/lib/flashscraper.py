@@ -102,7 +102,7 @@ def _scrape_youtube_url(url, callback):
         httpclient.grab_url(
             url,
             lambda x: _youtube_callback_step2(x, video_id, callback),
-            lambda x: _youtube_errback(x, callback))
+            lambda x: _youtube_errback(x, callback), use_cache=True)
 
     except (SystemExit, KeyboardInterrupt):
         raise
@@ -194,7 +194,8 @@ def _scrape_vmix_video_url(url, callback):
         url = (u"http://sdstage01.vmix.com/videos.php?type=%s&id=%s&l=%s" %
                (type_, id_, l))
         httpclient.grab_url(url, lambda x: _scrape_vmix_callback(x, callback),
-                           lambda x: _scrape_vmix_errback(x, callback))
+                           lambda x: _scrape_vmix_errback(x, callback),
+                           use_cache=True)
 
     except (SystemExit, KeyboardInterrupt):
         raise
@@ -239,7 +240,8 @@ def _scrape_veohtv_video_url(url, callback):
         permalink_id = params['permalinkId'][0]
         url = u'http://www.veoh.com/movieList.html?type=%s&permalinkId=%s&numResults=45' % (t, permalink_id)
         httpclient.grab_url(url, lambda x: _scrape_veohtv_callback(x, callback),
-                           lambda x: _scrape_veohtv_errback(x, callback))
+                           lambda x: _scrape_veohtv_errback(x, callback),
+                           use_cache=True)
     except (SystemExit, KeyboardInterrupt):
         raise
     except:
@@ -268,7 +270,8 @@ def _scrape_veohtv_errback(err, callback):
 
 def _scrape_break_video_url(url, callback):
     httpclient.grab_headers(url, lambda x: _scrape_break_callback(x, callback),
-                           lambda x: _scrape_break_errback(x, callback))
+                           lambda x: _scrape_break_errback(x, callback),
+                           use_cache=True)
 
 def _scrape_break_callback(info, callback):
     url = info['redirected-url']
@@ -300,7 +303,7 @@ def _scrape_vimeo_video_url(url, callback):
         httpclient.grab_url(
             url,
             lambda x: _scrape_vimeo_callback(x, callback),
-            lambda x: _scrape_vimeo_errback(x, callback))
+            lambda x: _scrape_vimeo_errback(x, callback), use_cache=True)
     except (SystemExit, KeyboardInterrupt):
         raise
     except:
@@ -316,7 +319,7 @@ def _scrape_vimeo_moogaloop_url(url, callback):
         httpclient.grab_url(
             url,
             lambda x: _scrape_vimeo_callback(x, callback),
-            lambda x: _scrape_vimeo_errback(x, callback))
+            lambda x: _scrape_vimeo_errback(x, callback), use_cache=True)
     except (SystemExit, KeyboardInterrupt):
         raise
     except:
@@ -396,6 +396,36 @@ class DownloadsPanel(PanelBuilder):
         
         vbox.pack_start(grid.make_table())
 
+        max_kbs = sys.maxint / (2**10) # highest value accepted: sys.maxint
+                                       # bits per second in kb/s
+
+        grid = dialogwidgets.ControlGrid()
+        grid.pack(dialogwidgets.heading(_("HTTP:")), grid.ALIGN_LEFT, span=3)
+        grid.end_line(spacing=12)
+
+        cbx = widgetset.Checkbox(_('Limit downstream bandwidth to:'))
+        limit = widgetset.TextEntry()
+        limit.set_width(5)
+        per_download_limit = widgetset.TextEntry()
+        per_download_limit.set_width(5)
+        attach_boolean(cbx, prefs.LIMIT_DOWNSTREAM_HTTP, (limit,))
+        attach_integer(limit, prefs.DOWNSTREAM_HTTP_LIMIT_IN_KBS, create_integer_checker(min=0, max=max_kbs))
+        attach_integer(per_download_limit,
+                prefs.DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS,
+                create_integer_checker(min=0, max=max_kbs))
+
+        grid.pack(cbx)
+        grid.pack(limit)
+        grid.pack_label(_("KB/s"))
+        grid.end_line(spacing=6)
+
+        grid.pack_label(_("Limit for each download (0 for no limit):"),
+                dialogwidgets.ControlGrid.ALIGN_RIGHT)
+        grid.pack(per_download_limit)
+        grid.pack_label(_("KB/s"))
+        grid.end_line(spacing=12)
+        vbox.pack_start(widgetutil.align_left(grid.make_table()))
+
         grid = dialogwidgets.ControlGrid()
         grid.pack(dialogwidgets.heading(_("Bittorrent:")), grid.ALIGN_LEFT, span=3)
         grid.end_line(spacing=12)
@@ -405,8 +435,6 @@ class DownloadsPanel(PanelBuilder):
         limit = widgetset.TextEntry()
         limit.set_width(5)
         attach_boolean(cbx, prefs.LIMIT_UPSTREAM, (limit,))
-        max_kbs = sys.maxint / (2**10) # highest value accepted: sys.maxint
-                                       # bits per second in kb/s
         attach_integer(limit, prefs.UPSTREAM_LIMIT_IN_KBS, create_integer_checker(min=0, max=max_kbs))
 
         grid.pack(cbx)
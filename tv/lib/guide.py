@@ -32,6 +32,8 @@
 """
 
 import logging
+import os
+import tempfile
 from HTMLParser import HTMLParser, HTMLParseError
 from urlparse import urlparse, urljoin
 
@@ -44,6 +46,9 @@ from miro import httpclient
 from miro import iconcache
 from miro import fileutil
 
+# size of the chunks we feed to GuideHTMLParser
+PARSE_CHUNK_SIZE = 64 * 1024
+
 class ChannelGuide(DDBObject, iconcache.IconCacheOwnerMixin):
     ICON_CACHE_VITAL = True
 
@@ -138,7 +143,13 @@ class ChannelGuide(DDBObject, iconcache.IconCacheOwnerMixin):
         self.userTitle = title
         self.signal_change(needs_save=True)
 
-    def guide_downloaded(self, info):
+    def guide_downloaded(self, info, path):
+        try:
+            self._guide_downloaded(info, path)
+        finally:
+            self._remove_download_file(path)
+
+    def _guide_downloaded(self, info, path):
         if not self.id_exists():
             return
         self.client = None
@@ -146,9 +157,17 @@ class ChannelGuide(DDBObject, iconcache.IconCacheOwnerMixin):
         parser = None
         try:
             parser = GuideHTMLParser(self.updated_url)
-            parser.feed(info["body"])
+            f = open(path, 'rb')
+            try:
+                while True:
+                    data = f.read(PARSE_CHUNK_SIZE)
+                    if not data:
+                        break
+                    parser.feed(data)
+            finally:
+                f.close()
             parser.close()
-        except (HTMLParseError, UnicodeDecodeError), parser_error:
+        except (HTMLParseError, UnicodeDecodeError, IOError), parser_error:
             logging.debug("Ignoring error when parsing guide %s: %s", self.updated_url, parser_error)
 
         if parser:
@@ -171,7 +190,8 @@ class ChannelGuide(DDBObject, iconcache.IconCacheOwnerMixin):
         self.extend_history(self.updated_url)
         self.signal_change()
 
-    def guide_error(self, error):
+    def guide_error(self, error, path):
+        self._remove_download_file(path)
         if not self.id_exists():
             return
         # FIXME - this should display some kind of error page to the user
@@ -179,7 +199,20 @@ class ChannelGuide(DDBObject, iconcache.IconCacheOwnerMixin):
         self.client = None
 
     def download_guide(self):
-        self.client = httpclient.grab_url(self.get_url(), self.guide_downloaded, self.guide_error)
+        # Download the page to a temp file and parse it from there, rather
+        # than keeping the whole page in memory.
+        fd, path = tempfile.mkstemp(prefix='miro-guide-', suffix='.html')
+        os.close(fd)
+        self.client = httpclient.grab_url(self.get_url(),
+                lambda info: self.guide_downloaded(info, path),
+                lambda error: self.guide_error(error, path),
+                write_file=path, use_cache=True, compressed=True)
+
+    def _remove_download_file(self, path):
+        try:
+            fileutil.remove(path)
+        except OSError:
+            pass
 
     def get_favicon_path(self):
         """Returns the path to the favicon file.  It's either the favicon of
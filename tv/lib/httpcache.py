@@ -0,0 +1,464 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005-2010 Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.httpcache`` -- Disk cache for httpclient.grab_url().
+
+Callers opt in by passing ``use_cache=True`` to ``grab_url()``.  Responses
+are stored in the cache directory, keyed by URL.  We follow the
+``Cache-Control``, ``Expires``, ``ETag`` and ``Last-Modified`` headers:
+fresh entries are returned without touching the network, and stale ones
+are revalidated with a conditional request.
+
+The cache is limited to ``prefs.HTTP_CACHE_SIZE`` megabytes.  When it
+grows past that, the least recently used entries are removed.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import re
+import rfc822
+import shutil
+import time
+
+from miro import app
+from miro import fileutil
+from miro import prefs
+
+# Entries with a Last-Modified header, but no explicit expiration time, stay
+# fresh for this fraction of their age (see RFC 2616, section 13.2.4)...
+HEURISTIC_FRESHNESS_FRACTION = 0.1
+# ... up to this many seconds
+MAX_HEURISTIC_FRESHNESS = 24 * 60 * 60
+# Don't store responses bigger than this fraction of the whole cache
+MAX_ENTRY_FRACTION = 0.125
+
+CACHE_CONTROL_RE = re.compile(r'\s*([\w-]+)\s*(?:=\s*"?([^",]*)"?)?\s*(?:,|$)')
+
+def parse_cache_control(value):
+    """Parse a Cache-Control header.
+
+    :returns: dict mapping directive names (lowercased) to their values
+        (or None for directives without values)
+    """
+    directives = {}
+    if value:
+        for name, arg in CACHE_CONTROL_RE.findall(value):
+            directives[name.lower()] = arg or None
+    return directives
+
+def parse_http_date(value):
+    """Convert a HTTP date into a timestamp.
+
+    :returns: seconds since the epoch, or None if value can't be parsed
+    """
+    if not value:
+        return None
+    parsed = rfc822.parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return rfc822.mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def calc_expiration(info, now):
+    """Figure out when a response stops being fresh.
+
+    :param info: info dict from grab_url()
+    :param now: time that we got the response
+    :returns: timestamp that the response expires at, or None if the
+        response shouldn't be stored.
+    """
+    cache_control = parse_cache_control(info.get('cache-control'))
+    if 'no-store' in cache_control:
+        return None
+    if 'no-cache' in cache_control:
+        expires = now
+    elif 'max-age' in cache_control:
+        try:
+            expires = now + int(cache_control['max-age'])
+        except ValueError:
+            expires = now
+    elif 'expires' in info:
+        # Expires is relative to the server's clock, so use the Date header
+        # to adjust for clock skew.
+        expires = parse_http_date(info['expires'])
+        server_now = parse_http_date(info.get('date'))
+        if expires is None:
+            expires = now
+        elif server_now is not None:
+            expires = now + (expires - server_now)
+    elif 'last-modified' in info:
+        last_modified = parse_http_date(info['last-modified'])
+        server_now = parse_http_date(info.get('date'))
+        if server_now is None:
+            server_now = now
+        if last_modified is None or last_modified > server_now:
+            expires = now
+        else:
+            freshness = ((server_now - last_modified) *
+                    HEURISTIC_FRESHNESS_FRACTION)
+            expires = now + min(freshness, MAX_HEURISTIC_FRESHNESS)
+    else:
+        expires = now
+
+    if (expires <= now and 'etag' not in info and
+            'last-modified' not in info):
+        # We would have to refetch this entry every time and we don't have a
+        # way to revalidate it.  Don't bother storing it.
+        return None
+    return expires
+
+class CacheEntry(object):
+    """A response stored in the cache.
+
+    Attributes:
+        url -- URL that we requested
+        info -- info dict from grab_url(), without the body
+        expires -- timestamp that the entry stops being fresh at
+        size -- size of the body
+        last_access -- last time the entry was used
+    """
+    def __init__(self, url, info, expires, size):
+        self.url = url
+        self.info = info
+        self.expires = expires
+        self.size = size
+        self.last_access = time.time()
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+    def get_etag(self):
+        return self.info.get('etag')
+
+    def get_last_modified(self):
+        return self.info.get('last-modified')
+
+    def make_info(self):
+        """Make a info dict to send to grab_url()'s callback."""
+        info = self.info.copy()
+        info['status'] = 200
+        return info
+
+    def to_dict(self):
+        return {
+            'url': self.url,
+            'info': self.info,
+            'expires': self.expires,
+            'size': self.size,
+            'last_access': self.last_access,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        entry = cls(data['url'], data['info'], data['expires'],
+                data['size'])
+        entry.last_access = data['last_access']
+        return entry
+
+class HTTPCache(object):
+    """Stores HTTP responses on disk.
+
+    For each entry we keep 2 files in the cache directory, named after the
+    SHA1 hash of the URL: ``<hash>.meta`` has the pickled CacheEntry data and
+    ``<hash>.body`` has the response body.
+
+    All methods should be called from the eventloop thread.
+    """
+    def __init__(self, directory, max_size):
+        """Create a HTTPCache.
+
+        :param directory: directory to store the cache in
+        :param max_size: max size of the cache in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.entries = {}
+        self.total_size = 0
+        self.reset_stats()
+        self._load()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+
+    def get_stats(self):
+        """Get statistics for the cache.
+
+        :returns: dict with these keys:
+
+        * **entries** -- number of entries in the cache
+        * **size** -- total size of the stored bodies
+        * **hits** -- requests answered by a fresh entry
+        * **revalidations** -- requests for stale entries that the server
+          told us were still good (304 responses)
+        * **misses** -- requests that we had to download
+        * **stores** -- responses stored in the cache
+        * **evictions** -- entries removed to keep the cache size down
+        """
+        return {
+            'entries': len(self.entries),
+            'size': self.total_size,
+            'hits': self.hits,
+            'revalidations': self.revalidations,
+            'misses': self.misses,
+            'stores': self.stores,
+            'evictions': self.evictions,
+        }
+
+    def record_hit(self):
+        self.hits += 1
+
+    def record_miss(self):
+        self.misses += 1
+
+    def _key(self, url):
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        return hashlib.sha1(url).hexdigest()
+
+    def _meta_path(self, key):
+        return os.path.join(self.directory, key + '.meta')
+
+    def body_path(self, url):
+        return os.path.join(self.directory, self._key(url) + '.body')
+
+    def _load(self):
+        try:
+            filenames = fileutil.listdir(self.directory)
+        except OSError:
+            return
+        for filename in filenames:
+            if not filename.endswith('.meta'):
+                continue
+            key = filename[:-len('.meta')]
+            try:
+                f = fileutil.open_file(self._meta_path(key), 'rb')
+                try:
+                    entry = CacheEntry.from_dict(cPickle.load(f))
+                finally:
+                    f.close()
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                logging.warn("error loading HTTP cache entry %s", key,
+                        exc_info=True)
+                self._remove_files(key)
+                continue
+            if (self._key(entry.url) != key or
+                    not fileutil.exists(self.body_path(entry.url))):
+                self._remove_files(key)
+                continue
+            self.entries[entry.url] = entry
+            self.total_size += entry.size
+        self._shrink()
+
+    def _remove_files(self, key):
+        for path in (self._meta_path(key),
+                os.path.join(self.directory, key + '.body')):
+            try:
+                fileutil.remove(path)
+            except OSError:
+                pass
+
+    def _write_meta(self, entry):
+        key = self._key(entry.url)
+        f = fileutil.open_file(self._meta_path(key), 'wb')
+        try:
+            cPickle.dump(entry.to_dict(), f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+
+    def get(self, url):
+        """Get the entry for a URL.
+
+        :returns: CacheEntry or None
+        """
+        return self.entries.get(url)
+
+    def read_body(self, entry):
+        """Read the body for a cache entry.
+
+        :returns: body string, or None if we couldn't read it
+        """
+        try:
+            f = fileutil.open_file(self.body_path(entry.url), 'rb')
+            try:
+                return f.read()
+            finally:
+                f.close()
+        except IOError:
+            self.remove(entry.url)
+            return None
+
+    def copy_body(self, entry, path):
+        """Copy the body for a cache entry to a file.
+
+        :returns: True if the copy succeeded
+        """
+        try:
+            shutil.copyfile(fileutil.expand_filename(self.body_path(entry.url)),
+                    fileutil.expand_filename(path))
+        except (IOError, OSError):
+            self.remove(entry.url)
+            return False
+        return True
+
+    def touch(self, entry):
+        entry.last_access = time.time()
+
+    def store(self, url, info, body=None, body_file=None):
+        """Store a response.
+
+        Either body or body_file must be given.
+
+        :param url: URL that we requested
+        :param info: info dict from grab_url()
+        :param body: response body
+        :param body_file: path to a file with the response body
+        """
+        if info.get('status') != 200:
+            return
+        expires = calc_expiration(info, time.time())
+        if expires is None:
+            self.remove(url)
+            return
+        if body is not None:
+            size = len(body)
+        else:
+            try:
+                size = os.path.getsize(fileutil.expand_filename(body_file))
+            except OSError:
+                return
+        if size > self.max_size * MAX_ENTRY_FRACTION:
+            self.remove(url)
+            return
+
+        self.remove(url)
+        info = info.copy()
+        info.pop('body', None)
+        entry = CacheEntry(url, info, expires, size)
+        try:
+            try:
+                fileutil.makedirs(self.directory)
+            except OSError:
+                pass
+            body_path = self.body_path(url)
+            if body is not None:
+                f = fileutil.open_file(body_path, 'wb')
+                try:
+                    f.write(body)
+                finally:
+                    f.close()
+            else:
+                shutil.copyfile(fileutil.expand_filename(body_file),
+                        fileutil.expand_filename(body_path))
+            self._write_meta(entry)
+        except (IOError, OSError), e:
+            logging.warn("error storing HTTP cache entry for %s: %s", url, e)
+            self._remove_files(self._key(url))
+            return
+        self.entries[url] = entry
+        self.total_size += size
+        self.stores += 1
+        self._shrink()
+
+    def revalidated(self, entry, info):
+        """Update an entry after the server sent us a 304 response.
+
+        :param info: info dict for the 304 response
+        """
+        self.revalidations += 1
+        # 304 responses include the headers that would have changed,
+        # merge them in.
+        for key in ('cache-control', 'expires', 'date', 'etag',
+                'last-modified'):
+            if key in info:
+                entry.info[key] = info[key]
+        expires = calc_expiration(entry.info, time.time())
+        if expires is None:
+            self.remove(entry.url)
+            return
+        entry.expires = expires
+        self.touch(entry)
+        try:
+            self._write_meta(entry)
+        except (IOError, OSError):
+            self.remove(entry.url)
+
+    def remove(self, url):
+        entry = self.entries.pop(url, None)
+        if entry is not None:
+            self.total_size -= entry.size
+            self._remove_files(self._key(url))
+
+    def _shrink(self):
+        if self.total_size <= self.max_size:
+            return
+        entries = sorted(self.entries.values(),
+                key=lambda entry: entry.last_access)
+        for entry in entries:
+            if self.total_size <= self.max_size:
+                break
+            self.remove(entry.url)
+            self.evictions += 1
+
+cache = None
+
+def _default_cache_directory():
+    return os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+            'http-cache')
+
+def init(directory=None, max_size=None):
+    """Create the HTTP cache.
+
+    Until this is called, grab_url() ignores the use_cache argument.
+    """
+    global cache
+    if directory is None:
+        directory = _default_cache_directory()
+    if max_size is None:
+        max_size = app.config.get(prefs.HTTP_CACHE_SIZE) * 1024 * 1024
+    cache = HTTPCache(directory, max_size)
+
+def get_stats():
+    """Get statistics for the HTTP cache.
+
+    See HTTPCache.get_stats() for the details.
+
+    :returns: dict of stats, or None if the cache isn't initialized
+    """
+    if cache is None:
+        return None
+    return cache.get_stats()
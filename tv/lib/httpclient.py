@@ -34,8 +34,11 @@ The main ways this module used is grab_url() and grab_headers().  grab_url
 fetches a HTTP or HTTPS url, while grab_headers only fetches the headers.
 """
 
+import errno
+import hashlib
 import logging
 import os
+import re
 import stat
 import threading
 import urllib
@@ -49,10 +52,12 @@ from miro import download_utils
 from miro import eventloop
 from miro import fileutil
 from miro import httpauth
+from miro import httpcache
 from miro import net
 from miro import prefs
 from miro import signals
 from miro import util
+from miro.clock import clock
 from miro.gtcache import gettext as _
 from miro.xhtmltools import url_encode_dict, multipart_encode
 from miro.plat import utils
@@ -61,6 +66,29 @@ from miro.net import NetworkError, ConnectionError, ConnectionTimeout
 
 REDIRECTION_LIMIT = 10
 MAX_AUTH_ATTEMPTS = 5
+# max number of unused curl handles that LibCURLManager keeps around
+MAX_IDLE_HANDLES = 10
+# max number of open connections that libcurl keeps in its cache
+MAX_CACHED_CONNECTIONS = 20
+# content encodings that we ask for when compressed=True.  libcurl decodes
+# the data for us.
+ACCEPT_ENCODING = 'gzip, deflate'
+DECODED_ENCODINGS = ('gzip', 'x-gzip', 'deflate')
+# size of the chunks we read file:// URLs in when streaming them
+FILE_URL_CHUNK_SIZE = 64 * 1024
+# max seconds that data for write_file can sit in memory before we write it
+# out.  The amount of data is controlled by the HTTP_WRITE_BUFFER_SIZE pref.
+WRITE_BUFFER_FLUSH_INTERVAL = 2.0
+# how often BandwidthScheduler recalculates the bandwidth for each transfer
+BANDWIDTH_UPDATE_INTERVAL = 1.0
+# bulk transfers always get at least this many bytes/sec, even if
+# interactive transfers are using the whole limit
+MIN_BULK_RATE = 1024
+# transfers that are going slower than their share get this much more than
+# their current rate, so they can speed up if they are able to
+BANDWIDTH_HEADROOM = 1.25
+# first byte position in a Content-Range header
+CONTENT_RANGE_RE = re.compile(r'bytes\s+(\d+)-\d+/(\d+|\*)$')
 
 _logged_noproxy_error = False
 
@@ -177,9 +205,17 @@ class WriteError(NetworkError):
 
     def __init__(self, path):
         msg = _("Could not write to %(filename)s") % \
-            {"filename": util.stringify(self.filename)}
+            {"filename": util.stringify(path)}
         NetworkError.__init__(self, _('Write error'), msg)
 
+class DiskFull(WriteError):
+    """Ran out of disk space while writing a file with grab_url()."""
+
+    def __init__(self, path):
+        msg = _("Not enough disk space to write %(filename)s") % \
+            {"filename": util.stringify(path)}
+        NetworkError.__init__(self, _('Not enough disk space'), msg)
+
 class TransferOptions(object):
     """Holds data about an upcoming transfer.
 
@@ -192,7 +228,8 @@ class TransferOptions(object):
     """
 
     def __init__(self, url, etag=None, modified=None, resume=False,
-            post_vars=None, post_files=None, write_file=None):
+            post_vars=None, post_files=None, write_file=None,
+            compressed=False, byte_range=None, bulk=False):
         self.url = url
         self.etag = etag
         self.modified = modified
@@ -200,6 +237,9 @@ class TransferOptions(object):
         self.post_vars = post_vars
         self.post_files = post_files
         self.write_file = write_file
+        self.compressed = compressed
+        self.byte_range = byte_range
+        self.bulk = bulk
         self.head_request = False
         self.invalid_url = False
         # _cancel_on_body_data is an internal attribute used for grab_headers.
@@ -225,22 +265,23 @@ class TransferOptions(object):
             self.invalid_url = True
             return
 
-    def build_handle(self, out_headers):
-        """Build a libCURL handle.  This should only be called inside the
+    def build_handle(self, out_headers, handle):
+        """Setup a libCURL handle.  This should only be called inside the
         LibCURLManager thread.
+
+        :param handle: fresh handle from LibCURLManager.get_handle()
         """
         if self.etag is not None:
-            out_headers['etag'] = self.etag
+            out_headers['If-None-Match'] = self.etag
         if self.modified is not None:
             out_headers['If-Modified-Since'] = self.modified
 
-        handle = self._init_handle()
+        self._init_handle(handle)
         self._setup_post(handle, out_headers)
         self._setup_headers(handle, out_headers)
         return handle
 
-    def _init_handle(self):
-        handle = pycurl.Curl()
+    def _init_handle(self, handle):
         handle.setopt(pycurl.USERAGENT, user_agent())
         handle.setopt(pycurl.FOLLOWLOCATION, 1)
         handle.setopt(pycurl.MAXREDIRS, REDIRECTION_LIMIT)
@@ -254,6 +295,10 @@ class TransferOptions(object):
         handle.setopt(pycurl.URL, self.url)
         if self.head_request:
             handle.setopt(pycurl.NOBODY, 1)
+        if self.compressed:
+            handle.setopt(pycurl.ENCODING, ACCEPT_ENCODING)
+        if self.byte_range is not None:
+            handle.setopt(pycurl.RANGE, '%d-%d' % self.byte_range)
         self._setup_proxy(handle)
         return handle
 
@@ -301,6 +346,52 @@ class TransferOptions(object):
             self.post_data = data
             self.post_length = len(data)
 
+class FileWriteBuffer(object):
+    """Coalesces the small chunks that libcurl gives us into larger writes.
+
+    Data gets written out once we have buffer_size bytes, or once
+    flush_interval seconds have passed since the last write.  fileobj should
+    be unbuffered, so each flush is a single write() call.
+    """
+    def __init__(self, fileobj, buffer_size,
+            flush_interval=WRITE_BUFFER_FLUSH_INTERVAL):
+        self.fileobj = fileobj
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.chunks = []
+        self.buffered = 0
+        self.write_count = 0
+        self.last_flush = clock()
+
+    def fileno(self):
+        return self.fileobj.fileno()
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.buffered += len(data)
+        if (self.buffered >= self.buffer_size or
+                clock() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush_if_stale(self):
+        if self.chunks and clock() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if self.chunks:
+            data = ''.join(self.chunks)
+            self.chunks = []
+            self.buffered = 0
+            self.fileobj.write(data)
+            self.write_count += 1
+        self.last_flush = clock()
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            self.fileobj.close()
+
 class CurlTransfer(object):
     """A in-progress CURL download.
 
@@ -310,19 +401,21 @@ class CurlTransfer(object):
     """
 
     def __init__(self, options, callback, errback, header_callback=None,
-            content_check_callback=None):
+            content_check_callback=None, body_callback=None):
         """Create a CurlTransfer object.
 
         :param options: TransferOptions object.  The object shouldn't be
             modified after passing it in.
         :param callback: function to call when the transfer succeeds
         :param errback: function to call when the transfer fails
+        :param body_callback: function to call with each chunk of body data
         """
         self.options = options
         self._reset_transfer_data()
         self.callback = callback
         self.header_callback = header_callback
         self.content_check_callback = content_check_callback
+        self.body_callback = body_callback
         self.errback = errback
         self.auth_attempts = {'http': 0, 'proxy': 0}
         self.canceled = False
@@ -342,6 +435,12 @@ class CurlTransfer(object):
         self.resume_from = 0
         self.out_headers = {}
         self.status_code = None
+        self.decoded_size = 0
+        self.write_error = None
+        # set once we've checked the response to a byte_range request
+        self.range_checked = False
+        # current MAX_RECV_SPEED_LARGE for our handle (0 means unlimited)
+        self.rate_limit = 0
 
     def start(self):
         if self.options.invalid_url:
@@ -429,24 +528,45 @@ class CurlTransfer(object):
             self._reset_transfer_data()
             curl_manager.add_transfer(self)
 
-    def build_handle(self):
-        """Build a libCURL handle.  This should only be called inside the
-        LibCURLManager thread.
+    def build_handle(self, handle):
+        """Setup a libCURL handle for this transfer.  This should only be
+        called inside the LibCURLManager thread.
         """
-        self.handle = self.options.build_handle(self.out_headers)
+        self.handle = self.options.build_handle(self.out_headers, handle)
         self._setup_http_auth()
         self._setup_proxy_auth()
         if self.options._cancel_on_body_data:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self._write_func_abort)
+            write_func = self._write_func_abort
         elif self.options.write_file is not None:
             self._open_file()
-            self.handle.setopt(pycurl.WRITEDATA, self._filehandle)
+            write_func = self._write_to_file
         elif self.content_check_callback is not None:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self._call_content_check)
+            write_func = self._call_content_check
+        elif self.body_callback is not None:
+            write_func = self._call_body_callback
         else:
-            self.handle.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
+            write_func = self.buffer.write
+        if self.options.compressed:
+            # libcurl gives us the decoded data, keep track of its size
+            self._decoded_write_func = write_func
+            write_func = self._write_decoded
+        self.handle.setopt(pycurl.WRITEFUNCTION, write_func)
         self.handle.setopt(pycurl.HEADERFUNCTION, self.header_func)
 
+    def _write_decoded(self, data):
+        self.decoded_size += len(data)
+        return self._decoded_write_func(data)
+
+    def content_is_decoded(self):
+        """Check if libcurl is decoding the response body for us.
+
+        If so, the content-length header is the size of the encoded data,
+        not the size of the data that we get.
+        """
+        return (self.options.compressed and
+                self.headers.get('content-encoding', '').strip().lower()
+                in DECODED_ENCODINGS)
+
     def _lookup_auth(self):
         """Lookup existing HTTP passwords to use.
 
@@ -491,6 +611,37 @@ class CurlTransfer(object):
         if rv == False or isinstance(rv, Exception):
             curl_manager.remove_transfer(self)
 
+    def _call_body_callback(self, data):
+        if self.status_code in (401, 407):
+            # This is the error page for an auth request.  We'll retry the
+            # transfer once we have a password, so don't let the error page
+            # end up in front of the real body.
+            return
+        if self.options.byte_range is not None and not self.range_checked:
+            if not self._check_byte_range():
+                # The server is sending something other than the range we
+                # asked for, so the body callback would put the data in the
+                # wrong place.  Stop the transfer before it sees any of it,
+                # on_error() sends write_error to the errback.
+                self.write_error = UnexpectedStatusCode(self.status_code)
+                return 0
+            self.range_checked = True
+        rv = trap_call('body callback', self.body_callback, data)
+        if isinstance(rv, Exception):
+            curl_manager.remove_transfer(self)
+
+    def _check_byte_range(self):
+        """Check that the response is the range we asked for.
+
+        This means a 206 status with a Content-Range that starts at the
+        first byte of options.byte_range.
+        """
+        if self.status_code != 206:
+            return False
+        match = CONTENT_RANGE_RE.match(self.headers.get('content-range', ''))
+        return (match is not None and
+                int(match.group(1)) == self.options.byte_range[0])
+
     def _open_file(self):
         if self.options.resume:
             mode = 'ab'
@@ -505,9 +656,61 @@ class CurlTransfer(object):
         else:
             mode = 'wb'
         try:
-            self._filehandle = fileutil.open_file(self.options.write_file, mode)
+            # FileWriteBuffer does our buffering, so open the file unbuffered
+            f = fileutil.open_file(self.options.write_file, mode, 0)
         except IOError:
-            raise WriteError(self.filename)
+            raise WriteError(self.options.write_file)
+        buffer_size = app.config.get(prefs.HTTP_WRITE_BUFFER_SIZE) * 1024
+        self._filehandle = FileWriteBuffer(f, buffer_size)
+
+    def _write_to_file(self, data):
+        if self.write_error is not None:
+            # _abort_write() was called, stop the transfer
+            return 0
+        try:
+            self._filehandle.write(data)
+        except IOError, e:
+            self.write_error = self._make_write_error(e)
+            # Returning a different length than we were given makes libcurl
+            # stop the transfer with E_WRITE_ERROR.  on_error() then sends
+            # write_error to the errback.
+            return 0
+
+    def _make_write_error(self, exception):
+        if getattr(exception, 'errno', None) == errno.ENOSPC:
+            return DiskFull(self.options.write_file)
+        else:
+            return WriteError(self.options.write_file)
+
+    def _abort_write(self, exception):
+        # Don't call the errback here, libcurl might still call
+        # _write_to_file() in this perform cycle.  The next write stops the
+        # transfer and on_error() sends write_error to the errback.  If the
+        # transfer is already done, on_finished() does.
+        self.write_error = self._make_write_error(exception)
+
+    def _preallocate_file(self):
+        """Reserve disk space for the data we're about to write.
+
+        This keeps files from getting fragmented when we're running many
+        downloads at once and lets us notice that the disk is full before we
+        download anything.
+        """
+        if (self._filehandle is None or self.content_is_decoded() or
+                'content-length' not in self.headers or
+                not self.check_response_code(self.status_code)):
+            return
+        length = int(self.handle.getinfo(pycurl.CONTENT_LENGTH_DOWNLOAD))
+        if length <= 0:
+            return
+        try:
+            utils.preallocate_file(self._filehandle, self.resume_from, length)
+        except IOError, e:
+            if e.errno == errno.ENOSPC:
+                self._abort_write(e)
+            else:
+                logging.warn("Error preallocating %s: %s",
+                        self.options.write_file, e)
 
     def header_func(self, line):
         line = line.strip()
@@ -557,12 +760,16 @@ class CurlTransfer(object):
             self.headers[header] += (',%s' % value)
 
     def on_headers_finished(self):
+        self._preallocate_file()
         if self.header_callback:
             eventloop.add_idle(self.header_callback,
                     'httpclient header callback',
                     args=(self._make_callback_info(),))
 
     def check_response_code(self, code):
+        if self.options.byte_range is not None:
+            # a 200 response means the server ignored the Range header
+            return code == 206
         expected_codes = set([200])
         if self.options.resume:
             expected_codes.add(206)
@@ -573,7 +780,11 @@ class CurlTransfer(object):
     def _make_callback_info(self):
         info = self.headers.copy()
         info['status'] = self.handle.getinfo(pycurl.RESPONSE_CODE)
-        if 'content-length' in info:
+        if self.content_is_decoded():
+            # We don't know the decoded size until the transfer is done.
+            # on_finished() fills it in.
+            info.pop('content-length', None)
+        elif 'content-length' in info:
             # Use libcurl's content length rather than the raw header string
             info['content-length'] = self.stats.download_total
             info['total-size'] = self.stats.download_total + self.resume_from
@@ -592,9 +803,23 @@ class CurlTransfer(object):
         curl_manager.call_after_perform(self.on_finished)
 
     def on_finished(self):
+        if self.write_error is not None:
+            self.call_errback(self.write_error)
+            return
+        if self._filehandle is not None:
+            try:
+                self._filehandle.flush()
+            except IOError, e:
+                self.call_errback(self._make_write_error(e))
+                return
         info = self._make_callback_info()
-        if self.options.write_file is None:
+        if self.content_is_decoded():
+            info['content-length'] = self.decoded_size
+            info['total-size'] = self.decoded_size
+        if self.options.write_file is None and self.body_callback is None:
             info['body'] = self.buffer.getvalue()
+        # don't keep a 2nd copy of the body around while the callback runs
+        self.buffer = StringIO()
         if self.check_response_code(info['status']):
             self.call_callback(info)
         elif info['status'] == 401:
@@ -668,6 +893,8 @@ class CurlTransfer(object):
             error = UnknownHostError(self.options.host)
         elif code == pycurl.E_OPERATION_TIMEOUTED:
             error = ConnectionTimeout(self.options.host)
+        elif code == pycurl.E_WRITE_ERROR and self.write_error is not None:
+            error = self.write_error
         elif (code == pycurl.E_RECV_ERROR and
                 self.handle.getinfo(pycurl.HTTP_CONNECTCODE) == 407):
             # Hack for proxy authentication errors with HTTPS
@@ -690,7 +917,13 @@ class CurlTransfer(object):
 
     def _cleanup_filehandle(self):
         if self._filehandle is not None:
-            self._filehandle.close()
+            try:
+                self._filehandle.close()
+            except IOError, e:
+                # We only get here for canceled/failed transfers, since
+                # on_finished() flushes the data first.
+                logging.warn("Error closing %s: %s", self.options.write_file,
+                        e)
             self._filehandle = None
 
     def build_stats(self):
@@ -711,6 +944,11 @@ class CurlTransfer(object):
         return stats
 
     def update_stats(self):
+        if self._filehandle is not None:
+            try:
+                self._filehandle.flush_if_stale()
+            except IOError, e:
+                self._abort_write(e)
         new_stats = self.build_stats()
         self.lock.acquire()
         try:
@@ -753,15 +991,130 @@ class LibCURLManager(eventloop.SimpleEventLoop):
       - Runs a thread for pycurl to use
       - Manages the libcurl multi object
       - Handles adding/removing CurlTransfers objects
+      - Keeps a pool of curl handles to reuse between transfers
+
+    The multi object keeps a cache of open connections, so transfers to the
+    same host can reuse a keep-alive connection.  All our handles use a
+    CurlShare object, so they also share the DNS cache, cookies and SSL
+    sessions.
     """
 
     def __init__(self):
         eventloop.SimpleEventLoop.__init__(self)
         self.multi = pycurl.CurlMulti()
+        if hasattr(pycurl, 'M_MAXCONNECTS'):
+            self.multi.setopt(pycurl.M_MAXCONNECTS, MAX_CACHED_CONNECTIONS)
+        self.share = self._make_share()
+        self.idle_handles = []
         self.transfer_map = {}
         self.transfers_to_add = Queue.Queue()
         self.transfers_to_remove = Queue.Queue()
         self.after_perform_callbacks = []
+        self.stats_lock = threading.Lock()
+        self.bandwidth = BandwidthScheduler()
+        self.reset_connection_stats()
+
+    def _make_share(self):
+        share = pycurl.CurlShare()
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_COOKIE)
+        # older versions of pycurl don't support sharing SSL sessions
+        if hasattr(pycurl, 'LOCK_DATA_SSL_SESSION'):
+            share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+        return share
+
+    def reset_connection_stats(self):
+        self.stats_lock.acquire()
+        try:
+            self.handles_created = 0
+            self.handles_reused = 0
+            self.transfers_finished = 0
+            self.connections_created = 0
+            self.connections_reused = 0
+        finally:
+            self.stats_lock.release()
+
+    def get_connection_stats(self):
+        """Get statistics about handle and connection reuse.
+
+        :returns: dict with these keys:
+
+        * **handles_created** -- number of curl handles we created
+        * **handles_reused** -- number of transfers that used a pooled handle
+        * **transfers_finished** -- number of transfers that finished
+        * **connections_created** -- number of new connections that finished
+          transfers made
+        * **connections_reused** -- number of finished transfers that reused
+          a cached connection
+        """
+        self.stats_lock.acquire()
+        try:
+            return {
+                'handles_created': self.handles_created,
+                'handles_reused': self.handles_reused,
+                'transfers_finished': self.transfers_finished,
+                'connections_created': self.connections_created,
+                'connections_reused': self.connections_reused,
+            }
+        finally:
+            self.stats_lock.release()
+
+    def get_handle(self):
+        """Get a curl handle to use for a transfer.
+
+        The handle comes from our pool if possible.  Either way, it's set to
+        use our CurlShare object.
+        """
+        self.stats_lock.acquire()
+        try:
+            if self.idle_handles:
+                handle = self.idle_handles.pop()
+                self.handles_reused += 1
+            else:
+                handle = pycurl.Curl()
+                self.handles_created += 1
+        finally:
+            self.stats_lock.release()
+        handle.setopt(pycurl.SHARE, self.share)
+        # an empty filename turns on the cookie engine without reading
+        # cookies from anywhere.
+        handle.setopt(pycurl.COOKIEFILE, '')
+        return handle
+
+    def release_handle(self, handle):
+        """Put a curl handle that's not being used anymore back in the
+        pool.
+        """
+        if len(self.idle_handles) < MAX_IDLE_HANDLES:
+            # reset() clears all of the options for the handle, including
+            # the callbacks that reference our CurlTransfer.  It keeps the
+            # handle's caches.
+            handle.reset()
+            self.idle_handles.append(handle)
+        else:
+            handle.close()
+
+    def _count_connections(self, handle):
+        new_connections = handle.getinfo(pycurl.NUM_CONNECTS)
+        self.stats_lock.acquire()
+        try:
+            self.transfers_finished += 1
+            self.connections_created += new_connections
+            if new_connections == 0:
+                self.connections_reused += 1
+        finally:
+            self.stats_lock.release()
+
+    def set_bandwidth_limits(self, global_limit, transfer_limit):
+        self.bandwidth.set_limits(global_limit, transfer_limit)
+        self.wakeup()
+
+    def set_external_interactive_rate(self, rate):
+        self.bandwidth.set_external_rate(rate)
+        self.wakeup()
+
+    def get_interactive_rate(self):
+        return self.bandwidth.interactive_rate
 
     def start(self):
         self.thread = threading.Thread(target=utils.thread_body,
@@ -779,7 +1132,13 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         for transfer in self.transfer_map.values():
             self.multi.remove_handle(transfer.handle)
             transfer.handle.close()
+        for handle in self.idle_handles:
+            handle.close()
+        self.idle_handles = []
         self.multi.close()
+        # older versions of pycurl don't have CurlShare.close()
+        if hasattr(self.share, 'close'):
+            self.share.close()
 
     def add_transfer(self, transfer):
         self.transfers_to_add.put(transfer)
@@ -800,9 +1159,13 @@ class LibCURLManager(eventloop.SimpleEventLoop):
         if timeout < 0:
             # libcurl documentation says this means to wait "not too long"
             # Let's try 2 seconds
-            return 2.0
+            timeout = 2.0
         else:
-            return timeout / 1000.0
+            timeout = timeout / 1000.0
+        if self.bandwidth.is_active() and self.transfer_map:
+            # wake up in time to reschedule the bandwidth
+            timeout = min(timeout, BANDWIDTH_UPDATE_INTERVAL)
+        return timeout
 
     def process_events(self, readfds, writefds, excfds):
         self.process_queues()
@@ -816,6 +1179,7 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 break
         self.process_queues()
         self.check_finished()
+        self.bandwidth.update(self.transfer_map.values())
 
     def update_stats(self):
         for transfer in self.transfer_map.values():
@@ -827,13 +1191,16 @@ class LibCURLManager(eventloop.SimpleEventLoop):
                 transfer = self.transfers_to_add.get_nowait()
             except Queue.Empty:
                 break
+            handle = self.get_handle()
             try:
-                transfer.build_handle()
+                transfer.build_handle(handle)
             except NetworkError, e:
+                self.release_handle(handle)
                 transfer.call_errback(e)
                 continue
             self.transfer_map[transfer.handle] = transfer
             self.multi.add_handle(transfer.handle)
+            self.bandwidth.needs_update = True
 
         while True:
             try:
@@ -841,24 +1208,188 @@ class LibCURLManager(eventloop.SimpleEventLoop):
             except Queue.Empty:
                 break
             transfer.on_cancel(remove_file)
-            try:
-                del self.transfer_map[transfer.handle]
-            except KeyError:
+            # check that the handle hasn't been reused for another transfer
+            # since this one finished.
+            if self.transfer_map.get(transfer.handle) is not transfer:
                 continue
-            self.multi.remove_handle(transfer.handle)
+            self.pop_transfer(transfer.handle)
+            self.release_handle(transfer.handle)
+            self.bandwidth.needs_update = True
 
     def check_finished(self):
         queued, finished, errors = self.multi.info_read()
         for handle in finished:
+            self._count_connections(handle)
             self.pop_transfer(handle).on_finished()
+            self.release_handle(handle)
         for handle, code, message in errors:
             self.pop_transfer(handle).on_error(code, handle)
+            self.release_handle(handle)
+        if finished or errors:
+            # give the bandwidth to the transfers that are left
+            self.bandwidth.needs_update = True
 
     def pop_transfer(self, handle):
         transfer = self.transfer_map.pop(handle)
         self.multi.remove_handle(handle)
         return transfer
 
+def calc_fair_shares(total, demands):
+    """Split up bandwidth using max-min fairness.
+
+    Transfers that want less than an even split get what they want, the rest
+    is split evenly between the other transfers.
+
+    :param total: bandwidth to split up
+    :param demands: list of the bandwidth that each transfer can use, or None
+        if we don't know
+    :returns: list of shares, in the same order as demands
+    """
+    shares = [0] * len(demands)
+    def sort_key(index):
+        if demands[index] is None:
+            return (1, 0)
+        return (0, demands[index])
+    order = sorted(range(len(demands)), key=sort_key)
+    remaining = total
+    for count, index in enumerate(order):
+        fair_share = float(remaining) / (len(demands) - count)
+        demand = demands[index]
+        if demand is not None and demand < fair_share:
+            shares[index] = demand
+        else:
+            shares[index] = fair_share
+        remaining -= shares[index]
+    return shares
+
+class BandwidthScheduler(object):
+    """Divides up the download bandwidth between transfers.
+
+    This runs in the libcurl thread.  Every BANDWIDTH_UPDATE_INTERVAL
+    seconds (and whenever transfers start or stop) we measure how fast each
+    transfer is going and give each bulk transfer a rate limit with
+    MAX_RECV_SPEED_LARGE.  libcurl does the actual throttling.
+
+    Interactive transfers (feed updates, icons, etc.) are never throttled.
+    The bandwidth they use comes out of the global limit first and the bulk
+    transfers split what's left.  Most interactive transfers run in the app
+    process, while the bulk ones run in the downloader, so the app sends its
+    interactive rate over (see set_external_rate()) and we count it here
+    too.
+    """
+    def __init__(self):
+        self.global_limit = 0
+        self.transfer_limit = 0
+        # interactive bytes/sec from transfers in the other process
+        self.external_rate = 0
+        # interactive bytes/sec from our transfers at the last update
+        self.interactive_rate = 0
+        self.needs_update = False
+        self.last_update = clock()
+        # maps transfers to the number of bytes downloaded at the last
+        # update
+        self.last_sizes = {}
+        # maps transfers to their download rate, see measure_rates()
+        self.rates = {}
+
+    def set_limits(self, global_limit, transfer_limit):
+        """Change the bandwidth limits.
+
+        :param global_limit: max bytes/sec for all transfers, 0 for no limit
+        :param transfer_limit: max bytes/sec for each bulk transfer, 0 for no
+            limit
+        """
+        self.global_limit = global_limit
+        self.transfer_limit = transfer_limit
+        self.needs_update = True
+
+    def set_external_rate(self, rate):
+        """Set how fast interactive transfers in the other process are
+        downloading.
+        """
+        self.external_rate = rate
+        self.needs_update = True
+
+    def is_active(self):
+        return self.global_limit > 0 or self.transfer_limit > 0
+
+    def update(self, transfers):
+        """Recalculate the rate limits if it's time to."""
+        now = clock()
+        if now - self.last_update >= BANDWIDTH_UPDATE_INTERVAL:
+            self.measure_rates(transfers, now)
+        elif not self.needs_update:
+            return
+        # If we get here because needs_update is set, we keep the rates
+        # from the last measurement, since measuring over a short time is
+        # too noisy to be useful.
+        self.needs_update = False
+        bulk = [t for t in transfers if t.options.bulk]
+        interactive_rate = 0
+        for transfer in transfers:
+            rate = self.rates.get(transfer)
+            if not transfer.options.bulk and rate is not None:
+                interactive_rate += rate
+        self.interactive_rate = interactive_rate
+        limits = self.calc_limits(bulk,
+                interactive_rate + self.external_rate)
+        for transfer, limit in zip(bulk, limits):
+            self.set_transfer_limit(transfer, limit)
+
+    def measure_rates(self, transfers, now):
+        """Calculate how fast each transfer went since the last
+        measurement.
+
+        This sets self.rates, which maps transfers to bytes/sec, or None for
+        transfers that just started.
+        """
+        elapsed = now - self.last_update
+        self.rates = {}
+        sizes = {}
+        for transfer in transfers:
+            size = transfer.handle.getinfo(pycurl.SIZE_DOWNLOAD)
+            sizes[transfer] = size
+            last_size = self.last_sizes.get(transfer)
+            if last_size is None:
+                self.rates[transfer] = None
+            else:
+                self.rates[transfer] = (size - last_size) / elapsed
+        self.last_sizes = sizes
+        self.last_update = now
+
+    def calc_limits(self, bulk, interactive_rate):
+        """Calculate the rate limit for each bulk transfer.
+
+        :returns: list of limits in bytes/sec (0 for no limit)
+        """
+        if not self.is_active() or not bulk:
+            return [0] * len(bulk)
+        demands = []
+        for transfer in bulk:
+            rate = self.rates.get(transfer)
+            if rate is None or (transfer.rate_limit > 0 and
+                    rate * BANDWIDTH_HEADROOM >= transfer.rate_limit):
+                # either a new transfer or one that's using all of its
+                # bandwidth.  Either way, it could use more.
+                demands.append(None)
+            else:
+                demands.append(rate * BANDWIDTH_HEADROOM)
+        if self.global_limit > 0:
+            total = max(self.global_limit - interactive_rate,
+                    MIN_BULK_RATE * len(bulk))
+            limits = calc_fair_shares(total, demands)
+            limits = [max(int(limit), MIN_BULK_RATE) for limit in limits]
+        else:
+            limits = [self.transfer_limit] * len(bulk)
+        if self.transfer_limit > 0:
+            limits = [min(limit, self.transfer_limit) for limit in limits]
+        return limits
+
+    def set_transfer_limit(self, transfer, limit):
+        if limit != transfer.rate_limit:
+            transfer.handle.setopt(pycurl.MAX_RECV_SPEED_LARGE, limit)
+            transfer.rate_limit = limit
+
 class HTTPClient(object):
     """HTTP client for a grab_url call.
 
@@ -880,6 +1411,39 @@ class HTTPClient(object):
 
         return self.transfer.get_stats()
 
+class BodyBuffer(object):
+    """Collects a response body for grab_url()'s body_callback.
+
+    The chunks are kept in a list and joined once when the transfer is done,
+    and the SHA1 digest is calculated as the data comes in, so the caller can
+    check if the body changed without making another pass over it.
+
+    Usage::
+
+        buf = BodyBuffer()
+        grab_url(url, callback, errback, body_callback=buf.write)
+        ...
+        # in the callback
+        body = buf.getvalue()
+    """
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+        self._sha1 = hashlib.sha1()
+
+    def write(self, data):
+        self.chunks.append(data)
+        self.size += len(data)
+        self._sha1.update(data)
+
+    def hexdigest(self):
+        return self._sha1.hexdigest()
+
+    def getvalue(self):
+        """Get the body and release the chunks."""
+        if len(self.chunks) != 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0]
 
 def sanitize_url(url):
     """Fix poorly constructed URLs.
@@ -891,7 +1455,8 @@ def sanitize_url(url):
 def grab_url(url, callback, errback, header_callback=None,
         content_check_callback=None, write_file=None, etag=None, modified=None,
         default_mime_type=None, resume=False, post_vars=None,
-        post_files=None):
+        post_files=None, body_callback=None, use_cache=False,
+        compressed=None, byte_range=None, bulk=False):
     """Quick way to download a network resource
 
     grab_url is a simple interface to the HTTPClient class.
@@ -912,11 +1477,32 @@ def grab_url(url, callback, errback, header_callback=None,
     :param post_vars: dictionary of variables to send as POST data
     :param post_files: files to send as POST data (see
         xhtmltools.multipart_encode for the format)
+    :param body_callback: function to call with each chunk of the body as we
+        recieve it.  Use this (or write_file) to avoid keeping large responses
+        in memory.  Like content_check_callback, this runs in the libcurl
+        thread.  If it raises an exception, the transfer is canceled.
+    :param use_cache: use the disk cache from the httpcache module.  Fresh
+        responses are returned from the cache and stale ones are
+        revalidated.  This can't be combined with content_check_callback,
+        resume, post_vars, post_files, body_callback or byte_range.
+    :param compressed: ask the server for a gzip/deflate encoded response.
+        The data is decoded before we pass it on, and 'content-length' is
+        the decoded size.  If this is None, we only ask for compression
+        when the body is returned in memory (write_file is not given).
+        Don't use this for media downloads.
+    :param byte_range: (first, last) tuple of byte positions to request,
+        like the HTTP Range header the range is inclusive.  The server must
+        reply with a 206 response, other responses are errors.
+    :param bulk: this is a bulk transfer (like a media download) that the
+        user isn't waiting on.  Bulk transfers are subject to the bandwidth
+        limits from set_bandwidth_limits(), other transfers get priority
+        over them.
 
     The callback will be passed a dictionary that contains all the HTTP
     headers, as well as the following keys:
         'status': HTTP response code
-        'body': The request body (if write_file is not given)
+        'body': The request body (if write_file and body_callback are not
+            given)
         'content-length': Length of the downloads as an int
         'total-size': Total size of the download (this is different from
             content-length because it includes the data we are resuming from)
@@ -930,18 +1516,140 @@ def grab_url(url, callback, errback, header_callback=None,
 
     :returns HTTPClient object
     """
+    if use_cache and (content_check_callback is not None or resume or
+            post_vars is not None or post_files is not None or
+            body_callback is not None or byte_range is not None):
+        raise ValueError("use_cache can't be used with "
+                "content_check_callback, resume, POST data, body_callback "
+                "or byte_range")
+    if compressed is None:
+        compressed = (write_file is None and byte_range is None)
     url = sanitize_url(url)
     if url.startswith("file://"):
-        return _grab_file_url(url, callback, errback, default_mime_type)
+        return _grab_file_url(url, callback, errback, default_mime_type,
+                write_file, body_callback)
+    elif use_cache and httpcache.cache is not None:
+        return _grab_url_cached(url, callback, errback, header_callback,
+                write_file, etag, modified, compressed)
     else:
         options = TransferOptions(url, etag, modified, resume, post_vars,
-                post_files, write_file)
+                post_files, write_file, compressed, byte_range, bulk)
         transfer = CurlTransfer(options, callback, errback, header_callback,
-                content_check_callback)
+                content_check_callback, body_callback)
         transfer.start()
         return HTTPClient(transfer)
 
-def _grab_file_url(url, callback, errback, default_mime_type):
+class CacheHitTransfer(object):
+    """Stands in for a CurlTransfer when grab_url() was answered from the
+    HTTP cache.
+    """
+    def __init__(self, callback, info):
+        self.canceled = False
+        self.stats = TransferStats()
+        self.stats.status_code = info['status']
+        eventloop.add_idle(self._send_callback, 'http cache callback',
+                args=(callback, info))
+
+    def _send_callback(self, callback, info):
+        if not self.canceled:
+            callback(info)
+
+    def cancel(self, remove_file):
+        self.canceled = True
+
+    def get_stats(self):
+        return self.stats
+
+def _make_cached_response(cache, entry, write_file):
+    """Make the info dict for a response from the cache.
+
+    :returns: info dict, or None if we couldn't read the cached body
+    """
+    info = entry.make_info()
+    if write_file is not None:
+        if not cache.copy_body(entry, write_file):
+            return None
+    else:
+        body = cache.read_body(entry)
+        if body is None:
+            return None
+        info['body'] = body
+    cache.touch(entry)
+    return info
+
+def _grab_url_cached(url, callback, errback, header_callback, write_file,
+        etag, modified, compressed):
+    """grab_url() for use_cache=True."""
+    cache = httpcache.cache
+    entry = cache.get(url)
+    if entry is not None and entry.is_fresh():
+        if ((etag is not None or modified is not None) and
+                etag in (None, entry.get_etag()) and
+                modified in (None, entry.get_last_modified())):
+            # the caller already has this version
+            info = entry.make_info()
+            info['status'] = 304
+            cache.touch(entry)
+        else:
+            info = _make_cached_response(cache, entry, write_file)
+        if info is not None:
+            cache.record_hit()
+            if header_callback is not None:
+                eventloop.add_idle(header_callback,
+                        'http cache header callback', args=(info,))
+            return HTTPClient(CacheHitTransfer(callback, info))
+
+    # If the caller didn't send their own validators, revalidate the entry
+    # that we have.  Either way, we may need to send a 304 response from the
+    # server to the caller as the full response from our cache.
+    if entry is not None and etag is None and modified is None:
+        etag = entry.get_etag()
+        modified = entry.get_last_modified()
+        send_full_response = True
+    else:
+        send_full_response = False
+
+    def on_response(info):
+        if info['status'] == 304:
+            still_cached = (entry is not None and cache.get(url) is entry)
+            if still_cached:
+                cache.revalidated(entry, info)
+            if send_full_response:
+                # We added the validators, so the caller expects the whole
+                # response.  The body on disk belongs to entry only if it's
+                # still the one in the cache.
+                if still_cached:
+                    info = _make_cached_response(cache, entry, write_file)
+                else:
+                    info = None
+                if info is None:
+                    # the cached body went away, start over
+                    restart()
+                    return
+        else:
+            cache.record_miss()
+            if write_file is not None:
+                cache.store(url, info, body_file=write_file)
+            elif 'body' in info:
+                cache.store(url, info, body=info['body'])
+        callback(info)
+
+    def restart():
+        # Make the request again without validators.  The caller holds on to
+        # client, so give it the new transfer, that way cancel() still works.
+        new_client = grab_url(url, callback, errback, header_callback,
+                write_file=write_file, compressed=compressed)
+        client.transfer = new_client.transfer
+
+    options = TransferOptions(url, etag, modified, write_file=write_file,
+            compressed=compressed)
+    transfer = CurlTransfer(options, on_response, errback, header_callback)
+    client = HTTPClient(transfer)
+    transfer.start()
+    return client
+
+def _grab_file_url(url, callback, errback, default_mime_type,
+        write_file=None, body_callback=None):
     path = download_utils.get_file_url_path(url)
     try:
         f = file(path)
@@ -950,20 +1658,50 @@ def _grab_file_url(url, callback, errback, default_mime_type):
                 args=(FileURLNotFoundError(path),))
     else:
         try:
-            data = f.read()
+            if write_file is not None or body_callback is not None:
+                _copy_file_url_data(f, write_file, body_callback)
+                data = None
+            else:
+                data = f.read()
+        except WriteError, e:
+            eventloop.add_idle(errback, 'grab file url errback', args=(e,))
         except (SystemExit, KeyboardInterrupt):
             raise
         except:
             eventloop.add_idle(errback, 'grab file url errback',
                     args=(FileURLReadError(path),))
         else:
-            info = {"body": data,
-                          "updated-url":url,
+            info = {"updated-url":url,
                           "redirected-url":url,
                           "content-type": default_mime_type,
                           }
+            if data is not None:
+                info['body'] = data
             eventloop.add_idle(callback, 'grab file url callback',
                     args=(info,))
+        f.close()
+
+def _copy_file_url_data(f, write_file, body_callback):
+    """Send the contents of a file:// URL to the write_file/body_callback
+    sink passed to grab_url().
+    """
+    if write_file is not None:
+        try:
+            output = fileutil.open_file(write_file, 'wb')
+        except IOError:
+            raise WriteError(write_file)
+    try:
+        while True:
+            data = f.read(FILE_URL_CHUNK_SIZE)
+            if not data:
+                break
+            if write_file is not None:
+                output.write(data)
+            else:
+                body_callback(data)
+    finally:
+        if write_file is not None:
+            output.close()
 
 def _grab_headers_using_get(url, callback, errback):
     options = TransferOptions(url)
@@ -972,8 +1710,12 @@ def _grab_headers_using_get(url, callback, errback):
     transfer.start()
     return HTTPClient(transfer)
 
-def grab_headers(url, callback, errback):
-    """Quickly get the headers for a URL"""
+def grab_headers(url, callback, errback, use_cache=False):
+    """Quickly get the headers for a URL
+
+    :param use_cache: if True and the httpcache module has a fresh entry for
+        the URL, use the headers from that.
+    """
     def errback_intercept(error):
         if isinstance(error, AuthorizationCanceled):
             # don't bother asking again
@@ -981,6 +1723,14 @@ def grab_headers(url, callback, errback):
         _grab_headers_using_get(url, callback, errback)
 
     url = sanitize_url(url)
+    if use_cache and httpcache.cache is not None:
+        entry = httpcache.cache.get(url)
+        if entry is not None and entry.is_fresh():
+            httpcache.cache.touch(entry)
+            httpcache.cache.record_hit()
+            info = entry.make_info()
+            info['body'] = ''
+            return HTTPClient(CacheHitTransfer(callback, info))
     options = TransferOptions(url)
     options.head_request = True
     transfer = CurlTransfer(options, callback, errback_intercept)
@@ -1014,3 +1764,36 @@ def stop_thread():
     global curl_manager
     curl_manager.stop()
     curl_manager = None
+
+def set_bandwidth_limits(global_limit, transfer_limit):
+    """Limit the download bandwidth for bulk transfers.
+
+    :param global_limit: max bytes/sec to download for all transfers, 0 for
+        no limit.  Interactive transfers aren't throttled, but they count
+        against this limit.
+    :param transfer_limit: max bytes/sec for each bulk transfer, 0 for no
+        limit
+    """
+    curl_manager.set_bandwidth_limits(global_limit, transfer_limit)
+
+def set_external_interactive_rate(rate):
+    """Tell the bandwidth scheduler how many bytes/sec the interactive
+    transfers in the other process are using.  They count against the global
+    limit just like our own interactive transfers.
+    """
+    curl_manager.set_external_interactive_rate(rate)
+
+def get_interactive_rate():
+    """Get how many bytes/sec our interactive transfers were downloading
+    at the last bandwidth update.
+    """
+    if curl_manager is None:
+        return 0
+    return curl_manager.get_interactive_rate()
+
+def get_connection_stats():
+    """Get connection reuse statistics from the libcurl thread.
+
+    See LibCURLManager.get_connection_stats() for the details.
+    """
+    return curl_manager.get_connection_stats()
@@ -167,7 +167,18 @@ class IconCache(DDBObject):
             eventloop.add_timeout(3600, self.request_update, "Thumbnail request for %s" % url)
         iconCacheUpdater.update_finished()
 
-    def update_icon_cache(self, url, info):
+    def update_icon_cache(self, url, info, tmp_filename):
+        try:
+            self._update_icon_cache(url, info, tmp_filename)
+        finally:
+            # If we didn't move the download into place, get rid of it.
+            self.remove_file(tmp_filename)
+
+    def download_error(self, url, error, tmp_filename):
+        self.remove_file(tmp_filename)
+        self.error_callback(url, error)
+
+    def _update_icon_cache(self, url, info, tmp_filename):
         self.dbItem.confirm_db_thread()
 
         if self.removed:
@@ -193,24 +204,6 @@ class IconCache(DDBObject):
                 self.filename = None
 
             cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
-            try:
-                fileutil.makedirs(cachedir)
-            except OSError:
-                pass
-
-            try:
-                # Write to a temp file.
-                if self.filename:
-                    tmp_filename = self.filename + ".part"
-                else:
-                    tmp_filename = os.path.join(cachedir, info["filename"]) + ".part"
-
-                tmp_filename, output = next_free_filename(tmp_filename)
-                output.write(info["body"])
-                output.close()
-            except IOError:
-                self.remove_file(tmp_filename)
-                return
 
             if self.filename:
                 self.remove_file(self.filename)
@@ -287,9 +280,37 @@ class IconCache(DDBObject):
             self.error_callback(url)
             return
 
-        # Last try, get the icon from HTTP.
-        httpclient.grab_url(url, lambda info: self.update_icon_cache(url, info),
-                lambda error: self.error_callback(url, error))
+        # Last try, get the icon from HTTP.  We download straight to a
+        # temp file rather than holding the icon in memory.
+        tmp_filename = self.make_tmp_filename()
+        if tmp_filename is None:
+            self.error_callback(url, "can't create temp file")
+            return
+        httpclient.grab_url(url,
+                lambda info: self.update_icon_cache(url, info, tmp_filename),
+                lambda error: self.download_error(url, error, tmp_filename),
+                write_file=tmp_filename)
+
+    def make_tmp_filename(self):
+        """Create an empty temp file to download the icon into.
+
+        :returns: the filename, or None if we couldn't create the file
+        """
+        cachedir = app.config.get(prefs.ICON_CACHE_DIRECTORY)
+        try:
+            fileutil.makedirs(cachedir)
+        except OSError:
+            pass
+        if self.filename and fileutil.access(self.filename, os.R_OK | os.W_OK):
+            tmp_filename = self.filename + ".part"
+        else:
+            tmp_filename = os.path.join(cachedir, "icon-%s.part" % self.id)
+        try:
+            tmp_filename, output = next_free_filename(tmp_filename)
+        except (IOError, OSError):
+            return None
+        output.close()
+        return tmp_filename
 
     def request_update(self, is_vital=False):
         if hasattr(self, "updating") and hasattr(self, "dbItem"):
@@ -82,8 +82,18 @@ class FeedParserValues(object):
     attribute for various attributes using in Item (entry_title,
     rss_id, url, etc...).
     """
-    def __init__(self, entry):
+    # keys of data, these are what compare_to_item() checks
+    DATA_KEYS = ('comments_link', 'enclosure_format', 'enclosure_size',
+                 'enclosure_type', 'entry_description', 'entry_title',
+                 'license', 'link', 'payment_link', 'releaseDateObj',
+                 'rss_id', 'thumbnail_url', 'url')
+    # keys of data that compare_to_item_enclosures() checks
+    ENCLOSURE_KEYS = ('url', 'enclosure_size', 'enclosure_type',
+                      'enclosure_format')
+
+    def __init__(self, entry, entry_digest=None):
         self.entry = entry
+        self.entry_digest = entry_digest
         self.first_video_enclosure = get_first_video_enclosure(entry)
 
         self.data = {
@@ -105,6 +115,7 @@ class FeedParserValues(object):
     def update_item(self, item):
         for key, value in self.data.items():
             setattr(item, key, value)
+        item.entry_digest = self.entry_digest
 
     def compare_to_item(self, item):
         for key, value in self.data.items():
@@ -113,15 +124,32 @@ class FeedParserValues(object):
         return True
 
     def compare_to_item_enclosures(self, item):
-        compare_keys = (
-            'url', 'enclosure_size', 'enclosure_type',
-            'enclosure_format'
-            )
-        for key in compare_keys:
+        for key in self.ENCLOSURE_KEYS:
             if getattr(item, key) != self.data[key]:
                 return False
         return True
 
+    # The key methods below return tuples that can be used to look up
+    # items in a dict instead of calling compare_to_item() or
+    # compare_to_item_enclosures() on each one.  The keys are equal when
+    # the compare methods would return True.  The tuples may contain
+    # unhashable values, in which case using them as keys raises
+    # TypeError.
+
+    def content_key(self):
+        return tuple(self.data[key] for key in self.DATA_KEYS)
+
+    @classmethod
+    def item_content_key(cls, item):
+        return tuple(getattr(item, key) for key in cls.DATA_KEYS)
+
+    def enclosure_key(self):
+        return tuple(self.data[key] for key in self.ENCLOSURE_KEYS)
+
+    @classmethod
+    def item_enclosure_key(cls, item):
+        return tuple(getattr(item, key) for key in cls.ENCLOSURE_KEYS)
+
     def _calc_title(self):
         if hasattr(self.entry, "title"):
             # The title attribute shouldn't use entities, but some in
@@ -1183,8 +1211,20 @@ class Item(DDBObject, iconcache.IconCacheOwnerMixin, ItemBase):
     def remove_rss_id(self):
         self.confirm_db_thread()
         self.rss_id = None
+        # our data no longer matches the feed entry
+        self.entry_digest = None
         self.signal_change()
 
+    def set_entry_digest(self, digest):
+        """Set the digest of the feed entry that this item matches.
+
+        See RSSFeedImplBase._create_items_for_parsed().
+        """
+        self.confirm_db_thread()
+        if self.entry_digest != digest:
+            self.entry_digest = digest
+            self.signal_change()
+
     def set_auto_downloaded(self, autodl=True):
         self.confirm_db_thread()
         if autodl != self.autoDownloaded:
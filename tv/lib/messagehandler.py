@@ -41,6 +41,7 @@ from miro import devices
 from miro import downloader
 from miro import eventloop
 from miro import feed
+from miro import feedupdate
 from miro.displaystate import DisplayState
 from miro import guide
 from miro import fileutil
@@ -308,6 +309,14 @@ class ItemTrackerBase(ViewTracker):
             tracker.connect('removed', self.on_object_removed)
             tracker.connect('changed', self.on_object_changed)
             self.trackers.append(tracker)
+            # let the downloader know that these items are on screen, so
+            # that it sends us download rate changes for them.
+            downloader.add_item_display_tracker(tracker)
+
+    def unlink(self):
+        for tracker in self.trackers:
+            downloader.remove_item_display_tracker(tracker)
+        ViewTracker.unlink(self)
 
     def get_object_views(self):
         return [self.view]
@@ -434,10 +443,12 @@ class DeviceItemTracker(object):
         real_id, item_type = self.id.rsplit('-', 1)
         if item_type not in ('video', 'audio'):
             return
-        devices.clean_database(self.device)
+        # devices.DeviceScanner keeps the database up to date, so we don't
+        # check the files here.
         items = [item.DeviceItem(device=self.device, file_type=item_type,
                                  video_path=path, **args)
-                 for path, args in self.device.database[item_type].items()]
+                 for path, args in
+                 self.device.database.get(item_type, {}).items()]
         infos = [messages.ItemInfo(i) for i in items]
 
         messages.ItemList(self.type, self.id, infos).send_to_frontend()
@@ -1187,6 +1198,9 @@ New ids: %s""", playlist_item_ids, message.item_ids)
                 # message type was wrong
                 return
             self.item_trackers[key] = item_tracker
+            if message.type in ('feed', 'audio-feed'):
+                # the user is looking at this feed, update it before others
+                feedupdate.set_priority(message.id, True)
         else:
             item_tracker = self.item_trackers[key]
         item_tracker.send_initial_list()
@@ -1203,6 +1217,8 @@ New ids: %s""", playlist_item_ids, message.item_ids)
             logging.warn("Item tracker not found (id: %s)", message.id)
         else:
             item_tracker.unlink()
+            if message.type in ('feed', 'audio-feed'):
+                feedupdate.set_priority(message.id, False)
 
     def handle_cancel_auto_download(self, message):
         try:
@@ -1563,7 +1579,7 @@ New ids: %s""", playlist_item_ids, message.item_ids)
                               [message.item.id]).send_to_frontend()
 
     def handle_device_eject(self, message):
-        devices.write_database(message.device.mount, message.device.database)
+        devices.flush_database(message.device.database)
         app.device_tracker.eject(message.device)
 
     @staticmethod
@@ -26,13 +26,14 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
-from miro.eventloop import as_idle
 import os.path
 import re
+from datetime import datetime, timedelta
+import shutil
 import subprocess
-import time
 import traceback
 import threading
+import itertools
 import Queue
 import logging
 import mutagen
@@ -42,15 +43,24 @@ from miro import prefs
 from miro import signals
 from miro import util
 from miro import fileutil
+from miro import eventloop
+from miro import moviedatacache
 from miro.plat.utils import (FilenameType, kill_process,
-                             movie_data_program_info, thread_body)
+                             movie_data_program_info, thread_body,
+                             get_logical_cpu_count)
 
 # Time in seconds that we wait for the utility to execute.  If it goes
 # longer than this, we assume it's hung and kill it.
 MOVIE_DATA_UTIL_TIMEOUT = 120
 
-# Time to sleep while we're polling the external movie command
-SLEEP_DELAY = 0.1
+# Queue priorities, lower numbers go first.
+PRIORITY_SHUTDOWN = 0
+PRIORITY_DISPLAYED = 1   # items that the user is looking at
+PRIORITY_DOWNLOADED = 2  # items that just finished downloading
+PRIORITY_NORMAL = 3      # everything else (watched folders, old items)
+
+# how long after a download finishes we still count it as just finished
+RECENT_DOWNLOAD_WINDOW = timedelta(hours=1)
 
 DURATION_RE = re.compile("Miro-Movie-Data-Length: (\d+)")
 TYPE_RE = re.compile("Miro-Movie-Data-Type: (audio|video|other)")
@@ -121,99 +131,197 @@ class MovieDataInfo(object):
     program_info = property(_get_program_info)
 
 class MovieDataUpdater(signals.SignalEmitter):
+    """Extracts durations, thumbnails and metadata from media files.
+
+    The work is done by a pool of worker threads, one per CPU, since most of
+    the time is spent running the movie data program.  Items get queued by
+    request_update(), with items that are on screen or that just finished
+    downloading going to the front of the line.  Results are collected and
+    saved to the database in batches from the event loop.
+    """
     def __init__ (self):
         signals.SignalEmitter.__init__(self, 'begin-loop', 'end-loop',
                 'queue-empty')
         self.in_shutdown = False
-        self.queue = Queue.Queue()
-        self.thread = None
+        # holds (priority, sequence number, MovieDataInfo) tuples.  The
+        # sequence number keeps things first in, first out within a
+        # priority.
+        self.queue = Queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.threads = []
+        # results that are waiting for update_items() to save them
+        self.results = []
+        self.results_lock = threading.Lock()
+        self.update_scheduled = False
+        # movie data processes that are running, so shutdown() can kill them
+        self.processes = set()
+        self.processes_lock = threading.Lock()
+
+    def calc_thread_count(self):
+        return max(1, get_logical_cpu_count())
 
     def start_thread(self):
-        self.thread = threading.Thread(name='Movie Data Thread',
-                                       target=thread_body,
-                                       args=[self.thread_loop])
-        self.thread.setDaemon(True)
-        self.thread.start()
+        for i in xrange(self.calc_thread_count()):
+            thread = threading.Thread(name='Movie Data Thread %d' % i,
+                                      target=thread_body,
+                                      args=[self.thread_loop])
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
 
     def thread_loop(self):
         while not self.in_shutdown:
             self.emit('begin-loop')
             if self.queue.empty():
                 self.emit('queue-empty')
-            mdi = self.queue.get(block=True)
+            priority, sequence, mdi = self.queue.get(block=True)
             if mdi is None or mdi.program_info is None:
                 # shutdown() was called or there's no moviedata
                 # implemented.
                 self.emit('end-loop')
                 break
-            duration = -1
-            metadata = {}
-            (mime_mediatype, duration, metadata) = self.read_metadata(mdi.item)
-            if duration > -1 and mime_mediatype is not 'video':
-                mediatype = 'audio'
-                screenshot = mdi.item.screenshot or FilenameType("")
-                logging.debug("moviedata: mutagen %s %s", duration, mediatype)
-
-                self.update_finished(mdi.item, duration, screenshot, mediatype,
-                        metadata)
+            try:
+                self.process_item(mdi)
+            finally:
+                self.emit('end-loop')
+
+    def process_item(self, mdi):
+        cache_key = None
+        if moviedatacache.cache is not None:
+            cache_key = moviedatacache.calc_key(mdi.video_path)
+            if cache_key is not None and self.use_cached_data(mdi, cache_key):
+                return
+        duration = -1
+        metadata = {}
+        (mime_mediatype, duration, metadata) = self.read_metadata(mdi.item)
+        if duration > -1 and mime_mediatype is not 'video':
+            mediatype = 'audio'
+            screenshot = mdi.item.screenshot or FilenameType("")
+            logging.debug("moviedata: mutagen %s %s", duration, mediatype)
+
+            self.store_cached_data(mdi, cache_key, duration, screenshot,
+                    mediatype, metadata)
+            self.update_finished(mdi.item, duration, screenshot, mediatype,
+                    metadata)
+            return
+        try:
+            screenshot_worked = False
+            screenshot = None
+
+            command_line, env = mdi.program_info
+            stdout = self.run_movie_data_program(command_line, env)
+
+            # if the moviedata program tells us to try again, we move
+            # along without updating the item at all
+            if TRY_AGAIN_RE.search(stdout):
+                return
+
+            if duration == -1:
+                duration = self.parse_duration(stdout)
+            mediatype = self.parse_type(stdout)
+            if THUMBNAIL_SUCCESS_RE.search(stdout):
+                screenshot_worked = True
+            if ((screenshot_worked and
+                 fileutil.exists(mdi.thumbnail_path))):
+                screenshot = mdi.thumbnail_path
             else:
-                try:
-                    screenshot_worked = False
-                    screenshot = None
-
-                    command_line, env = mdi.program_info
-                    stdout = self.run_movie_data_program(command_line, env)
-
-                    # if the moviedata program tells us to try again, we move
-                    # along without updating the item at all
-                    if TRY_AGAIN_RE.search(stdout):
-                        continue
-
-                    if duration == -1:
-                        duration = self.parse_duration(stdout)
-                    mediatype = self.parse_type(stdout)
-                    if THUMBNAIL_SUCCESS_RE.search(stdout):
-                        screenshot_worked = True
-                    if ((screenshot_worked and
-                         fileutil.exists(mdi.thumbnail_path))):
-                        screenshot = mdi.thumbnail_path
-                    else:
-                        # All the programs failed, maybe it's an audio
-                        # file?  Setting it to "" instead of None, means
-                        # that we won't try to take the screenshot again.
-                        screenshot = FilenameType("")
-                    logging.debug("moviedata: mdp %s %s %s", duration, screenshot,
-                                  mediatype)
-
-                    self.update_finished(mdi.item, duration, screenshot,
-                                         mediatype, metadata)
-                except StandardError:
-                    if self.in_shutdown:
-                        break
-                    signals.system.failed_exn(
-                        "When running external movie data program")
-                    self.update_finished(mdi.item, -1, None, None, metadata)
-            self.emit('end-loop')
+                # All the programs failed, maybe it's an audio
+                # file?  Setting it to "" instead of None, means
+                # that we won't try to take the screenshot again.
+                screenshot = FilenameType("")
+            logging.debug("moviedata: mdp %s %s %s", duration, screenshot,
+                          mediatype)
+
+            # an empty stdout means that the program was killed, so we
+            # should try again if we see the file again
+            if stdout and not self.in_shutdown:
+                self.store_cached_data(mdi, cache_key, duration, screenshot,
+                        mediatype, metadata)
+            self.update_finished(mdi.item, duration, screenshot,
+                                 mediatype, metadata)
+        except StandardError:
+            if self.in_shutdown:
+                return
+            signals.system.failed_exn(
+                "When running external movie data program")
+            self.update_finished(mdi.item, -1, None, None, metadata)
+
+    def use_cached_data(self, mdi, cache_key):
+        """Update an item using the movie data cache.
+
+        The item gets its own copy of the cached screenshot, since items
+        delete their screenshots when they expire.
+
+        :returns: True if we found the item in the cache
+        """
+        entry = moviedatacache.cache.get(cache_key, mdi.video_path)
+        if entry is None:
+            return False
+        screenshot = entry['screenshot']
+        if screenshot:
+            try:
+                shutil.copyfile(screenshot, mdi.thumbnail_path)
+            except (IOError, OSError):
+                # the screenshot is gone, run the movie data program again
+                return False
+            screenshot = mdi.thumbnail_path
+        logging.debug("moviedata: cached %s %s %s", entry['duration'],
+                      screenshot, entry['mediatype'])
+        self.update_finished(mdi.item, entry['duration'], screenshot,
+                             entry['mediatype'], entry['metadata'])
+        return True
+
+    def store_cached_data(self, mdi, cache_key, duration, screenshot,
+                          mediatype, metadata):
+        if cache_key is None:
+            return
+        try:
+            moviedatacache.cache.put(cache_key, mdi.video_path, duration,
+                                     screenshot, mediatype, metadata)
+        except moviedatacache.sqlite3.Error:
+            logging.warn("error storing movie data cache entry",
+                         exc_info=True)
 
     def run_movie_data_program(self, command_line, env):
-        start_time = time.time()
+        """Run the movie data program and return what it wrote to stdout.
+
+        communicate() reads stdout and stderr as the data comes in and
+        returns as soon as the process exits, so we don't need to poll it.
+        A timer kills the process if it runs longer than
+        MOVIE_DATA_UTIL_TIMEOUT and shutdown() kills any that are still
+        running.  In both cases we return an empty string.
+        """
         pipe = subprocess.Popen(command_line, stdout=subprocess.PIPE,
                 stdin=subprocess.PIPE, stderr=subprocess.PIPE, env=env,
                 startupinfo=util.no_console_startupinfo())
-        while pipe.poll() is None and not self.in_shutdown:
-            time.sleep(SLEEP_DELAY)
-            if time.time() - start_time > MOVIE_DATA_UTIL_TIMEOUT:
-                logging.info("Movie data process hung, killing it")
-                self.kill_process(pipe.pid)
-                return ''
-
-        if self.in_shutdown:
-            if pipe.poll() is None:
-                logging.info("Movie data process running after shutdown, "
-                             "killing it")
+        self.processes_lock.acquire()
+        try:
+            self.processes.add(pipe)
+        finally:
+            self.processes_lock.release()
+        timed_out = threading.Event()
+        def on_timeout():
+            timed_out.set()
+            logging.info("Movie data process hung, killing it")
+            self.kill_process(pipe.pid)
+        timer = threading.Timer(MOVIE_DATA_UTIL_TIMEOUT, on_timeout)
+        timer.setDaemon(True)
+        timer.start()
+        try:
+            if self.in_shutdown:
+                # shutdown() may have run before we added the process
                 self.kill_process(pipe.pid)
+            stdout, stderr = pipe.communicate()
+        finally:
+            timer.cancel()
+            self.processes_lock.acquire()
+            try:
+                self.processes.discard(pipe)
+            finally:
+                self.processes_lock.release()
+        if timed_out.isSet() or self.in_shutdown:
             return ''
-        return pipe.stdout.read()
+        return stdout
 
     def _mediatype_from_mime(self, mimes):
         for mime in mimes:
@@ -362,8 +470,39 @@ class MovieDataUpdater(signals.SignalEmitter):
         else:
             return None
 
-    @as_idle
     def update_finished(self, item, duration, screenshot, mediatype, metadata):
+        """Queue up the results for an item.  This is called from the
+        worker threads.
+        """
+        self.results_lock.acquire()
+        try:
+            self.results.append((item, duration, screenshot, mediatype,
+                                 metadata))
+            schedule = not self.update_scheduled
+            self.update_scheduled = True
+        finally:
+            self.results_lock.release()
+        if schedule:
+            eventloop.add_idle(self.update_items, "Update movie data")
+
+    def update_items(self):
+        """Save all the results that the worker threads have queued up."""
+        self.results_lock.acquire()
+        try:
+            results = self.results
+            self.results = []
+            self.update_scheduled = False
+        finally:
+            self.results_lock.release()
+        app.bulk_sql_manager.start()
+        try:
+            for (item, duration, screenshot, mediatype, metadata) in results:
+                self.update_item(item, duration, screenshot, mediatype,
+                                 metadata)
+        finally:
+            app.bulk_sql_manager.finish()
+
+    def update_item(self, item, duration, screenshot, mediatype, metadata):
         if item.id_exists():
             item.duration = duration
             item.screenshot = screenshot
@@ -374,6 +513,17 @@ class MovieDataUpdater(signals.SignalEmitter):
                 item.media_type_checked = True
             item.signal_change()
 
+    def calc_priority(self, item):
+        # import here since downloader imports this module indirectly
+        from miro import downloader
+        if downloader.is_item_displayed(item.id):
+            return PRIORITY_DISPLAYED
+        elif (item.downloadedTime is not None and
+                datetime.now() - item.downloadedTime < RECENT_DOWNLOAD_WINDOW):
+            return PRIORITY_DOWNLOADED
+        else:
+            return PRIORITY_NORMAL
+
     def request_update(self, item):
         if self.in_shutdown:
             return
@@ -386,13 +536,25 @@ class MovieDataUpdater(signals.SignalEmitter):
             return
 
         item.updating_movie_info = True
-        self.queue.put(MovieDataInfo(item))
+        self.queue.put((self.calc_priority(item), self.sequence.next(),
+                        MovieDataInfo(item)))
 
     def shutdown(self):
         self.in_shutdown = True
-        # wake up our thread
-        self.queue.put(None)
-        if self.thread is not None:
-            self.thread.join()
+        self.processes_lock.acquire()
+        try:
+            processes = list(self.processes)
+        finally:
+            self.processes_lock.release()
+        for pipe in processes:
+            logging.info("Movie data process running after shutdown, "
+                         "killing it")
+            self.kill_process(pipe.pid)
+        # wake up our threads
+        for thread in self.threads:
+            self.queue.put((PRIORITY_SHUTDOWN, self.sequence.next(), None))
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
 
 movie_data_updater = MovieDataUpdater()
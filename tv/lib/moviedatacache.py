@@ -0,0 +1,288 @@
+# Miro - an RSS based video player application
+# Copyright (C) 2005-2010 Participatory Culture Foundation
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin St, Fifth Floor, Boston, MA  02110-1301 USA
+#
+# In addition, as a special exception, the copyright holders give
+# permission to link the code of portions of this program with the OpenSSL
+# library.
+#
+# You must obey the GNU General Public License in all respects for all of
+# the code used other than OpenSSL. If you modify file(s) with this
+# exception, you may extend this exception to your version of the file(s),
+# but you are not obligated to do so. If you do not wish to do so, delete
+# this exception statement from your version. If you delete this exception
+# statement from all source files in the program, then also delete it here.
+
+"""``miro.moviedatacache`` -- Remembers what we found out about media files.
+
+When a file gets added again (re-imported, moved to another watched folder or
+added back after the database was reset), ``MovieDataUpdater`` can use the
+results from last time instead of running mutagen and the movie data program.
+
+Entries are keyed by the file's size, modification time and a hash of its
+first and last ``HASH_CHUNK_SIZE`` bytes, so the key stays the same when the
+file moves, but changes if it's modified.  The cache is a small sqlite
+database of its own, since the movie data threads can't use the main one.
+Items delete their screenshots when they expire, so the cache keeps its own
+copy of each screenshot in a directory next to the database.
+
+Entries for files that are gone get removed by ``prune()``, along with their
+screenshots.
+"""
+
+import cPickle
+import hashlib
+import logging
+import os
+import shutil
+import threading
+import time
+
+try:
+    import sqlite3
+except ImportError:
+    from pysqlite2 import dbapi2 as sqlite3
+
+from miro import app
+from miro import eventloop
+from miro import fileutil
+from miro import prefs
+
+# how much to read from the start and the end of a file for its key
+HASH_CHUNK_SIZE = 64 * 1024
+# Entries for files that we can't find are kept for this long (in seconds),
+# in case the file was moved and gets added back from its new location.
+PRUNE_AGE = 7 * 24 * 60 * 60
+
+def calc_key(path):
+    """Calculate the cache key for a file.
+
+    :returns: key string, or None if we can't read the file
+    """
+    try:
+        f = fileutil.open_file(path, 'rb')
+        try:
+            stat_result = os.fstat(f.fileno())
+            size = stat_result.st_size
+            hasher = hashlib.sha1()
+            hasher.update(f.read(HASH_CHUNK_SIZE))
+            if size > HASH_CHUNK_SIZE * 2:
+                f.seek(-HASH_CHUNK_SIZE, os.SEEK_END)
+                hasher.update(f.read(HASH_CHUNK_SIZE))
+        finally:
+            f.close()
+    except (IOError, OSError):
+        return None
+    return '%d:%d:%s' % (size, int(stat_result.st_mtime), hasher.hexdigest())
+
+class MovieDataCache(object):
+    """Stores movie data results in a sqlite database.
+
+    Entries are dicts with the path of the file that we last saw with that
+    key, plus the duration, screenshot, mediatype and metadata that
+    ``MovieDataUpdater.update_finished()`` takes.  The screenshot is the
+    cache's own copy, stored in screenshot_dir.
+
+    This can be used from any thread.
+    """
+    def __init__(self, path, screenshot_dir=None):
+        self.path = path
+        if screenshot_dir is None:
+            screenshot_dir = os.path.join(os.path.dirname(path),
+                                          'movie-data-cache')
+        self.screenshot_dir = screenshot_dir
+        self.lock = threading.Lock()
+        self.hits = self.misses = 0
+        try:
+            self.connection = self._connect()
+        except sqlite3.DatabaseError:
+            logging.warn("movie data cache is corrupt, starting over",
+                         exc_info=True)
+            try:
+                fileutil.remove(path)
+            except OSError:
+                pass
+            self.connection = self._connect()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, check_same_thread=False)
+        # losing a couple of entries in a crash is fine, so don't wait for
+        # the disk on every commit
+        connection.execute("PRAGMA synchronous=OFF")
+        connection.execute("CREATE TABLE IF NOT EXISTS movie_data "
+                           "(key TEXT PRIMARY KEY, data BLOB, "
+                           "last_seen REAL)")
+        connection.commit()
+        return connection
+
+    def get(self, key, path):
+        """Look up an entry.
+
+        :param key: key from calc_key()
+        :param path: path of the file we're looking up.  If the file has
+            moved, we remember its new location.
+        :returns: entry dict, or None
+        """
+        self.lock.acquire()
+        try:
+            cursor = self.connection.execute(
+                    "SELECT data FROM movie_data WHERE key=?", (key,))
+            row = cursor.fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            try:
+                entry = cPickle.loads(str(row[0]))
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                logging.warn("error loading movie data cache entry",
+                             exc_info=True)
+                self.misses += 1
+                return None
+            self.hits += 1
+            if entry['path'] != path:
+                entry['path'] = path
+                self._write(key, entry)
+            return entry
+        finally:
+            self.lock.release()
+
+    def screenshot_path(self, key):
+        """Get the path of the cache's copy of the screenshot for key."""
+        # keys contain colons, which windows doesn't allow in filenames
+        return os.path.join(self.screenshot_dir,
+                            '%s.png' % key.replace(':', '-'))
+
+    def put(self, key, path, duration, screenshot, mediatype, metadata):
+        """Store an entry.
+
+        If there's a screenshot, we copy it into screenshot_dir.  If that
+        fails, we don't store anything.
+        """
+        if screenshot:
+            cached_screenshot = self.screenshot_path(key)
+            try:
+                if not fileutil.exists(self.screenshot_dir):
+                    fileutil.makedirs(self.screenshot_dir)
+                shutil.copyfile(screenshot, cached_screenshot)
+            except (IOError, OSError):
+                logging.warn("error copying screenshot to the movie data "
+                             "cache", exc_info=True)
+                return
+            screenshot = cached_screenshot
+        else:
+            self._remove_screenshot(key)
+        entry = {
+            'path': path,
+            'duration': duration,
+            'screenshot': screenshot,
+            'mediatype': mediatype,
+            'metadata': metadata,
+        }
+        self.lock.acquire()
+        try:
+            self._write(key, entry)
+        finally:
+            self.lock.release()
+
+    def _remove_screenshot(self, key):
+        try:
+            fileutil.remove(self.screenshot_path(key))
+        except OSError:
+            pass
+
+    def _write(self, key, entry):
+        data = cPickle.dumps(entry, cPickle.HIGHEST_PROTOCOL)
+        self.connection.execute("INSERT OR REPLACE INTO movie_data "
+                                "(key, data, last_seen) VALUES (?, ?, ?)",
+                                (key, buffer(data), time.time()))
+        self.connection.commit()
+
+    def prune(self):
+        """Remove entries for files that have been gone for PRUNE_AGE, and
+        their screenshots.
+
+        This checks every file in the cache, so it should be run in a
+        thread.
+        """
+        now = time.time()
+        self.lock.acquire()
+        try:
+            rows = self.connection.execute(
+                    "SELECT key, data, last_seen FROM movie_data").fetchall()
+        finally:
+            self.lock.release()
+        seen = []
+        to_remove = []
+        for key, data, last_seen in rows:
+            try:
+                path = cPickle.loads(str(data))['path']
+            except (SystemExit, KeyboardInterrupt):
+                raise
+            except:
+                to_remove.append((key,))
+                continue
+            if fileutil.exists(path):
+                seen.append((now, key))
+            elif now - last_seen > PRUNE_AGE:
+                to_remove.append((key,))
+        self.lock.acquire()
+        try:
+            self.connection.executemany(
+                    "UPDATE movie_data SET last_seen=? WHERE key=?", seen)
+            self.connection.executemany(
+                    "DELETE FROM movie_data WHERE key=?", to_remove)
+            self.connection.commit()
+        finally:
+            self.lock.release()
+        for (key,) in to_remove:
+            self._remove_screenshot(key)
+        return len(to_remove)
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.connection.close()
+        finally:
+            self.lock.release()
+
+cache = None
+
+def _default_cache_path():
+    return os.path.join(app.config.get(prefs.SUPPORT_DIRECTORY),
+            'movie-data-cache.sqlite')
+
+def init(path=None):
+    """Open the movie data cache.
+
+    Until this is called, MovieDataUpdater doesn't use the cache.
+    """
+    global cache
+    if path is None:
+        path = _default_cache_path()
+    cache = MovieDataCache(path)
+
+def prune_in_thread():
+    """Run MovieDataCache.prune() in a thread pool thread."""
+    def on_pruned(count):
+        if count:
+            logging.info("removed %d entries from the movie data cache",
+                         count)
+    def on_error(error):
+        logging.warn("error pruning movie data cache: %s", error)
+    eventloop.call_in_thread(on_pruned, on_error, cache.prune,
+            "Prune movie data cache", pool_name='fileio')
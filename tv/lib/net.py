@@ -110,39 +110,53 @@ def trap_call(object, function, *args, **kwargs):
 
 class NetworkBuffer(object):
     """Responsible for storing incomming network data and doing some basic
-    parsing of it.  I think this is about as fast as we can do things in pure
-    python, someday we may want to make it C...
+    parsing of it.
+
+    Data is kept in a single bytearray with an offset to the first unread
+    byte.  Adding data appends to the bytearray and reading just moves the
+    offset, so the only copy we make is of the data that gets returned.
+    Once more than half of the bytearray (and at least COMPACT_SIZE bytes)
+    has been read, we throw away the read part.
     """
+
+    COMPACT_SIZE = 64 * 1024
+
     def __init__(self):
-        self.chunks = []
+        self._data = bytearray()
+        self._pos = 0
         self.length = 0
 
     def addData(self, data):
-        self.chunks.append(data)
+        self._data.extend(data)
         self.length += len(data)
 
-    def _mergeChunks(self):
-        self.chunks = [''.join(self.chunks)]
+    def _consume(self, size):
+        self._pos += size
+        self.length -= size
+        if self.length == 0:
+            del self._data[:]
+            self._pos = 0
+        elif (self._pos >= self.COMPACT_SIZE and
+                self._pos * 2 >= len(self._data)):
+            del self._data[:self._pos]
+            self._pos = 0
 
     def has_data(self):
         return self.length > 0
 
     def discard_data(self):
-        self.chunks = []
+        self._data = bytearray()
+        self._pos = 0
         self.length = 0
 
     def read(self, size=None):
         """Read at most size bytes from the data that has been added to the
         buffer.  """
 
-        self._mergeChunks()
-        if size is not None:
-            rv = self.chunks[0][:size]
-            self.chunks[0] = self.chunks[0][len(rv):]
-        else:
-            rv = self.chunks[0]
-            self.chunks = []
-        self.length -= len(rv)
+        if size is None or size > self.length:
+            size = self.length
+        rv = memoryview(self._data)[self._pos:self._pos+size].tobytes()
+        self._consume(size)
         return rv
 
     def readline(self):
@@ -152,28 +166,30 @@ class NetworkBuffer(object):
         * Both "\r\n" and "\n" act as a line ender
         """
 
-        self._mergeChunks()
-        split = self.chunks[0].split("\n", 1)
-        if len(split) == 2:
-            self.chunks[0] = split[1]
-            self.length = len(self.chunks[0])
-            if split[0].endswith("\r"):
-                return split[0][:-1]
-            else:
-                return split[0]
-        else:
+        end = self._data.find("\n", self._pos)
+        if end < 0:
             return None
+        line_end = end
+        if line_end > self._pos and self._data[line_end-1] == ord("\r"):
+            line_end -= 1
+        rv = memoryview(self._data)[self._pos:line_end].tobytes()
+        self._consume(end + 1 - self._pos)
+        return rv
 
     def unread(self, data):
         """Put back read data.  This make is like the data was never read at
         all.
         """
-        self.chunks.insert(0, data)
+        if len(data) <= self._pos:
+            # there's room in the part that we've already read
+            self._data[self._pos-len(data):self._pos] = data
+            self._pos -= len(data)
+        else:
+            self._data[self._pos:self._pos] = data
         self.length += len(data)
 
     def getValue(self):
-        self._mergeChunks()
-        return self.chunks[0]
+        return memoryview(self._data)[self._pos:].tobytes()
 
 class _Packet(object):
     """A packet of data for the AsyncSocket class
@@ -318,7 +334,8 @@ class AsyncSocket(object):
             trap_call(self, errback, ConnectionTimeout(host))
             self.connectionErrback = None
         eventloop.call_in_thread(onAddressLookup, handleGetAddrInfoException,
-                socket.getaddrinfo, "getAddrInfo - %s:%s" % (host, port), host, port)
+                socket.getaddrinfo, "getAddrInfo - %s:%s" % (host, port), host, port,
+                pool_name='dns')
 
     def accept_connection(self, family, host, port, callback, errback):
         def finishAccept():
@@ -72,6 +72,10 @@ LIMIT_DOWNSTREAM_BT         = Pref(key='limitDownstreamBT',     default=False, p
 DOWNSTREAM_BT_LIMIT_IN_KBS  = Pref(key='downstreamBTLimitInKBS', default=200,   platformSpecific=False)
 LIMIT_CONNECTIONS_BT        = Pref(key='limitConnectionsBT',     default=False, platformSpecific=False)
 CONNECTION_LIMIT_BT_NUM     = Pref(key='connectionLimitBTNum', default=100,   platformSpecific=False)
+LIMIT_DOWNSTREAM_HTTP       = Pref(key='limitDownstreamHTTP',   default=False, platformSpecific=False)
+DOWNSTREAM_HTTP_LIMIT_IN_KBS = Pref(key='downstreamHTTPLimitInKBS', default=200, platformSpecific=False)
+# 0 means that individual HTTP downloads aren't limited
+DOWNSTREAM_HTTP_PER_DOWNLOAD_LIMIT_IN_KBS = Pref(key='downstreamHTTPPerDownloadLimitInKBS', default=0, platformSpecific=False)
 PRESERVE_DISK_SPACE         = Pref(key='preserveDiskSpace',     default=True,  platformSpecific=False)
 PRESERVE_X_GB_FREE          = Pref(key='preserveXGBFree',       default=0.2,   platformSpecific=False)
 EXPIRE_AFTER_X_DAYS         = Pref(key='expireAfterXDays',      default=6,     platformSpecific=False,
@@ -83,6 +87,9 @@ BT_MIN_PORT                 = Pref(key='BitTorrentMinPort',     default=8500,  p
 BT_MAX_PORT                 = Pref(key='BitTorrentMaxPort',     default=8600,  platformSpecific=False)
 UPLOAD_RATIO                = Pref(key='uploadRatio',           default=2.0,   platformSpecific=False)
 LIMIT_UPLOAD_RATIO          = Pref(key='limitUploadRatio',      default=False, platformSpecific=False)
+# how many torrents can be downloading/seeding at once, -1 means no limit
+BT_ACTIVE_DOWNLOADS_LIMIT   = Pref(key='BitTorrentActiveDownloadsLimit', default=5, platformSpecific=False)
+BT_ACTIVE_SEEDS_LIMIT       = Pref(key='BitTorrentActiveSeedsLimit', default=5, platformSpecific=False)
 STARTUP_TASKS_DONE          = Pref(key='startupTasksDone',      default=False, platformSpecific=False)
 SINGLE_VIDEO_PLAYBACK_MODE  = Pref(key='singleVideoPlaybackMode', default=False, platformSpecific=False)
 PLAY_DETACHED               = Pref(key='detachedPlaybackMode',  default=False, platformSpecific=False)
@@ -103,6 +110,25 @@ SUBTITLE_FONT               = Pref(key='subtitleFont',          default=None,  p
 # language setting: "system" uses system default; all other languages are overrides
 LANGUAGE                    = Pref(key='language',              default="system", platformSpecific=False)
 MAX_CONCURRENT_CONVERSIONS  = Pref(key='maxConcurrentConversions', default=1, platformSpecific=False)
+# max size of the converted files that we keep around for device syncs, in MB
+CONVERSION_CACHE_SIZE       = Pref(key='conversionCacheSize',   default=1024, platformSpecific=False)
+# thread pool sizes for eventloop.call_in_thread(); None means pick a size
+# based on the number of cpus
+THREAD_POOL_DEFAULT_SIZE    = Pref(key='threadPoolDefaultSize', default=None, platformSpecific=False)
+THREAD_POOL_DNS_SIZE        = Pref(key='threadPoolDNSSize',     default=None, platformSpecific=False)
+THREAD_POOL_PARSE_SIZE      = Pref(key='threadPoolParseSize',   default=None, platformSpecific=False)
+THREAD_POOL_FILEIO_SIZE     = Pref(key='threadPoolFileIOSize',  default=None, platformSpecific=False)
+# number of processes to use for parsing feeds (capped at the number of
+# cpus), 0 parses feeds in-process.  The timeout is in seconds.
+FEEDPARSER_PROCESSES        = Pref(key='feedparserProcesses',   default=2,    platformSpecific=False)
+FEEDPARSER_TIMEOUT          = Pref(key='feedparserTimeout',     default=120,  platformSpecific=False)
+# max size of the disk cache for httpclient.grab_url(), in megabytes
+HTTP_CACHE_SIZE             = Pref(key='httpCacheSize',         default=20,   platformSpecific=False)
+# number of connections to use for HTTP downloads from servers that support
+# range requests.  1 turns off segmented downloads.
+HTTP_DOWNLOAD_SEGMENTS      = Pref(key='httpDownloadSegments',  default=1,    platformSpecific=False)
+# how much data httpclient buffers before writing it to disk, in kilobytes
+HTTP_WRITE_BUFFER_SIZE      = Pref(key='httpWriteBufferSize',   default=256,  platformSpecific=False)
 
 # This doesn't need to be defined on the platform, but it can be overridden there if the platform wants to.
 SHOW_ERROR_DIALOG           = Pref(key='showErrorDialog',       default=True,  platformSpecific=True)
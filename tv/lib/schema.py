@@ -300,7 +300,7 @@ class SchemaStatusContainer(SchemaReprContainer):
                 self.validateType(value, str)
 
     def _binary_fields(self):
-        rv = ('metainfo', 'fastResumeData')
+        rv = ('metainfo',)
         if FilenameType != unicode:
             rv += self.filename_fields
         return rv
@@ -443,6 +443,7 @@ class ItemSchema(MultiClassObjectSchema):
         ('metadata',
             SchemaDict(SchemaString(noneOk=False),SchemaString(noneOk=True),noneOk=True)),
         ('rating', SchemaInt(noneOk=True)),
+        ('entry_digest', SchemaString(noneOk=True)),
     ]
 
     indexes = (
@@ -499,6 +500,7 @@ class RSSFeedImplSchema(FeedImplSchema):
         ('initialHTML', SchemaBinary(noneOk=True)),
         ('etag', SchemaString(noneOk=True)),
         ('modified', SchemaString(noneOk=True)),
+        ('body_digest', SchemaString(noneOk=True)),
     ]
 
 class SavedSearchFeedImplSchema(FeedImplSchema):
@@ -573,7 +575,6 @@ class RemoteDownloaderSchema(DDBObjectSchema):
         ('channelName', SchemaFilename(noneOk=True)),
         ('status', SchemaStatusContainer()),
         ('metainfo', SchemaBinary(noneOk=True)),
-        ('fast_resume_data', SchemaBinary(noneOk=True)),
         ('manualUpload', SchemaBool()),
         ('state', SchemaString()),
         ('main_item_id', SchemaInt(noneOk=True)),
@@ -707,7 +708,7 @@ class DBLogEntrySchema(DDBObjectSchema):
         ('description', SchemaString()),
     ]
 
-VERSION = 126
+VERSION = 128
 object_schemas = [
     IconCacheSchema, ItemSchema, FeedSchema,
     FeedImplSchema, RSSFeedImplSchema, SavedSearchFeedImplSchema,
@@ -59,6 +59,7 @@ from miro import eventloop
 from miro import fileutil
 from miro import guide
 from miro import httpauth
+from miro import httpcache
 from miro import httpclient
 from miro import iconcache
 from miro import item
@@ -69,6 +70,7 @@ from miro import messages
 from miro import messagehandler
 from miro import models
 from miro import moviedata
+from miro import moviedatacache
 from miro import playlist
 from miro import prefs
 from miro.plat.utils import setup_logging
@@ -233,6 +235,7 @@ def startup():
     logging.info("Reading HTTP Password list")
     httpauth.init()
     httpauth.restore_from_file()
+    httpcache.init()
     logging.info("Starting libCURL thread")
     httpclient.init_libcurl()
     httpclient.start_thread()
@@ -369,6 +372,8 @@ def on_frontend_started():
     yield None
     feed.expire_items()
     yield None
+    moviedatacache.init()
+    moviedatacache.prune_in_thread()
     moviedata.movie_data_updater.start_thread()
     yield None
     commandline.startup()
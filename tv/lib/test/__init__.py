@@ -54,10 +54,13 @@ from miro.test.subscriptiontest import *
 from miro.test.opmltest import *
 from miro.test.schedulertest import *
 from miro.test.networktest import *
+from miro.test.protocoltest import *
 from miro.test.httpclienttest import *
+from miro.test.httpcachetest import *
 from miro.test.httpdownloadertest import *
 from miro.test.feedtest import *
 from miro.test.feedparsertest import *
+from miro.test.feedupdatetest import *
 from miro.test.parseurltest import *
 from miro.test.utiltest import *
 from miro.test.playlisttest import *
@@ -68,6 +71,7 @@ from miro.test.xhtmltest import *
 from miro.test.iconcachetest import *
 from miro.test.databasetest import *
 from miro.test.itemtest import *
+from miro.test.moviedatatest import *
 from miro.test.filetypestest import *
 from miro.test.cellpacktest import *
 
@@ -1,4 +1,5 @@
 import os
+import threading
 
 from miro.test.framework import MiroTestCase
 
@@ -145,3 +146,198 @@ class FFMpeg2TheoraConversionTaskTest(MiroTestCase):
         finally:
             f.close()
         
+
+class FakeConverterInfo(object):
+    name = u'Fake Converter'
+
+class FakeConversionTask(object):
+    def __init__(self, key, tempdir):
+        self.key = key
+        self.thread = None
+        self.error = None
+        self.interrupted = False
+        self.process_exited = threading.Event()
+        self.converter_info = FakeConverterInfo()
+        self.item_info = None
+        self.create_item = False
+        self.final_output_path = os.path.join(tempdir, key)
+        self.temp_output_path = os.path.join(tempdir, key + '.tmp')
+
+    def run(self):
+        self.thread = threading.Thread(target=self.process_exited.wait)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def finish(self):
+        self.process_exited.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def is_pending(self):
+        return self.thread is None
+
+    def is_running(self):
+        return self.thread is not None and self.thread.isAlive()
+
+    def done_running(self):
+        return self.thread is not None and not self.thread.isAlive()
+
+    def is_failed(self):
+        return self.error is not None
+
+    def is_finished(self):
+        return self.done_running() and not self.is_failed()
+
+    def interrupt(self):
+        self.interrupted = True
+        self.finish()
+
+class MockConversionManager(conversions.ConversionManager):
+    def __init__(self):
+        conversions.ConversionManager.__init__(self)
+        self.count_notifications = 0
+
+    def _notify_task_changed(self, task):
+        pass
+
+    def _notify_task_removed(self, task):
+        pass
+
+    def _notify_all_tasks_removed(self):
+        pass
+
+    def _notify_tasks_count(self):
+        self.count_notifications += 1
+
+class ConversionManagerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.MAX_CONCURRENT_CONVERSIONS, 3)
+        self.manager = MockConversionManager()
+        self.tasks = [FakeConversionTask('task-%d' % i, self.tempdir)
+                      for i in range(5)]
+
+    def tearDown(self):
+        for task in self.tasks:
+            task.finish()
+        MiroTestCase.tearDown(self)
+
+    def add_tasks(self):
+        for task in self.tasks:
+            self.manager.pending_tasks.append(task)
+            self.manager._enqueue_message("start_pending")
+
+    def run_cycle(self):
+        self.manager._run_loop_cycle(self.manager.message_queue.get_nowait())
+
+    def test_fill_free_slots(self):
+        self.add_tasks()
+        self.run_cycle()
+        # all the messages get handled and every free slot gets filled in
+        # one cycle
+        self.assert_(self.manager.message_queue.empty())
+        self.assertEquals(self.manager.running_tasks_count(), 3)
+        self.assertEquals(self.manager.pending_tasks_count(), 2)
+        self.assertEquals(self.manager.count_notifications, 1)
+
+    def test_task_done(self):
+        self.add_tasks()
+        self.run_cycle()
+        done_task = self.manager.running_tasks[0]
+        done_task.finish()
+        self.manager._task_done(done_task)
+        self.run_cycle()
+        self.assertEquals(self.manager.finished_tasks, [done_task])
+        self.assertEquals(self.manager.running_tasks_count(), 3)
+        self.assertEquals(self.manager.pending_tasks_count(), 1)
+        # the staging message got handled in the same cycle.  There's no
+        # output file, so the task failed.
+        self.assert_(self.manager.message_queue.empty())
+        self.assertNotEquals(done_task.error, None)
+
+    def test_canceled_task_done(self):
+        self.add_tasks()
+        self.run_cycle()
+        task = self.manager.running_tasks[0]
+        self.manager.cancel(task.key)
+        self.manager._task_done(task)
+        self.run_cycle()
+        self.assert_(task.interrupted)
+        self.assertEquals(self.manager.finished_tasks, [])
+        self.assertEquals(self.manager.running_tasks_count(), 3)
+
+    def test_loop(self):
+        self.manager._check_task_loop()
+        thread = self.manager.task_loop
+        self.add_tasks()
+        self.manager.cancel_all()
+        thread.join(10)
+        self.assert_(not thread.isAlive())
+        self.assertEquals(self.manager.running_tasks, [])
+        self.assertEquals(self.manager.pending_tasks, [])
+
+class CacheConverterInfo(object):
+    executable = 'ffmpeg'
+    parameters = '-i {input} -s {ssize} {output}'
+    screen_size = '480x320'
+    extension = 'mp4'
+
+class ConversionCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache = conversions.ConversionCache(
+            os.path.join(self.tempdir, 'cache'))
+        self.converter_info = CacheConverterInfo()
+        self.input_path = self.make_file('input.avi', 'input data')
+
+    def make_file(self, name, data):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_key(self):
+        key = self.cache.calc_key(self.converter_info, self.input_path)
+        self.assertEquals(
+            self.cache.calc_key(self.converter_info, self.input_path), key)
+        # different converter parameters use a different key
+        other_info = CacheConverterInfo()
+        other_info.screen_size = '320x240'
+        self.assertNotEquals(
+            self.cache.calc_key(other_info, self.input_path), key)
+        self.assertEquals(self.cache.calc_key(self.converter_info,
+            os.path.join(self.tempdir, 'missing.avi')), None)
+
+    def test_store_and_lookup(self):
+        self.assertEquals(
+            self.cache.lookup(self.converter_info, self.input_path), None)
+        output_path = self.make_file('output.mp4', 'output data')
+        self.cache.store(self.converter_info, self.input_path, output_path)
+        path = self.cache.lookup(self.converter_info, self.input_path)
+        self.assertEquals(open(path, 'rb').read(), 'output data')
+        # the cache keeps its own copy
+        self.assert_(os.path.exists(output_path))
+        # changing the source file misses the cache
+        self.make_file('input.avi', 'new input data')
+        self.assertEquals(
+            self.cache.lookup(self.converter_info, self.input_path), None)
+
+    def test_shrink(self):
+        app.config.set(prefs.CONVERSION_CACHE_SIZE, 1)
+        output_path = self.make_file('output.mp4', 'x' * 500000)
+        input_paths = [self.make_file('input-%d.avi' % i, 'input %d' % i)
+                       for i in range(2)]
+        for i, input_path in enumerate(input_paths):
+            self.cache.store(self.converter_info, input_path, output_path)
+            os.utime(self.cache.lookup(self.converter_info, input_path),
+                     (i, i))
+        # using the first file makes the second the least recently used
+        self.cache.lookup(self.converter_info, input_paths[0])
+        self.cache.store(self.converter_info, self.input_path, output_path)
+        self.assertNotEquals(
+            self.cache.lookup(self.converter_info, input_paths[0]), None)
+        self.assertEquals(
+            self.cache.lookup(self.converter_info, input_paths[1]), None)
+        self.assertNotEquals(
+            self.cache.lookup(self.converter_info, self.input_path), None)
@@ -127,6 +127,10 @@ devices = [target1]
 
 class DeviceHelperTest(MiroTestCase):
 
+    def tearDown(self):
+        devices._save_managers.clear()
+        MiroTestCase.tearDown(self)
+
     def test_load_database(self):
         data = {u'a': 2,
                 u'b': {u'c': [5, 6]}}
@@ -160,3 +164,152 @@ class DeviceHelperTest(MiroTestCase):
         with open(os.path.join(self.tempdir, '.miro', 'json')) as f:
             new_data = json.load(f)
         self.assertEqual(data, new_data)
+
+    def test_write_database_atomic(self):
+        devices.write_database(self.tempdir, {u'a': 1})
+        devices.write_database(self.tempdir, {u'a': 2})
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, '.miro')),
+                         ['json'])
+        with open(os.path.join(self.tempdir, '.miro', 'json')) as f:
+            self.assertEqual(json.load(f), {u'a': 2})
+
+    def test_delayed_write(self):
+        ddb = devices.load_database(self.tempdir)
+        save_manager = ddb.save_manager
+        ddb[u'a'] = 1
+        write_dc = save_manager.write_dc
+        self.assertNotEqual(write_dc, None)
+        ddb[u'b'] = 2
+        # the second change doesn't schedule another write
+        self.assertEqual(save_manager.write_dc, write_dc)
+        json_path = os.path.join(self.tempdir, '.miro', 'json')
+        self.assertFalse(os.path.exists(json_path))
+
+        devices.flush_database(ddb)
+        self.assert_(write_dc.canceled)
+        with open(json_path) as f:
+            self.assertEqual(json.load(f), {u'a': 1, u'b': 2})
+
+    def test_load_database_flushes(self):
+        old_ddb = devices.load_database(self.tempdir)
+        old_ddb[u'a'] = 1
+        # loading the database again sees the pending change
+        ddb = devices.load_database(self.tempdir)
+        self.assertEqual(dict(ddb), {u'a': 1})
+        # the old database object doesn't get saved anymore
+        self.assertEqual(len(old_ddb.get_callbacks('changed')), 0)
+        old_ddb[u'b'] = 2
+        self.assertEqual(old_ddb.save_manager.write_dc, None)
+        devices.flush_database(ddb)
+
+    def test_discard(self):
+        # once the device is gone, pending changes are dropped
+        ddb = devices.load_database(self.tempdir)
+        ddb[u'a'] = 1
+        write_dc = ddb.save_manager.write_dc
+        ddb.save_manager.discard()
+        self.assert_(write_dc.canceled)
+        self.assertEqual(ddb.save_manager.write_dc, None)
+        self.assertEqual(len(ddb.get_callbacks('changed')), 0)
+        self.assertFalse(os.path.exists(os.path.join(self.tempdir, '.miro')))
+
+    def test_flush_all_databases(self):
+        ddb = devices.load_database(self.tempdir)
+        ddb[u'a'] = 1
+        devices.flush_all_databases()
+        self.assertEqual(ddb.save_manager.write_dc, None)
+        with open(os.path.join(self.tempdir, '.miro', 'json')) as f:
+            self.assertEqual(json.load(f), {u'a': 1})
+
+class FakeDevice(object):
+    def __init__(self, mount):
+        self.mount = mount
+        self.database = devices.DeviceDatabase()
+
+class DeviceScannerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.device = FakeDevice(os.path.join(self.tempdir, ''))
+        os.makedirs(os.path.join(self.tempdir, 'Music', 'Album'))
+        self.make_file('video.mp4')
+        self.make_file('notes.txt')
+        self.make_file(os.path.join('Music', 'Album', 'song.mp3'))
+        # make the directory mtimes old enough to trust
+        for directory in ('', 'Music', os.path.join('Music', 'Album')):
+            self.set_mtime(directory, 1000)
+
+    def make_file(self, path):
+        open(os.path.join(self.tempdir, path), 'w').close()
+
+    def set_mtime(self, directory, mtime):
+        os.utime(os.path.join(self.tempdir, directory), (mtime, mtime))
+
+    def scan(self):
+        scanner = devices.DeviceScanner(self.device)
+        database = self.device.database
+        known_files = set()
+        for item_type in ('video', 'audio', 'other'):
+            for item_path in database.get(item_type, {}):
+                known_files.add(os.path.normcase(item_path))
+        new_index, missing_files, batch = scanner.scan(
+            dict(database.get('directories', {})), known_files)
+        for item_type, ufilename in batch:
+            database.setdefault(item_type, {})[ufilename] = {}
+        database['directories'] = new_index
+        return batch, missing_files
+
+    def test_scan(self):
+        batch, missing_files = self.scan()
+        song_path = os.path.join(u'Music', u'Album', u'song.mp3')
+        self.assertEqual(sorted(batch), [('audio', song_path),
+                                         ('video', u'video.mp4')])
+        self.assertEqual(missing_files, set())
+        self.assertEqual(self.device.database['directories'][u''],
+                         [1000, [os.path.normcase(u'Music')]])
+
+    def test_unchanged_directories_skipped(self):
+        self.scan()
+        # a file added without changing the mtime doesn't get noticed
+        self.make_file(os.path.join('Music', 'Album', 'other.mp3'))
+        self.set_mtime(os.path.join('Music', 'Album'), 1000)
+        self.assertEqual(self.scan(), ([], set()))
+        # once the mtime changes, it does
+        self.set_mtime(os.path.join('Music', 'Album'), 2000)
+        batch, missing_files = self.scan()
+        self.assertEqual(batch, [('audio', os.path.join(u'Music', u'Album',
+                                                        u'other.mp3'))])
+
+    def test_missing_files(self):
+        self.scan()
+        os.remove(os.path.join(self.tempdir, 'video.mp4'))
+        self.set_mtime('', 2000)
+        batch, missing_files = self.scan()
+        self.assertEqual(missing_files, set([u'video.mp4']))
+
+    def test_removed_directory(self):
+        self.scan()
+        os.remove(os.path.join(self.tempdir, 'Music', 'Album', 'song.mp3'))
+        os.rmdir(os.path.join(self.tempdir, 'Music', 'Album'))
+        self.set_mtime('Music', 2000)
+        batch, missing_files = self.scan()
+        self.assertEqual(missing_files,
+                         set([os.path.join(u'Music', u'Album', u'song.mp3')]))
+        self.assertFalse(os.path.normcase(os.path.join(u'Music', u'Album')) in
+                         self.device.database['directories'])
+
+    def test_canceled_scan(self):
+        scanner = devices._scanners[self.device.mount] = devices.DeviceScanner(
+            self.device)
+        result = scanner.scan({}, set())
+        # the device gets disconnected and then connected again
+        del devices._scanners[self.device.mount]
+        scanner.cancel()
+        new_scanner = devices.DeviceScanner(self.device)
+        devices._scanners[self.device.mount] = new_scanner
+        try:
+            scanner._scan_finished(result)
+            self.assertEqual(dict(self.device.database), {})
+            self.assertEqual(devices._scanners[self.device.mount],
+                             new_scanner)
+        finally:
+            del devices._scanners[self.device.mount]
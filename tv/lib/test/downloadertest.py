@@ -1,11 +1,15 @@
 import os
 
 from miro import app
+from miro import download_utils
 from miro import downloader
 from miro import eventloop
 from miro import models
 from miro import prefs
 from miro.dl_daemon import command
+from miro.dl_daemon import daemon
+from miro.dl_daemon import download
+from miro.item import Item, fp_values_for_url
 from miro.test.framework import MiroTestCase, EventLoopTest, uses_httpclient
 
 class DownloaderTest(EventLoopTest):
@@ -73,3 +77,385 @@ class DownloaderTest(EventLoopTest):
     ## def test_resume_fail(self):
     ##     # FIXME - implement this
     ##     pass
+
+class FastResumeDataTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        app.config.set(prefs.SUPPORT_DIRECTORY, self.tempdir)
+        self.info_hash = 'ab' * 20
+
+    def test_save_and_load(self):
+        download_utils.save_fast_resume_data(self.info_hash, 'resume data')
+        self.assertEquals(
+                download_utils.load_fast_resume_data(self.info_hash),
+                'resume data')
+        path = download_utils.fast_resume_path(self.info_hash)
+        self.assert_(path.startswith(self.tempdir))
+        self.assert_(not os.path.exists(path + '.tmp'))
+
+    def test_overwrite(self):
+        download_utils.save_fast_resume_data(self.info_hash, 'old data')
+        download_utils.save_fast_resume_data(self.info_hash, 'new data')
+        self.assertEquals(
+                download_utils.load_fast_resume_data(self.info_hash),
+                'new data')
+
+    def test_missing(self):
+        self.assertEquals(
+                download_utils.load_fast_resume_data(self.info_hash), None)
+        # deleting a missing file shouldn't raise an error
+        download_utils.delete_fast_resume_data(self.info_hash)
+
+    def test_delete(self):
+        download_utils.save_fast_resume_data(self.info_hash, 'resume data')
+        download_utils.delete_fast_resume_data(self.info_hash)
+        self.assert_(not os.path.exists(
+            download_utils.fast_resume_path(self.info_hash)))
+        self.assertEquals(
+                download_utils.load_fast_resume_data(self.info_hash), None)
+
+class FakeBGDownloader(object):
+    def __init__(self, dlid):
+        self.dlid = dlid
+
+class FakeDaemon(object):
+    def __init__(self):
+        self.shutdown = False
+        self.sent = []
+
+    def send(self, comm, callback=None):
+        self.sent.append(comm)
+
+class DownloadStatusUpdaterTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.updater = download.DownloadStatusUpdater()
+        self.downloader = FakeBGDownloader(u'download1')
+        self.old_last_daemon = daemon.LAST_DAEMON
+        daemon.LAST_DAEMON = FakeDaemon()
+
+    def tearDown(self):
+        daemon.LAST_DAEMON = self.old_last_daemon
+        EventLoopTest.tearDown(self)
+
+    def test_forget(self):
+        self.updater.queue_update(self.downloader)
+        self.updater.forget(self.downloader)
+        self.runPendingIdles()
+        self.assertEquals(self.updater.to_update, set())
+        self.assertEquals(len(daemon.LAST_DAEMON.sent), 1)
+        comm = daemon.LAST_DAEMON.sent[0]
+        self.assertEquals(type(comm), command.ForgetDownloadStatusCommand)
+        self.assertEquals(comm.args, (u'download1',))
+
+class StatusUpdateTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.feed = models.Feed(u'http://example.com/1')
+        self.item = Item(fp_values_for_url(u'http://example.com/1/item1'),
+                feed_id=self.feed.id)
+        self.downloader = downloader.RemoteDownloader(
+                u'http://example.com/1/item1/movie.mpeg', self.item)
+        self.item.set_downloader(self.downloader)
+        self.downloader.status = {
+            'dlid': self.downloader.dlid,
+            'state': u'downloading',
+            'currentSize': 0,
+            'totalSize': 1000,
+            'rate': 0,
+            'upRate': 0,
+            'eta': 0,
+            'dlerType': u'HTTP',
+        }
+        self.downloader.signal_change()
+        self.item_changes = 0
+        self.item_tracker = models.Item.make_view().make_tracker()
+        self.item_tracker.connect('changed', self.on_item_changed)
+
+    def tearDown(self):
+        self.item_tracker.unlink()
+        MiroTestCase.tearDown(self)
+
+    def on_item_changed(self, tracker, obj):
+        self.item_changes += 1
+
+    def update_status(self, **kwargs):
+        status = self.downloader.status.copy()
+        status.update(kwargs)
+        downloader.RemoteDownloader.update_status(status)
+
+    def test_update(self):
+        self.update_status(currentSize=100)
+        self.assertEquals(self.downloader.status['currentSize'], 100)
+        self.assertEquals(self.downloader.status['totalSize'], 1000)
+        self.assertEquals(self.downloader.status['state'], u'downloading')
+        self.assert_('status' in self.downloader.changed_attributes)
+
+    def test_removed_field(self):
+        status = self.downloader.status.copy()
+        del status['eta']
+        downloader.RemoteDownloader.update_status(status)
+        self.assert_('eta' not in self.downloader.status)
+        self.assertEquals(self.item_changes, 1)
+
+    def test_signal_item(self):
+        self.update_status(currentSize=100, rate=100)
+        self.assertEquals(self.item_changes, 1)
+
+    def test_rate_change_not_displayed(self):
+        self.update_status(rate=100, eta=10)
+        self.assertEquals(self.item_changes, 0)
+        self.assertEquals(self.downloader.get_rate(), 100)
+
+    def test_rate_change_displayed(self):
+        display_tracker = models.Item.make_view().make_tracker()
+        downloader.add_item_display_tracker(display_tracker)
+        try:
+            self.update_status(rate=100, eta=10)
+        finally:
+            downloader.remove_item_display_tracker(display_tracker)
+            display_tracker.unlink()
+        self.assertEquals(self.item_changes, 1)
+
+    def test_no_change(self):
+        self.update_status(currentSize=0, rate=0)
+        self.assertEquals(self.item_changes, 0)
+
+class FakeTorrentHandle(object):
+    def __init__(self, info_hash):
+        self._info_hash = info_hash
+        self.paused = False
+
+    def info_hash(self):
+        return self._info_hash
+
+    def pause(self):
+        self.paused = True
+
+    def resume(self):
+        self.paused = False
+
+class FakeTorrentStatus(object):
+    def __init__(self, handle):
+        self.handle = handle
+
+class state_changed_alert(object):
+    def __init__(self, handle):
+        self.handle = handle
+
+class state_update_alert(object):
+    def __init__(self, status):
+        self.status = status
+
+class FakeSession(object):
+    def __init__(self):
+        self.alerts = []
+        self.posted_updates = 0
+
+    def pop_alerts(self):
+        alerts = self.alerts
+        self.alerts = []
+        return alerts
+
+class UpdateAlertSession(FakeSession):
+    def post_torrent_updates(self):
+        self.posted_updates += 1
+
+CHECKING_FILES = download.lt.torrent_status.states.checking_files
+
+class FakeBTDownloader(object):
+    def __init__(self, info_hash, idle=False, state='downloading',
+                 torrent_state=None, leechers=-1, upload_ratio=0.0):
+        self.torrent = FakeTorrentHandle(info_hash)
+        self.idle = idle
+        self.state = state
+        self.torrent_state = torrent_state
+        self.leechers = leechers
+        self.upload_ratio = upload_ratio
+        self.queued = False
+        self.updates = []
+
+    def update_status(self, status=None):
+        self.updates.append(status)
+
+    def is_idle(self):
+        return self.idle
+
+    is_checking = download.BTDownloader.is_checking.im_func
+
+    def get_upload_ratio(self):
+        return self.upload_ratio
+
+    def set_queued(self, queued):
+        self.queued = queued
+
+class TorrentSessionTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.time = 0
+        self.old_clock = download.clock
+        download.clock = lambda: self.time
+        self.torrent_session = download.TorrentSession()
+        self.active = FakeBTDownloader('%040x' % 1)
+        self.seeder = FakeBTDownloader('%040x' % 2, idle=True,
+                                       state='uploading')
+
+    def tearDown(self):
+        download.clock = self.old_clock
+        MiroTestCase.tearDown(self)
+
+    def start_session(self, session):
+        self.torrent_session.session = session
+        self.torrent_session.use_update_alerts = hasattr(session,
+                'post_torrent_updates')
+        self.torrent_session.add_torrent(self.active)
+        self.torrent_session.add_torrent(self.seeder)
+
+    def test_poll_idle_seeders_less(self):
+        self.start_session(FakeSession())
+        self.torrent_session.update_torrents()
+        self.assertEquals(len(self.active.updates), 1)
+        self.assertEquals(len(self.seeder.updates), 1)
+        self.time += 1
+        self.torrent_session.update_torrents()
+        self.assertEquals(len(self.active.updates), 2)
+        self.assertEquals(len(self.seeder.updates), 1)
+        self.time += download.TorrentSession.IDLE_SEEDER_UPDATE_INTERVAL
+        self.torrent_session.update_torrents()
+        self.assertEquals(len(self.active.updates), 3)
+        self.assertEquals(len(self.seeder.updates), 2)
+
+    def test_state_changed_alert(self):
+        self.start_session(FakeSession())
+        self.torrent_session.update_torrents()
+        self.time += 1
+        self.torrent_session.session.alerts.append(
+                state_changed_alert(self.seeder.torrent))
+        self.torrent_session.update_torrents()
+        self.assertEquals(self.seeder.updates, [None, None])
+
+    def test_state_update_alert(self):
+        self.start_session(UpdateAlertSession())
+        self.torrent_session.update_torrents()
+        self.assertEquals(self.torrent_session.session.posted_updates, 1)
+        self.assertEquals(self.active.updates, [])
+        status = FakeTorrentStatus(self.active.torrent)
+        self.torrent_session.session.alerts.append(
+                state_update_alert([status]))
+        self.torrent_session.update_torrents()
+        self.assertEquals(self.active.updates, [status])
+        self.assertEquals(self.seeder.updates, [])
+        self.assertEquals(self.torrent_session.session.posted_updates, 2)
+
+    def test_removed_torrent(self):
+        self.start_session(FakeSession())
+        self.torrent_session.remove_torrent(self.seeder)
+        self.torrent_session.session.alerts.append(
+                state_changed_alert(self.seeder.torrent))
+        self.torrent_session.update_torrents()
+        self.assertEquals(self.seeder.updates, [])
+        self.assertEquals(len(self.active.updates), 1)
+
+class TorrentQueueTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.time = 0
+        self.old_clock = download.clock
+        download.clock = lambda: self.time
+        app.config.set(prefs.BT_ACTIVE_DOWNLOADS_LIMIT, 2)
+        app.config.set(prefs.BT_ACTIVE_SEEDS_LIMIT, 2)
+        self.torrent_session = download.TorrentSession()
+        self.torrent_session.session = FakeSession()
+        self.info_hash_counter = 0
+
+    def tearDown(self):
+        download.clock = self.old_clock
+        MiroTestCase.tearDown(self)
+
+    def add_torrent(self, **kwargs):
+        self.info_hash_counter += 1
+        downloader = FakeBTDownloader('%040x' % self.info_hash_counter,
+                                      **kwargs)
+        self.torrent_session.add_torrent(downloader)
+        return downloader
+
+    def check_queued(self, downloaders, queued):
+        for downloader, expected in zip(downloaders, queued):
+            self.assertEquals(downloader.queued, expected)
+            self.assertEquals(downloader.torrent.paused, expected)
+
+    def test_download_limit(self):
+        downloads = [self.add_torrent() for i in range(4)]
+        self.check_queued(downloads, [False, False, True, True])
+        # a seed doesn't take up a download slot
+        seed = self.add_torrent(state='uploading')
+        self.check_queued([seed], [False])
+        self.torrent_session.remove_torrent(downloads[0])
+        self.torrent_session.manage_queue()
+        self.check_queued(downloads[1:], [False, False, True])
+
+    def test_no_limit(self):
+        app.config.set(prefs.BT_ACTIVE_DOWNLOADS_LIMIT, -1)
+        downloads = [self.add_torrent() for i in range(4)]
+        self.check_queued(downloads, [False] * 4)
+
+    def test_checking_slot(self):
+        checking = [self.add_torrent(torrent_state=CHECKING_FILES)
+                    for i in range(3)]
+        self.check_queued(checking, [False, True, True])
+        checking[0].torrent_state = download.lt.torrent_status.states.seeding
+        self.torrent_session.manage_queue()
+        self.check_queued(checking, [False, False, True])
+
+    def test_waiting_to_check_not_queued(self):
+        # Restored torrents start out with no state, or waiting for
+        # libtorrent to check them.  They shouldn't wait for the checking
+        # slot.
+        app.config.set(prefs.BT_ACTIVE_DOWNLOADS_LIMIT, -1)
+        app.config.set(prefs.BT_ACTIVE_SEEDS_LIMIT, -1)
+        states = download.lt.torrent_status.states
+        torrents = []
+        for i in range(50):
+            torrents.append(self.add_torrent(torrent_state=None))
+            torrents.append(self.add_torrent(state='uploading',
+                    torrent_state=states.queued_for_checking))
+        self.torrent_session.manage_queue()
+        self.check_queued(torrents, [False] * len(torrents))
+
+    def test_finished_check_reruns_queue(self):
+        checking = [self.add_torrent(torrent_state=CHECKING_FILES)
+                    for i in range(2)]
+        self.check_queued(checking, [False, True])
+        self.time = 1
+        def update_status(status=None):
+            checking[0].torrent_state = (
+                    download.lt.torrent_status.states.seeding)
+        checking[0].update_status = update_status
+        self.torrent_session.session.alerts.append(
+                state_changed_alert(checking[0].torrent))
+        self.torrent_session.update_torrents()
+        self.check_queued(checking, [False, False])
+
+    def test_seed_rotation(self):
+        seeds = [self.add_torrent(state='uploading', leechers=0,
+                                  upload_ratio=ratio)
+                 for ratio in (2.0, 1.0, 0.5)]
+        self.check_queued(seeds, [False, False, True])
+        # active seeds keep their slots for a while
+        self.time = download.TorrentSession.SEED_ROTATION_INTERVAL - 1
+        self.torrent_session.manage_queue()
+        self.check_queued(seeds, [False, False, True])
+        # then the seed with the lowest ratio gets a turn
+        self.time = download.TorrentSession.SEED_ROTATION_INTERVAL
+        self.torrent_session.manage_queue()
+        self.check_queued(seeds, [True, False, False])
+
+    def test_seed_demand(self):
+        seeds = [self.add_torrent(state='uploading', leechers=leechers)
+                 for leechers in (0, 0, 3)]
+        self.check_queued(seeds, [False, False, True])
+        self.time = download.TorrentSession.SEED_ROTATION_INTERVAL
+        self.torrent_session.manage_queue()
+        # the seed with peers waiting gets a slot
+        self.assertEquals(seeds[2].queued, False)
+        self.assertEquals(len([s for s in seeds if s.queued]), 1)
@@ -1,7 +1,10 @@
 import logging
 import os
 import unittest
+from miro import app
 from miro import feedparser
+from miro import feedparserpool
+from miro import prefs
 from miro.plat import resources
 
 from miro.test.framework import MiroTestCase
@@ -59,6 +62,117 @@ class FeedParserTest(MiroTestCase):
         # this should kick up a KeyError and NOT a TypeError
         self.assertRaises(KeyError, lambda: d['url'])
 
+class FeedParserPoolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.path = os.path.join(FEEDPARSERTESTS, "ooze.rss")
+
+    def tearDown(self):
+        feedparserpool.shutdown()
+        MiroTestCase.tearDown(self)
+
+    def check_parsed(self, parsed):
+        expected = feedparserpool.parse_in_process(self.path)
+        self.assert_(isinstance(parsed, feedparser.FeedParserDict))
+        self.assertEquals(parsed.feed.title, expected.feed.title)
+        self.assertEquals(len(parsed.entries), len(expected.entries))
+        for entry, expected_entry in zip(parsed.entries, expected.entries):
+            self.assert_(isinstance(entry, feedparser.FeedParserDict))
+            self.assertEquals(entry.get('title'), expected_entry.get('title'))
+            self.assertEquals(entry.get('enclosures'),
+                              expected_entry.get('enclosures'))
+            for value in entry.values():
+                self.assert_(not isinstance(value, str))
+
+    def test_parse(self):
+        self.check_parsed(feedparserpool.parse(self.path))
+
+    def test_in_process_fallback(self):
+        app.config.set(prefs.FEEDPARSER_PROCESSES, 0)
+        self.check_parsed(feedparserpool.parse(self.path))
+        self.assertEquals(feedparserpool._feedparser_pool.pool, None)
+
+    def test_serialize(self):
+        data = feedparserpool._parse_and_serialize(self.path)
+        self.check_parsed(feedparserpool.unserialize(data))
+
+class FakeResult(object):
+    def ready(self):
+        return False
+
+    def wait(self, timeout):
+        pass
+
+class FakePool(object):
+    def __init__(self, process_count):
+        self.terminated = False
+
+    def terminate(self):
+        self.terminated = True
+
+    def join(self):
+        pass
+
+class FeedParserPoolRetireTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.old_pool_class = feedparserpool.multiprocessing.Pool
+        feedparserpool.multiprocessing.Pool = FakePool
+        self.pool = feedparserpool.FeedParserPool()
+        self.old_shutdown_wait = feedparserpool.SHUTDOWN_WAIT
+
+    def tearDown(self):
+        feedparserpool.multiprocessing.Pool = self.old_pool_class
+        feedparserpool.SHUTDOWN_WAIT = self.old_shutdown_wait
+        MiroTestCase.tearDown(self)
+
+    def test_retire_waits_for_other_parses(self):
+        stuck = self.pool._acquire_pool()
+        other = self.pool._acquire_pool()
+        self.assert_(stuck is other)
+        # the stuck parse times out
+        self.pool._retire_pool(stuck)
+        self.pool._release_pool(stuck)
+        self.assert_(not stuck.terminated)
+        # new parses get a new pool
+        new_pool = self.pool._acquire_pool()
+        self.assert_(new_pool is not stuck)
+        # the old pool goes away when the other parse finishes
+        self.pool._release_pool(other)
+        self.assert_(stuck.terminated)
+        self.assert_(not new_pool.terminated)
+
+    def test_retire_unused(self):
+        pool = self.pool._acquire_pool()
+        self.pool._release_pool(pool)
+        self.pool._retire_pool(pool)
+        self.assert_(pool.terminated)
+        self.assertEquals(self.pool.users, {})
+
+    def test_shutdown_waits_for_parses(self):
+        busy = self.pool._acquire_pool()
+        self.pool._retire_pool(busy)
+        idle = self.pool._acquire_pool()
+        self.pool._release_pool(idle)
+        self.pool.shutdown()
+        self.assert_(idle.terminated)
+        self.assert_(not busy.terminated)
+        # the running parse finishes normally
+        self.pool._release_pool(busy)
+        self.assert_(busy.terminated)
+        self.assertEquals(self.pool.users, {})
+        self.assertEquals(self.pool.retired, set())
+        self.assertEquals(self.pool.closing, set())
+
+    def test_shutdown_cuts_wait_short(self):
+        feedparserpool.SHUTDOWN_WAIT = 0
+        pool = self.pool._acquire_pool()
+        self.pool.shutdown()
+        self.assertRaises(feedparserpool.multiprocessing.TimeoutError,
+                self.pool._wait, pool, FakeResult(), 3600)
+        self.pool._release_pool(pool)
+        self.assert_(pool.terminated)
+
 # FIXME - could use way more feedparser tests
 
 if __name__ == "__main__":
@@ -10,6 +10,7 @@ from miro import dialogs
 from miro import database
 from miro import storedatabase
 from miro import feedparserutil
+from miro import feed as feed_mod
 from miro.plat import resources
 from miro.item import Item
 from miro.feed import validate_feed_url, normalize_feed_url, Feed
@@ -290,6 +291,85 @@ class EnclosureFeedTestCase(FeedTestCase):
         self.assertEqual(len(items), 4)
         my_feed.remove()
 
+class GuidlessFeedTestCase(FeedTestCase):
+    def write_feed(self, titles):
+        items = []
+        for i, title in enumerate(titles):
+            items.append("""\
+<item>
+ <title>%s</title>
+ <enclosure url="http://downhillbattle.org/key/gallery/%s.mpg" />
+</item>
+""" % (title, i))
+        self.write_file("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Downhill Battle Pics</title>
+%s
+   </channel>
+</rss>""" % "".join(items))
+
+class GuidlessFeedUpdateTest(GuidlessFeedTestCase):
+    # Test matching entries without guids to existing items
+    def test_same_content(self):
+        self.write_feed(['Bumper Sticker', 'T-shirt'])
+        feed = self.make_feed()
+        ids = set(i.id for i in Item.make_view())
+        self.assertEquals(len(ids), 2)
+        self.update_feed(feed)
+        self.assertEquals(set(i.id for i in Item.make_view()), ids)
+
+    def test_changed_title(self):
+        self.write_feed(['Bumper Sticker', 'T-shirt'])
+        feed = self.make_feed()
+        ids = set(i.id for i in Item.make_view())
+        # change the titles, the enclosures should still match the entries
+        # to the items we already have
+        self.write_feed(['Bumper Sticker 2', 'T-shirt 2'])
+        self.update_feed(feed)
+        items = list(Item.make_view())
+        self.assertEquals(set(i.id for i in items), ids)
+        self.assertEquals(set(i.entry_title for i in items),
+                          set([u'Bumper Sticker 2', u'T-shirt 2']))
+
+class DigestTest(GuidlessFeedTestCase):
+    # Test skipping work for feed bodies and entries we've already seen
+    def test_unchanged_body(self):
+        self.write_feed(['Bumper Sticker', 'T-shirt'])
+        feed = self.make_feed()
+        self.assertNotEquals(feed.actualFeed.body_digest, None)
+        for item in Item.make_view():
+            self.assertNotEquals(item.entry_digest, None)
+        unchanged = feed_mod._body_digest_stats['unchanged']
+        self.update_feed(feed)
+        self.assertEquals(feed_mod._body_digest_stats['unchanged'],
+                          unchanged + 1)
+        # a changed body should be parsed
+        self.write_feed(['Bumper Sticker', 'T-shirt', 'Flyer'])
+        self.update_feed(feed)
+        self.assertEquals(feed_mod._body_digest_stats['unchanged'],
+                          unchanged + 1)
+        self.assertEquals(Item.make_view().count(), 3)
+
+    def test_clean_old_items_resets_digest(self):
+        self.write_feed(['Bumper Sticker', 'T-shirt'])
+        feed = self.make_feed()
+        feed.actualFeed.clean_old_items()
+        self.assertEquals(feed.actualFeed.body_digest, None)
+
+    def test_unchanged_entries(self):
+        self.write_feed(['Bumper Sticker', 'T-shirt'])
+        feed = self.make_feed()
+        digests = dict((i.id, i.entry_digest) for i in Item.make_view())
+        self.write_feed(['Bumper Sticker', 'T-shirt 2'])
+        self.update_feed(feed)
+        items = dict((i.entry_title, i) for i in Item.make_view())
+        self.assertEquals(len(items), 2)
+        sticker = items[u'Bumper Sticker']
+        tshirt = items[u'T-shirt 2']
+        self.assertEquals(sticker.entry_digest, digests[sticker.id])
+        self.assertNotEquals(tshirt.entry_digest, digests[tshirt.id])
+
 class OldItemExpireTest(FeedTestCase):
     # Test that old items expire when the feed gets too big
     def setUp(self):
@@ -0,0 +1,247 @@
+import BaseHTTPServer
+import SocketServer
+import threading
+import time
+
+from miro import eventloop
+from miro import feedupdate
+from miro import httpclient
+from miro import signals
+from miro.clock import clock
+from miro.test.framework import EventLoopTest, uses_httpclient
+
+class FakeFeed(signals.SignalEmitter):
+    def __init__(self, id, url):
+        signals.SignalEmitter.__init__(self, 'update-finished', 'removed')
+        self.id = id
+        self.url = url
+        self.update_count = 0
+
+    def get_title(self):
+        return u"Feed %s" % self.id
+
+    def get_url(self):
+        return self.url
+
+    def update(self):
+        self.update_count += 1
+
+    def finish_update(self):
+        self.emit('update-finished')
+
+class FeedUpdateQueueTest(EventLoopTest):
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.current_time = 0.0
+        self.real_clock = feedupdate.clock
+        feedupdate.clock = lambda: self.current_time
+
+    def tearDown(self):
+        feedupdate.clock = self.real_clock
+        EventLoopTest.tearDown(self)
+
+    def make_feeds(self, count, host='example.com', start_id=0):
+        return [FakeFeed(i, u'http://%s/feed%d.rss' % (host, i))
+                for i in xrange(start_id, start_id + count)]
+
+    def queue_feeds(self, feeds):
+        for feed in feeds:
+            self.queue.schedule_update(0, feed, feed.update)
+        scheduler = eventloop._eventloop.scheduler
+        while scheduler.has_pending_timeout():
+            scheduler.process_next_timeout()
+
+    def test_per_host_limit(self):
+        feeds = self.make_feeds(5)
+        self.queue_feeds(feeds)
+        self.assertEquals(len(self.queue.currently_updating),
+                feedupdate.MAX_UPDATES_PER_HOST)
+        self.assertEquals(len(self.queue.update_queue),
+                5 - feedupdate.MAX_UPDATES_PER_HOST)
+        # finishing an update lets the next feed from the host run
+        feeds[0].finish_update()
+        self.assertEquals(feeds[feedupdate.MAX_UPDATES_PER_HOST].update_count,
+                1)
+
+    def test_other_hosts_not_blocked(self):
+        busy_feeds = self.make_feeds(5, host='busy.example.com')
+        other_feed = FakeFeed(100, u'http://other.example.com/feed.rss')
+        self.queue_feeds(busy_feeds + [other_feed])
+        self.assertEquals(other_feed.update_count, 1)
+
+    def test_global_limit(self):
+        feeds = []
+        for i in xrange(10):
+            feeds.extend(self.make_feeds(1, host='host%d.com' % i,
+                start_id=i))
+        self.queue_feeds(feeds)
+        self.assertEquals(len(self.queue.currently_updating),
+                feedupdate.MIN_UPDATES)
+
+    def test_no_host(self):
+        feeds = [FakeFeed(i, u'dtv:search') for i in xrange(5)]
+        self.queue_feeds(feeds)
+        self.assertEquals(len(self.queue.currently_updating),
+                feedupdate.MIN_UPDATES)
+
+    def test_priority(self):
+        feeds = []
+        for i in xrange(6):
+            feeds.extend(self.make_feeds(1, host='host%d.com' % i,
+                start_id=i))
+        self.queue.set_priority(5, True)
+        self.queue_feeds(feeds)
+        # once a slot opens up, the priority feed should go first.  Make
+        # the update slow, so that the limit doesn't go up.
+        self.current_time += feedupdate.TARGET_LATENCY * 2
+        feeds[0].finish_update()
+        self.assertEquals(feeds[5].update_count, 1)
+        self.assertEquals(feeds[3].update_count, 0)
+        self.queue.set_priority(5, False)
+        self.assertEquals(self.queue.priority_feed_ids, set())
+
+    def test_limit_adapts(self):
+        feeds = []
+        for i in xrange(30):
+            feeds.extend(self.make_feeds(1, host='host%d.com' % i,
+                start_id=i))
+        self.queue_feeds(feeds)
+        # fast updates raise the limit
+        for i in xrange(10):
+            self.current_time += 0.1
+            list(self.queue.currently_updating)[0].finish_update()
+        self.assertEquals(self.queue.max_updates, feedupdate.MAX_UPDATES)
+        self.assertEquals(len(self.queue.currently_updating),
+                feedupdate.MAX_UPDATES)
+        # slow updates lower it
+        self.current_time += feedupdate.TARGET_LATENCY * 20
+        list(self.queue.currently_updating)[0].finish_update()
+        self.assert_(self.queue.max_updates < feedupdate.MAX_UPDATES)
+
+    def test_jitter(self):
+        feed = FakeFeed(0, u'http://example.com/')
+        self.queue.schedule_update(100, feed, feed.update)
+        timeout = self.queue.timeouts[feed.id]
+        for scheduled_time, dc in eventloop._eventloop.scheduler.heap:
+            if dc is timeout:
+                delay = scheduled_time - clock()
+        self.assert_(100 * (1 - feedupdate.JITTER) - 1 < delay <
+                100 * (1 + feedupdate.JITTER) + 1)
+
+    def test_cancel(self):
+        feed = FakeFeed(0, u'http://example.com/')
+        self.queue.schedule_update(100, feed, feed.update)
+        self.queue.cancel_update(feed)
+        self.assertEquals(self.queue.timeouts, {})
+
+    def test_removed(self):
+        feeds = self.make_feeds(3)
+        self.queue_feeds(feeds)
+        feeds[0].emit('removed')
+        self.assertEquals(feeds[2].update_count, 1)
+        self.assertEquals(self.queue.host_counts,
+                {'example.com': feedupdate.MAX_UPDATES_PER_HOST})
+
+class StubFeedHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.lock.acquire()
+        try:
+            host = self.headers.get('Host', '').split(':')[0]
+            server.active[host] = server.active.get(host, 0) + 1
+            server.max_active[host] = max(server.max_active.get(host, 0),
+                    server.active[host])
+        finally:
+            server.lock.release()
+        time.sleep(server.latency)
+        body = '<rss version="2.0"><channel></channel></rss>'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/rss+xml')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        server.lock.acquire()
+        try:
+            server.active[host] -= 1
+        finally:
+            server.lock.release()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubFeedServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    """HTTP server that responds to every request with an empty feed
+    after a delay.  Tracks the number of simultaneous requests for each
+    host name used to connect to it.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency, handler_class=StubFeedHandler):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                handler_class)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.active = {}
+        self.max_active = {}
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+class HTTPFeed(FakeFeed):
+    def update(self):
+        FakeFeed.update(self)
+        httpclient.grab_url(self.url, self.on_grab, self.on_grab)
+
+    def on_grab(self, info):
+        self.finish_update()
+
+class FeedUpdateSimulationTest(EventLoopTest):
+    """Run a bunch of feed updates against a local server that uses 2
+    host names (localhost and 127.0.0.1).
+    """
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.server = StubFeedServer(latency=0.05)
+        self.server.start()
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.finished_count = 0
+
+    def tearDown(self):
+        self.server.stop()
+        EventLoopTest.tearDown(self)
+
+    def on_update_finished(self, feed):
+        self.finished_count += 1
+        if self.finished_count == len(self.feeds):
+            self.stopEventLoop(abnormal=False)
+
+    @uses_httpclient
+    def test_simulation(self):
+        port = self.server.server_address[1]
+        self.feeds = []
+        for i in xrange(20):
+            if i % 2:
+                host = 'localhost'
+            else:
+                host = '127.0.0.1'
+            feed = HTTPFeed(i, u'http://%s:%d/feed%d.rss' % (host, port, i))
+            feed.connect('update-finished', self.on_update_finished)
+            self.feeds.append(feed)
+            self.queue.schedule_update(0, feed, feed.update)
+        self.runEventLoop(timeout=20)
+        self.assertEquals(self.finished_count, 20)
+        for feed in self.feeds:
+            self.assertEquals(feed.update_count, 1)
+        for host in ('localhost', '127.0.0.1'):
+            self.assert_(self.server.max_active[host] <=
+                    feedupdate.MAX_UPDATES_PER_HOST)
+        self.assertEquals(self.queue.currently_updating, set())
+        self.assertEquals(self.queue.host_counts, {})
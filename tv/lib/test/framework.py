@@ -178,9 +178,9 @@ class MiroTestCase(unittest.TestCase):
         os.close(handle)
         return filename
 
-    def start_http_server(self):
+    def start_http_server(self, threaded=False):
         self.stop_http_server()
-        self.httpserver = testhttpserver.HTTPServer()
+        self.httpserver = testhttpserver.HTTPServer(threaded)
         self.httpserver.start()
 
     def last_http_info(self, info_name):
@@ -319,10 +319,10 @@ class EventLoopTest(MiroTestCase):
                     eventloop._eventloop.urgent_queue.queue.empty())
 
     def processThreads(self):
-        eventloop._eventloop.threadpool.init_threads()
-        while not eventloop._eventloop.threadpool.queue.empty():
+        eventloop._eventloop.threadpools.init_threads()
+        while not eventloop._eventloop.threadpools.all_queues_empty():
             sleep(0.05)
-        eventloop._eventloop.threadpool.close_threads()
+        eventloop._eventloop.threadpools.close_threads()
 
     def process_idles(self):
         eventloop._eventloop.idle_queue.process_idles()
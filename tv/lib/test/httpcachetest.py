@@ -0,0 +1,209 @@
+import os
+
+from miro import httpcache
+from miro import httpclient
+from miro.test.framework import MiroTestCase, uses_httpclient
+from miro.test.httpclienttest import HTTPClientTestBase, TEST_BODY
+
+class ExpirationTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.now = 1000000000
+
+    def check_expiration(self, info, expected):
+        self.assertEquals(httpcache.calc_expiration(info, self.now),
+                expected)
+
+    def test_parse_cache_control(self):
+        self.assertEquals(httpcache.parse_cache_control(
+            'max-age=60, no-cache, private="foo"'),
+            {'max-age': '60', 'no-cache': None, 'private': 'foo'})
+        self.assertEquals(httpcache.parse_cache_control(None), {})
+
+    def test_max_age(self):
+        self.check_expiration({'cache-control': 'max-age=60'},
+                self.now + 60)
+
+    def test_no_store(self):
+        self.check_expiration({'cache-control': 'no-store, max-age=60',
+            'etag': 'abc'}, None)
+
+    def test_no_cache(self):
+        self.check_expiration({'cache-control': 'no-cache, max-age=60',
+            'etag': 'abc'}, self.now)
+
+    def test_expires(self):
+        # Expires is relative to the Date header
+        self.check_expiration({
+            'date': 'Sun, 09 Sep 2001 01:45:40 GMT',
+            'expires': 'Sun, 09 Sep 2001 01:47:40 GMT',
+            }, self.now + 120)
+
+    def test_heuristic(self):
+        self.check_expiration({
+            'date': 'Sun, 09 Sep 2001 01:45:40 GMT',
+            'last-modified': 'Sun, 09 Sep 2001 00:45:40 GMT',
+            }, self.now + 360)
+        self.check_expiration({
+            'date': 'Sun, 09 Sep 2001 01:45:40 GMT',
+            'last-modified': 'Sun, 09 Sep 2000 01:45:40 GMT',
+            }, self.now + httpcache.MAX_HEURISTIC_FRESHNESS)
+
+    def test_no_validators(self):
+        self.check_expiration({}, None)
+        self.check_expiration({'etag': 'abc'}, self.now)
+
+class HTTPCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.directory = os.path.join(self.tempdir, 'http-cache')
+        self.cache = httpcache.HTTPCache(self.directory, 1000)
+
+    def make_info(self, **headers):
+        info = {'status': 200, 'cache-control': 'max-age=60'}
+        info.update(headers)
+        return info
+
+    def test_store(self):
+        self.cache.store('http://example.com/', self.make_info(),
+                body='abc')
+        entry = self.cache.get('http://example.com/')
+        self.assert_(entry.is_fresh())
+        self.assertEquals(self.cache.read_body(entry), 'abc')
+        self.assertEquals(self.cache.get_stats()['size'], 3)
+
+    def test_reload(self):
+        self.cache.store('http://example.com/', self.make_info(),
+                body='abc')
+        cache = httpcache.HTTPCache(self.directory, 1000)
+        entry = cache.get('http://example.com/')
+        self.assertEquals(cache.read_body(entry), 'abc')
+        self.assertEquals(entry.info['cache-control'], 'max-age=60')
+
+    def test_not_stored(self):
+        self.cache.store('http://example.com/',
+                self.make_info(**{'cache-control': 'no-store'}), body='abc')
+        self.cache.store('http://example.com/2',
+                {'status': 404, 'etag': 'abc'}, body='abc')
+        # too big
+        self.cache.store('http://example.com/3', self.make_info(),
+                body='a' * 500)
+        self.assertEquals(self.cache.get_stats()['entries'], 0)
+
+    def test_evict_least_recently_used(self):
+        for i in xrange(10):
+            self.cache.store('http://example.com/%d' % i, self.make_info(),
+                    body='a' * 100)
+            self.cache.entries['http://example.com/%d' % i].last_access = i
+        self.cache.touch(self.cache.get('http://example.com/0'))
+        self.cache.store('http://example.com/new', self.make_info(),
+                body='a' * 100)
+        self.assertNotEquals(self.cache.get('http://example.com/0'), None)
+        self.assertEquals(self.cache.get('http://example.com/1'), None)
+        self.assertNotEquals(self.cache.get('http://example.com/2'), None)
+        stats = self.cache.get_stats()
+        self.assertEquals(stats['evictions'], 1)
+        self.assertEquals(stats['size'], 1000)
+        self.assertEquals(len(os.listdir(self.directory)), 20)
+
+    def test_revalidated(self):
+        self.cache.store('http://example.com/',
+                self.make_info(**{'cache-control': 'no-cache', 'etag': 'a'}),
+                body='abc')
+        entry = self.cache.get('http://example.com/')
+        self.assert_(not entry.is_fresh())
+        self.cache.revalidated(entry, {'status': 304,
+            'cache-control': 'max-age=60'})
+        self.assert_(entry.is_fresh())
+        self.assertEquals(self.cache.get_stats()['revalidations'], 1)
+
+class GrabURLCacheTest(HTTPClientTestBase):
+    def setUp(self):
+        HTTPClientTestBase.setUp(self)
+        httpcache.init(os.path.join(self.tempdir, 'http-cache'), 100000)
+
+    def tearDown(self):
+        httpcache.cache = None
+        HTTPClientTestBase.tearDown(self)
+
+    @uses_httpclient
+    def test_hit(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], TEST_BODY)
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.grab_url_info['body'], TEST_BODY)
+        stats = httpcache.get_stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['hits'], 1)
+
+    @uses_httpclient
+    def test_hit_with_validators(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, use_cache=True)
+        modified = self.grab_url_info['last-modified']
+        self.grab_url(url, use_cache=True, modified=modified)
+        self.assertEquals(self.grab_url_info['status'], 304)
+        self.assert_('body' not in self.grab_url_info)
+
+    @uses_httpclient
+    def test_revalidate(self):
+        # The test server's Last-Modified header is newer than its Date
+        # header, so the response is stale right away.
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, use_cache=True)
+        self.grab_url(url, use_cache=True)
+        self.assertEquals(self.last_http_info('headers')['if-modified-since'],
+                self.grab_url_info['last-modified'])
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.grab_url_info['body'], TEST_BODY)
+        stats = httpcache.get_stats()
+        self.assertEquals(stats['misses'], 1)
+        self.assertEquals(stats['revalidations'], 1)
+
+    @uses_httpclient
+    def test_entry_removed_during_revalidation(self):
+        # If the entry goes away while we're revalidating it, the caller
+        # still gets a full response, not the server's 304.
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, use_cache=True)
+        self.grab_url_error = self.grab_url_info = None
+        self.client = httpclient.grab_url(url, self.grab_url_callback,
+                self.grab_url_errback, use_cache=True)
+        first_transfer = self.client.transfer
+        httpcache.cache.remove(url)
+        self.runEventLoop(timeout=self.event_loop_timeout)
+        self.assertEquals(self.grab_url_info['status'], 200)
+        self.assertEquals(self.grab_url_info['body'], TEST_BODY)
+        # the caller's client controls the new request
+        self.assert_(self.client.transfer is not first_transfer)
+
+    @uses_httpclient
+    def test_write_file(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        url = self.httpserver.build_url('test.txt')
+        for i in xrange(2):
+            filename = self.make_temp_path(".txt")
+            self.grab_url(url, use_cache=True, write_file=filename)
+            self.assert_('body' not in self.grab_url_info)
+            self.assertEquals(open(filename).read(), TEST_BODY)
+        self.assertEquals(httpcache.get_stats()['hits'], 1)
+
+    @uses_httpclient
+    def test_grab_headers(self):
+        self.httpserver.add_header('Cache-Control', 'max-age=3600')
+        url = self.httpserver.build_url('test.txt')
+        self.grab_url(url, use_cache=True)
+        self.grab_headers(url, use_cache=True)
+        self.assertEquals(self.grab_url_info['body'], '')
+        self.assertEquals(self.grab_url_info['cache-control'],
+                'max-age=3600')
+        self.assertEquals(httpcache.get_stats()['hits'], 1)
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, httpclient.grab_url,
+                'http://example.com/', self.grab_url_callback,
+                self.grab_url_errback, use_cache=True, resume=True)
@@ -1,4 +1,6 @@
+import errno
 import functools
+import hashlib
 import rfc822
 import os
 import pycurl
@@ -13,7 +15,8 @@ from miro import httpclient
 from miro import signals
 from miro.plat import resources
 from miro.test import mock
-from miro.test.framework import EventLoopTest, uses_httpclient
+from miro.test.framework import (EventLoopTest, MiroTestCase,
+        uses_httpclient)
 
 from miro.gtcache import gettext as _
 
@@ -106,9 +109,9 @@ class HTTPClientTest(HTTPClientTestBase):
     @uses_httpclient
     def test_etag(self):
         self.grab_url(self.httpserver.build_url('test.txt'))
-        self.check_header_not_present('etag')
+        self.check_header_not_present('if-none-match')
         self.grab_url(self.httpserver.build_url('test.txt'), etag='abcdef')
-        self.check_header('etag', 'abcdef')
+        self.check_header('if-none-match', 'abcdef')
 
     @uses_httpclient
     def test_modified(self):
@@ -373,6 +376,139 @@ class HTTPClientTest(HTTPClientTestBase):
         self.assert_('body' not in self.grab_url_info)
         self.assertEquals(open(filename).read(), TEST_BODY)
 
+    @uses_httpclient
+    def test_write_file_preallocate(self):
+        calls = []
+        def preallocate_file(fileobj, offset, length):
+            calls.append((offset, length))
+            return True
+        old_preallocate_file = httpclient.utils.preallocate_file
+        httpclient.utils.preallocate_file = preallocate_file
+        try:
+            filename = self.make_temp_path(".txt")
+            self.grab_url(self.httpserver.build_url('test.txt'),
+                    write_file=filename)
+        finally:
+            httpclient.utils.preallocate_file = old_preallocate_file
+        self.assertEquals(calls, [(0, len(TEST_BODY))])
+        self.assertEquals(open(filename).read(), TEST_BODY)
+
+    @uses_httpclient
+    def test_write_file_disk_full(self):
+        def preallocate_file(fileobj, offset, length):
+            raise IOError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+        old_preallocate_file = httpclient.utils.preallocate_file
+        httpclient.utils.preallocate_file = preallocate_file
+        try:
+            filename = self.make_temp_path(".txt")
+            self.expecting_errback = True
+            self.grab_url(self.httpserver.build_url('test.txt'),
+                    write_file=filename)
+        finally:
+            httpclient.utils.preallocate_file = old_preallocate_file
+        self.check_errback_called()
+        self.assert_(isinstance(self.grab_url_error, httpclient.DiskFull))
+
+    @uses_httpclient
+    def test_body_callback(self):
+        chunks = []
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                body_callback=chunks.append)
+        self.assert_('body' not in self.grab_url_info)
+        self.assertEquals(''.join(chunks), TEST_BODY)
+
+    @uses_httpclient
+    def test_body_buffer(self):
+        body = httpclient.BodyBuffer()
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                body_callback=body.write)
+        self.assertEquals(body.size, len(TEST_BODY))
+        self.assertEquals(body.hexdigest(),
+                hashlib.sha1(TEST_BODY).hexdigest())
+        self.assertEquals(body.getvalue(), TEST_BODY)
+
+    @uses_httpclient
+    def test_handle_reuse(self):
+        httpclient.curl_manager.reset_connection_stats()
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        stats = httpclient.get_connection_stats()
+        self.assertEquals(stats['handles_created'], 1)
+        self.assertEquals(stats['handles_reused'], 1)
+        self.assertEquals(len(httpclient.curl_manager.idle_handles), 1)
+
+    @uses_httpclient
+    def test_connection_reuse(self):
+        httpclient.curl_manager.reset_connection_stats()
+        for i in xrange(3):
+            self.grab_url(self.httpserver.build_url('test.txt'))
+            self.assertEquals(self.grab_url_info['body'], TEST_BODY)
+        stats = httpclient.get_connection_stats()
+        self.assertEquals(stats['transfers_finished'], 3)
+        self.assertEquals(stats['connections_created'], 1)
+        self.assertEquals(stats['connections_reused'], 2)
+
+    @uses_httpclient
+    def test_compressed(self):
+        self.httpserver.enable_compression()
+        self.grab_url(self.httpserver.build_url('test.txt'))
+        self.check_header('accept-encoding', httpclient.ACCEPT_ENCODING)
+        self.assertEquals(self.grab_url_info['content-encoding'], 'gzip')
+        self.assertEquals(self.grab_url_info['body'], TEST_BODY)
+        self.assertEquals(self.grab_url_info['content-length'],
+                len(TEST_BODY))
+        self.assertEquals(self.grab_url_info['total-size'], len(TEST_BODY))
+
+    @uses_httpclient
+    def test_compressed_write_file(self):
+        self.httpserver.enable_compression()
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename, compressed=True)
+        self.assertEquals(open(filename).read(), TEST_BODY)
+        self.assertEquals(self.grab_url_info['content-length'],
+                len(TEST_BODY))
+
+    @uses_httpclient
+    def test_no_compression_for_downloads(self):
+        self.httpserver.enable_compression()
+        filename = self.make_temp_path(".txt")
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                write_file=filename)
+        self.check_header_not_present('accept-encoding')
+        self.assert_('content-encoding' not in self.grab_url_info)
+        self.assertEquals(open(filename).read(), TEST_BODY)
+
+    @uses_httpclient
+    def test_body_callback_exception(self):
+        self.httpserver.pause_after(5)
+        self.error_signal_okay = True
+        def body_callback(data):
+            eventloop.add_timeout(0.2, self.stopEventLoop, 'stop download',
+                    args=(False,))
+            1/0
+        self.grab_url(self.httpserver.build_url('test.txt'),
+                body_callback=body_callback)
+        self.assertEquals(self.grab_url_info, None)
+        self.assertEquals(self.grab_url_error, None)
+        self.assert_(self.saw_error)
+
+    @uses_httpclient
+    def test_file_url_write_file(self):
+        path = resources.path("testdata/httpserver/test.txt")
+        filename = self.make_temp_path(".txt")
+        self.grab_url("file://" + path, write_file=filename)
+        self.assert_('body' not in self.grab_url_info)
+        self.assertEquals(open(filename).read(), TEST_BODY)
+
+    @uses_httpclient
+    def test_file_url_body_callback(self):
+        path = resources.path("testdata/httpserver/test.txt")
+        chunks = []
+        self.grab_url("file://" + path, body_callback=chunks.append)
+        self.assert_('body' not in self.grab_url_info)
+        self.assertEquals(''.join(chunks), TEST_BODY)
+
     def _write_partial_file(self, filename):
         # Write the start of test.txt to a file to test HTTP resume capability
         fp = open(filename, 'w')
@@ -471,6 +607,194 @@ class HTTPClientTest(HTTPClientTestBase):
         self.wait_for_libcurl_manager()
         self.assert_(not os.path.exists(filename))
 
+class FakeFile(object):
+    def __init__(self):
+        self.writes = []
+        self.closed = False
+
+    def write(self, data):
+        self.writes.append(data)
+
+    def close(self):
+        self.closed = True
+
+class FileWriteBufferTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.output = FakeFile()
+        self.writes = self.output.writes
+
+    def test_buffer_size(self):
+        buf = httpclient.FileWriteBuffer(self.output, 10,
+                flush_interval=1000)
+        for i in xrange(5):
+            buf.write('abc')
+        # we should have written 12 bytes in one chunk after the 4th write
+        self.assertEquals(self.writes, ['abcabcabcabc'])
+        buf.close()
+        self.assertEquals(self.writes, ['abcabcabcabc', 'abc'])
+        self.assertEquals(buf.write_count, 2)
+        self.assert_(self.output.closed)
+
+    def test_flush_interval(self):
+        buf = httpclient.FileWriteBuffer(self.output, 1000, flush_interval=0)
+        buf.write('abc')
+        buf.write('def')
+        self.assertEquals(self.writes, ['abc', 'def'])
+
+    def test_flush_if_stale(self):
+        buf = httpclient.FileWriteBuffer(self.output, 1000,
+                flush_interval=1000)
+        buf.write('abc')
+        buf.flush_if_stale()
+        self.assertEquals(self.writes, [])
+        buf.flush_interval = 0
+        buf.flush_if_stale()
+        self.assertEquals(self.writes, ['abc'])
+
+class FakeBandwidthHandle(object):
+    def __init__(self):
+        self.size = 0
+        self.options = {}
+
+    def getinfo(self, info):
+        if info == pycurl.SIZE_DOWNLOAD:
+            return float(self.size)
+        raise ValueError(info)
+
+    def setopt(self, option, value):
+        self.options[option] = value
+
+class FakeBandwidthTransfer(object):
+    def __init__(self, bulk):
+        self.options = httpclient.TransferOptions('http://example.com/',
+                bulk=bulk)
+        self.handle = FakeBandwidthHandle()
+        self.rate_limit = 0
+
+    def limit(self):
+        return self.handle.options.get(pycurl.MAX_RECV_SPEED_LARGE)
+
+class BandwidthSchedulerTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.now = 100.0
+        self.real_clock = httpclient.clock
+        httpclient.clock = lambda: self.now
+        self.scheduler = httpclient.BandwidthScheduler()
+        self.transfers = []
+
+    def tearDown(self):
+        httpclient.clock = self.real_clock
+        MiroTestCase.tearDown(self)
+
+    def make_transfer(self, bulk):
+        transfer = FakeBandwidthTransfer(bulk)
+        self.transfers.append(transfer)
+        return transfer
+
+    def run_update(self, downloaded=None):
+        """Run an update as if 1 second has passed.
+
+        :param downloaded: dict mapping transfers to the number of bytes they
+            downloaded during that second.
+        """
+        if downloaded is not None:
+            for transfer, count in downloaded.items():
+                transfer.handle.size += count
+        self.now += 1.0
+        self.scheduler.update(self.transfers)
+
+    def test_fair_shares(self):
+        self.assertEquals(httpclient.calc_fair_shares(300, [None, 50, None]),
+                [125, 50, 125])
+        self.assertEquals(httpclient.calc_fair_shares(300, [200, 50, 200]),
+                [125, 50, 125])
+        self.assertEquals(httpclient.calc_fair_shares(300, [10, 20]),
+                [10, 20])
+        self.assertEquals(httpclient.calc_fair_shares(300, []), [])
+
+    def test_no_limits(self):
+        bulk = self.make_transfer(bulk=True)
+        self.run_update()
+        self.run_update({bulk: 100000})
+        self.assertEquals(bulk.limit(), None)
+
+    def test_global_limit(self):
+        bulk1 = self.make_transfer(bulk=True)
+        bulk2 = self.make_transfer(bulk=True)
+        self.scheduler.set_limits(100000, 0)
+        self.run_update()
+        self.assertEquals(bulk1.limit(), 50000)
+        self.assertEquals(bulk2.limit(), 50000)
+        # bulk2 is only using 10000 bytes/sec, bulk1 should get the extra
+        # bandwidth.
+        self.run_update({bulk1: 50000, bulk2: 10000})
+        self.assertEquals(bulk2.limit(), 12500)
+        self.assertEquals(bulk1.limit(), 87500)
+
+    def test_interactive_priority(self):
+        bulk = self.make_transfer(bulk=True)
+        interactive = self.make_transfer(bulk=False)
+        self.scheduler.set_limits(100000, 0)
+        self.run_update()
+        self.run_update({bulk: 100000, interactive: 60000})
+        self.assertEquals(interactive.limit(), None)
+        self.assertEquals(bulk.limit(), 40000)
+        # bulk transfers never get starved completely
+        self.run_update({bulk: 40000, interactive: 200000})
+        self.assertEquals(bulk.limit(), httpclient.MIN_BULK_RATE)
+
+    def test_external_interactive_rate(self):
+        bulk = self.make_transfer(bulk=True)
+        interactive = self.make_transfer(bulk=False)
+        self.scheduler.set_limits(100000, 0)
+        self.run_update()
+        self.run_update({bulk: 100000, interactive: 20000})
+        self.assertEquals(self.scheduler.interactive_rate, 20000)
+        # the app process's interactive transfers also come out of the
+        # global limit
+        self.scheduler.set_external_rate(30000)
+        self.scheduler.update(self.transfers)
+        self.assertEquals(bulk.limit(), 50000)
+        self.assertEquals(self.scheduler.interactive_rate, 20000)
+
+    def test_transfer_limit(self):
+        bulk1 = self.make_transfer(bulk=True)
+        bulk2 = self.make_transfer(bulk=True)
+        self.scheduler.set_limits(0, 20000)
+        self.run_update()
+        self.assertEquals(bulk1.limit(), 20000)
+        self.assertEquals(bulk2.limit(), 20000)
+        self.scheduler.set_limits(30000, 20000)
+        self.run_update({bulk1: 20000, bulk2: 20000})
+        self.assertEquals(bulk1.limit(), 15000)
+        self.assertEquals(bulk2.limit(), 15000)
+
+    def test_remove_limits(self):
+        bulk = self.make_transfer(bulk=True)
+        self.scheduler.set_limits(100000, 0)
+        self.run_update()
+        self.assertEquals(bulk.limit(), 100000)
+        self.scheduler.set_limits(0, 0)
+        self.scheduler.update(self.transfers)
+        self.assertEquals(bulk.limit(), 0)
+
+    def test_update_interval(self):
+        bulk = self.make_transfer(bulk=True)
+        self.scheduler.set_limits(100000, 0)
+        self.scheduler.update(self.transfers)
+        self.assertEquals(bulk.limit(), 100000)
+        # adding a transfer doesn't change anything until the interval
+        # passes, or the LibCURLManager sets needs_update
+        bulk2 = self.make_transfer(bulk=True)
+        self.scheduler.update(self.transfers)
+        self.assertEquals(bulk.limit(), 100000)
+        self.scheduler.needs_update = True
+        self.scheduler.update(self.transfers)
+        self.assertEquals(bulk.limit(), 50000)
+        self.assertEquals(bulk2.limit(), 50000)
+
 class HTTPAuthTest(HTTPClientTestBase):
     def setUp(self):
         HTTPClientTestBase.setUp(self)
@@ -548,6 +872,18 @@ class HTTPAuthTest(HTTPClientTestBase):
         self.grab_url(self.httpserver.build_url('protected3/index.txt'))
         self.assertEquals(self.dialogs_seen, 2)
 
+    @uses_httpclient
+    def test_auth_body_callback(self):
+        self.setup_answer("user", "password")
+        url = self.httpserver.build_url('protected/index.txt')
+        body = httpclient.BodyBuffer()
+        self.grab_url(url, body_callback=body.write)
+        # the 401 error page shouldn't end up in the body
+        data = body.getvalue()
+        self.grab_url(url)
+        self.assertEquals(data, self.grab_url_info['body'])
+        self.assertEquals(body.hexdigest(), hashlib.sha1(data).hexdigest())
+
     @uses_httpclient
     def test_digest_auth_failed(self):
         self.expecting_errback = True
@@ -1,6 +1,9 @@
 import os
 import threading
+import time
 
+from miro import app
+from miro import prefs
 from miro import util # This adds logging.timing
 from miro import download_utils
 from miro import httpclient
@@ -33,7 +36,11 @@ class TestingDownloader(download.HTTPDownloader):
         # doesn't exist.
         pass
 
-class HTTPDownloaderTest(EventLoopTest):
+class SegmentedTestingDownloader(TestingDownloader):
+    # our test file is only 45k, so use tiny segments
+    MIN_SEGMENT_SIZE = 4096
+
+class HTTPDownloaderTestBase(EventLoopTest):
     def setUp(self):
         EventLoopTest.setUp(self)
         download.chatter = False
@@ -66,6 +73,8 @@ class HTTPDownloaderTest(EventLoopTest):
         self.wait_for_libcurl_manager()
         return len(httpclient.curl_manager.transfer_map)
 
+class HTTPDownloaderTest(HTTPDownloaderTestBase):
+
 #    Really slow test that downloads a very large file.
 #    def testHuge(self):
 #        url = 'http://archive-c01.libsyn.com/aXdueJh2m32XeGh6l3efp5qtZXiX/podcasts/askaninja/AANQ21.m4v'
@@ -162,3 +171,178 @@ class HTTPDownloaderTest(EventLoopTest):
         self.downloader2.statusCallback = status_callback
         self.runEventLoop()
         self.assert_(not self.restarted)
+
+class SegmentedDownloadTest(HTTPDownloaderTestBase):
+    def setUp(self):
+        HTTPDownloaderTestBase.setUp(self)
+        # use a threaded server so that the segments get downloaded at the
+        # same time
+        self.start_http_server(threaded=True)
+        self.download_url = unicode(
+                self.httpserver.build_url('screen-redirect'))
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS, 4)
+
+    def tearDown(self):
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS,
+                prefs.HTTP_DOWNLOAD_SEGMENTS.default)
+        HTTPDownloaderTestBase.tearDown(self)
+
+    def check_segment_map(self, segment_map):
+        segments = download.parse_segment_map(segment_map)
+        self.assertEquals(segments[0][0], 0)
+        self.assertEquals(max(end for (start, end, done) in segments),
+                self.download_size)
+
+    @uses_httpclient
+    def test_segmented_download(self):
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.downloader.currentSize, self.download_size)
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+        self.assertEquals(self.downloader.get_status()['segmentMap'], None)
+        self.assertEquals(self.countConnections(), 0)
+
+    @uses_httpclient
+    def test_segments_disabled(self):
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS, 1)
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        def check_status():
+            self.assertEquals(self.downloader.segments, [])
+            self.stopOnFinished()
+        self.downloader.statusCallback = check_status
+        self.runEventLoop()
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+
+    @uses_httpclient
+    def test_no_range_support(self):
+        # if the server doesn't send Accept-Ranges, we shouldn't try to use
+        # segments
+        self.httpserver.disable_resume()
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.segments, [])
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+
+    @uses_httpclient
+    def test_range_ignored(self):
+        # if the server says it supports ranges, but sends the whole file
+        # anyway, we should fall back to a normal download instead of
+        # writing the file at each segment's offset
+        self.httpserver.ignore_range()
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assert_(not self.downloader.allow_segments)
+        self.assertEquals(self.downloader.segments, [])
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+
+    @uses_httpclient
+    def test_restore(self):
+        self.httpserver.set_latency(0.05)
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        def pause_in_middle():
+            if (self.downloader.state == 'downloading' and
+                    self.downloader.segments and
+                    0 < self.downloader.currentSize < self.download_size):
+                self.downloader.pause()
+                self.stopEventLoop(False)
+        self.downloader.statusCallback = pause_in_middle
+        self.runEventLoop(timeout=5)
+        self.assertEquals(self.downloader.state, 'paused')
+        self.assertEquals(self.countConnections(), 0)
+        # the file was preallocated
+        self.assertEquals(os.path.getsize(self.downloader.filename),
+                self.download_size)
+        restore = self.downloader.get_status().copy()
+        self.check_segment_map(restore['segmentMap'])
+        restore['state'] = 'downloading'
+        download._downloads = {}
+        self.httpserver.set_latency(0)
+        self.downloader = SegmentedTestingDownloader(self, restore=restore)
+        self.restarted = False
+        def start_new_download_intercept():
+            self.restarted = True
+            self.stopEventLoop(False)
+        self.downloader.start_new_download = start_new_download_intercept
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assert_(not self.restarted)
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+
+    @uses_httpclient
+    def test_bad_segment_map(self):
+        # If the file doesn't match the segment map, we should start over
+        self.downloader = SegmentedTestingDownloader(self, self.download_url,
+                "ID1")
+        self.downloader.pause()
+        restore = self.downloader.get_status().copy()
+        restore['state'] = 'downloading'
+        restore['totalSize'] = self.download_size
+        restore['segmentMap'] = u'0-40000:1000,40000-45572:0'
+        download._downloads = {}
+        self.downloader = SegmentedTestingDownloader(self, restore=restore)
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop()
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+
+    def test_split(self):
+        segment = download.DownloadSegment('/dev/null', 0, 1000, 100,
+                lambda s: 0)
+        self.assertEquals(segment.split(100), (550, 1000))
+        self.assertEquals(segment.end, 550)
+        self.assertEquals(segment.split(300), None)
+        self.assertEquals(segment.end, 550)
+
+    def test_segment_map(self):
+        segments = [
+            download.DownloadSegment('/dev/null', 0, 100, 10, lambda s: 0),
+            download.DownloadSegment('/dev/null', 100, 250, 150, lambda s: 0),
+        ]
+        segment_map = download.format_segment_map(segments)
+        self.assertEquals(segment_map, u'0-100:10,100-250:150')
+        self.assertEquals(download.parse_segment_map(segment_map),
+                [(0, 100, 10), (100, 250, 150)])
+        self.assertRaises(ValueError, download.parse_segment_map, u'')
+        self.assertRaises(ValueError, download.parse_segment_map,
+                u'100-50:0')
+        self.assertRaises(ValueError, download.parse_segment_map,
+                u'0-50:60')
+
+    def time_download(self, downloader_class):
+        download._downloads = {}
+        start = time.time()
+        self.downloader = downloader_class(self, self.download_url, "ID1")
+        self.downloader.statusCallback = self.stopOnFinished
+        self.runEventLoop(timeout=10)
+        self.assertEquals(self.downloader.state, 'finished')
+        self.assertEquals(self.getDownloadedData(),
+                open(self.download_path).read())
+        return time.time() - start
+
+    @uses_httpclient
+    def test_throughput(self):
+        # With latency on each chunk, a single connection is limited by the
+        # round trips.  Several segments should finish significantly faster.
+        self.httpserver.set_latency(0.05)
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS, 1)
+        single_time = self.time_download(TestingDownloader)
+        app.config.set(prefs.HTTP_DOWNLOAD_SEGMENTS, 4)
+        segmented_time = self.time_download(SegmentedTestingDownloader)
+        self.assert_(segmented_time < single_time * 0.75,
+                "segmented: %s single: %s" % (segmented_time, single_time))
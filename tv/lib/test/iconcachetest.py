@@ -1,3 +1,5 @@
+import os
+
 from miro import database
 
 from miro import app
@@ -53,3 +55,33 @@ class IconCacheTest(EventLoopTest):
                 iconcache.IconCache.get_by_id, item_icon_cache_id)
         self.assertRaises(database.ObjectNotFoundError,
                 iconcache.IconCache.get_by_id, guide_icon_cache_id)
+
+    def _make_download(self, icon_cache, data):
+        tmp_filename = icon_cache.make_tmp_filename()
+        f = open(tmp_filename, 'wb')
+        f.write(data)
+        f.close()
+        # pretend that the request went through IconCacheUpdater
+        iconcache.iconCacheUpdater.runningCount += 1
+        return tmp_filename
+
+    def test_update_from_download(self):
+        icon_cache = self.feed.icon_cache
+        tmp_filename = self._make_download(icon_cache, 'icon data')
+        info = {'status': 200, 'filename': 'icon.png'}
+        icon_cache.update_icon_cache(u'http://example.com/icon.png', info,
+                tmp_filename)
+        self.assert_(not os.path.exists(tmp_filename))
+        self.assertEquals(open(icon_cache.filename).read(), 'icon data')
+
+    def test_download_removed_on_error(self):
+        icon_cache = self.feed.icon_cache
+        tmp_filename = self._make_download(icon_cache, '')
+        info = {'status': 304, 'filename': 'icon.png'}
+        icon_cache.update_icon_cache(u'http://example.com/icon.png', info,
+                tmp_filename)
+        self.assert_(not os.path.exists(tmp_filename))
+        tmp_filename = self._make_download(icon_cache, '')
+        icon_cache.download_error(u'http://example.com/icon.png',
+                'error', tmp_filename)
+        self.assert_(not os.path.exists(tmp_filename))
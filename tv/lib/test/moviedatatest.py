@@ -0,0 +1,243 @@
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from miro import downloader
+from miro import moviedata
+from miro import moviedatacache
+from miro.test.framework import MiroTestCase
+
+class FakeItem(object):
+    def __init__(self, id, filename, downloadedTime=None):
+        self.id = id
+        self.filename = filename
+        self.downloader = None
+        self.downloadedTime = downloadedTime
+        self.updating_movie_info = False
+        self.duration = None
+        self.changes = 0
+
+    def get_filename(self):
+        return self.filename
+
+    def id_exists(self):
+        return True
+
+    def signal_change(self):
+        self.changes += 1
+
+class FakeDisplayTracker(object):
+    def __init__(self, current_ids):
+        self.current_ids = set(current_ids)
+
+class MovieDataUpdaterTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.updater = moviedata.MovieDataUpdater()
+        self.item_counter = 0
+        self.added_idles = []
+        self.old_add_idle = moviedata.eventloop.add_idle
+        moviedata.eventloop.add_idle = (lambda func, name:
+                self.added_idles.append(func))
+
+    def tearDown(self):
+        moviedata.eventloop.add_idle = self.old_add_idle
+        MiroTestCase.tearDown(self)
+
+    def make_item(self, downloadedTime=None):
+        self.item_counter += 1
+        path = os.path.join(self.tempdir, 'video-%d.mp4' % self.item_counter)
+        open(path, 'w').close()
+        return FakeItem(self.item_counter, path, downloadedTime)
+
+    def get_queued_items(self):
+        items = []
+        while not self.updater.queue.empty():
+            priority, sequence, mdi = self.updater.queue.get()
+            items.append(mdi.item)
+        return items
+
+    def test_priority(self):
+        old_item = self.make_item(datetime.now() - timedelta(days=1))
+        downloaded_item = self.make_item(datetime.now())
+        displayed_item = self.make_item()
+        other_item = self.make_item()
+        tracker = FakeDisplayTracker([displayed_item.id])
+        downloader.add_item_display_tracker(tracker)
+        try:
+            for item in (old_item, downloaded_item, displayed_item,
+                         other_item):
+                self.updater.request_update(item)
+        finally:
+            downloader.remove_item_display_tracker(tracker)
+        self.assertEquals(self.get_queued_items(),
+                [displayed_item, downloaded_item, old_item, other_item])
+
+    def test_request_twice(self):
+        item = self.make_item()
+        self.updater.request_update(item)
+        self.updater.request_update(item)
+        self.assertEquals(self.get_queued_items(), [item])
+
+    def test_batched_results(self):
+        items = [self.make_item() for i in range(3)]
+        for item in items:
+            self.updater.update_finished(item, 1000, None, 'video', {})
+        # all the results get saved in one idle callback
+        self.assertEquals(len(self.added_idles), 1)
+        self.added_idles[0]()
+        for item in items:
+            self.assertEquals(item.duration, 1000)
+            self.assertEquals(item.file_type, u'video')
+            self.assertEquals(item.changes, 1)
+        self.assertEquals(self.updater.results, [])
+        # the next result schedules a new callback
+        self.updater.update_finished(items[0], 2000, None, 'video', {})
+        self.assertEquals(len(self.added_idles), 2)
+
+class RunMovieDataProgramTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.updater = moviedata.MovieDataUpdater()
+        self.old_timeout = moviedata.MOVIE_DATA_UTIL_TIMEOUT
+
+    def tearDown(self):
+        moviedata.MOVIE_DATA_UTIL_TIMEOUT = self.old_timeout
+        MiroTestCase.tearDown(self)
+
+    def run_python(self, code):
+        return self.updater.run_movie_data_program([sys.executable, '-c',
+            code], None)
+
+    def test_output(self):
+        # write more than fits in a pipe buffer to both stdout and stderr
+        stdout = self.run_python("import sys\n"
+                "sys.stderr.write('e' * 200000)\n"
+                "sys.stdout.write('o' * 200000)\n"
+                "sys.stdout.write('Miro-Movie-Data-Length: 10')\n")
+        self.assertEquals(len(stdout), 200000 +
+                len('Miro-Movie-Data-Length: 10'))
+        self.assertEquals(self.updater.parse_duration(stdout), 10)
+        self.assertEquals(self.updater.processes, set())
+
+    def test_timeout(self):
+        moviedata.MOVIE_DATA_UTIL_TIMEOUT = 0.5
+        start = time.time()
+        stdout = self.run_python("import sys, time\n"
+                "sys.stdout.write('partial')\n"
+                "sys.stdout.flush()\n"
+                "time.sleep(30)\n")
+        self.assertEquals(stdout, '')
+        self.assert_(time.time() - start < 10)
+
+    def test_shutdown(self):
+        results = []
+        def run():
+            results.append(self.run_python("import time\ntime.sleep(30)"))
+        thread = threading.Thread(target=run)
+        thread.start()
+        while not self.updater.processes:
+            time.sleep(0.01)
+        self.updater.shutdown()
+        thread.join(10)
+        self.assert_(not thread.isAlive())
+        self.assertEquals(results, [''])
+
+class MovieDataCacheTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.cache_path = os.path.join(self.tempdir, 'cache.sqlite')
+        self.cache = moviedatacache.MovieDataCache(self.cache_path)
+
+    def tearDown(self):
+        self.cache.close()
+        MiroTestCase.tearDown(self)
+
+    def make_file(self, name, data):
+        path = os.path.join(self.tempdir, name)
+        f = open(path, 'wb')
+        f.write(data)
+        f.close()
+        return path
+
+    def test_key(self):
+        data = 'a' * 300000
+        path = self.make_file('video.mp4', data)
+        key = moviedatacache.calc_key(path)
+        # moving the file keeps the key
+        new_path = os.path.join(self.tempdir, 'moved.mp4')
+        os.rename(path, new_path)
+        self.assertEquals(moviedatacache.calc_key(new_path), key)
+        # changing the end of the file changes it
+        os.utime(new_path, (1000, 1000))
+        key = moviedatacache.calc_key(new_path)
+        self.make_file('moved.mp4', data[:-1] + 'b')
+        os.utime(new_path, (1000, 1000))
+        self.assertNotEquals(moviedatacache.calc_key(new_path), key)
+        self.assertEquals(moviedatacache.calc_key(
+            os.path.join(self.tempdir, 'missing.mp4')), None)
+
+    def test_put_and_get(self):
+        path = self.make_file('video.mp4', 'data')
+        self.assertEquals(self.cache.get('key', path), None)
+        self.cache.put('key', path, 1000, u'', u'audio', {u'title': u'Foo'})
+        entry = self.cache.get('key', path)
+        self.assertEquals(entry['duration'], 1000)
+        self.assertEquals(entry['mediatype'], u'audio')
+        self.assertEquals(entry['metadata'], {u'title': u'Foo'})
+        self.assertEquals(entry['screenshot'], u'')
+        self.assertEquals((self.cache.hits, self.cache.misses), (1, 1))
+        # entries survive reopening the cache
+        self.cache.close()
+        self.cache = moviedatacache.MovieDataCache(self.cache_path)
+        self.assertEquals(self.cache.get('key', path)['duration'], 1000)
+
+    def test_prune(self):
+        path = self.make_file('video.mp4', 'data')
+        screenshot = self.make_file('screenshot.png', 'png data')
+        self.cache.put('present', path, 1, screenshot, None, {})
+        self.cache.put('moved', path + '.old', 2, u'', None, {})
+        self.cache.put('missing', path + '.missing', 3, screenshot, None, {})
+        self.cache.connection.execute("UPDATE movie_data SET last_seen=0")
+        # looking up an entry from a new location updates its path
+        self.cache.get('moved', path)
+        self.assertEquals(self.cache.prune(), 1)
+        self.assertEquals(self.cache.get('missing', path), None)
+        self.assertNotEquals(self.cache.get('present', path), None)
+        self.assertNotEquals(self.cache.get('moved', path), None)
+        # the screenshot copy goes with the entry
+        self.assert_(not os.path.exists(self.cache.screenshot_path('missing')))
+        self.assert_(os.path.exists(self.cache.screenshot_path('present')))
+
+    def test_corrupt_cache(self):
+        self.cache.close()
+        self.make_file('cache.sqlite', 'not a sqlite database' * 100)
+        self.cache = moviedatacache.MovieDataCache(self.cache_path)
+        self.assertEquals(self.cache.get('key', 'path'), None)
+
+    def test_updater_uses_cache(self):
+        video_path = self.make_file('video.mp4', 'data')
+        screenshot = self.make_file('screenshot.png', 'png data')
+        key = moviedatacache.calc_key(video_path)
+        self.cache.put(key, video_path, 1000, screenshot, u'video',
+                       {u'title': u'Foo'})
+        # the cache has its own copy, so it doesn't matter if the item that
+        # the screenshot was taken for expires
+        os.remove(screenshot)
+        old_cache = moviedatacache.cache
+        moviedatacache.cache = self.cache
+        try:
+            updater = moviedata.MovieDataUpdater()
+            results = []
+            updater.update_finished = lambda *args: results.append(args)
+            item = FakeItem(1, video_path)
+            mdi = moviedata.MovieDataInfo(item)
+            updater.process_item(mdi)
+        finally:
+            moviedatacache.cache = old_cache
+        self.assertEquals(results, [(item, 1000, mdi.thumbnail_path,
+                                     u'video', {u'title': u'Foo'})])
+        # the item gets its own copy of the screenshot
+        self.assertEquals(open(mdi.thumbnail_path).read(), 'png data')
@@ -337,6 +337,25 @@ class NetworkBufferTest(MiroTestCase):
         # check to make sure the value doesn't change as a result
         self.assertEquals(self.buffer.getValue(), "ONETWOTHREE")
 
+    def test_unread_after_read(self):
+        self.buffer.addData("ABCDEF")
+        self.assertEquals(self.buffer.read(3), "ABC")
+        self.buffer.unread("BC")
+        self.assertEquals(self.buffer.read(), "BCDEF")
+        self.buffer.addData("XY")
+        self.buffer.unread("123")
+        self.assertEquals(self.buffer.read(), "123XY")
+
+    def test_compact(self):
+        self.buffer.COMPACT_SIZE = 4
+        self.buffer.addData("0123456789")
+        self.assertEquals(self.buffer.read(6), "012345")
+        self.buffer.addData("ABC")
+        self.assertEquals(self.buffer.length, 7)
+        self.assertEquals(self.buffer.getValue(), "6789ABC")
+        self.assertEquals(self.buffer.readline(), None)
+        self.assertEquals(self.buffer.read(), "6789ABC")
+        self.assert_(not self.buffer.has_data())
 
 class WeirdCloseConnectionTest(AsyncSocketTest):
     def test_close_during_open_connection(self):
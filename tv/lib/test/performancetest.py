@@ -1,14 +1,29 @@
+import cPickle
 import shutil
 import os
+import struct
 import pstats
+import re
+import subprocess
 import cProfile
+import time
 
 from miro import app
+from miro import feedupdate
+from miro import httpclient
 from miro import messagehandler
 from miro import messages
 from miro import models
-from miro.test.framework import EventLoopTest
+from miro import net
+from miro import prefs
+from miro.dl_daemon import command
+from miro.dl_daemon import protocol
+from miro.test.framework import EventLoopTest, MiroTestCase, uses_httpclient
 from miro.test import messagetest
+from miro.test.feedtest import FeedTestCase
+from miro.test.feedupdatetest import StubFeedHandler, StubFeedServer, HTTPFeed
+from miro.test.protocoltest import make_status
+from miro.plat import resources
 from miro.plat.utils import FilenameType
 
 class PerformanceTest(EventLoopTest):
@@ -66,3 +81,283 @@ class PerformanceTest(EventLoopTest):
     def track_item_count(self):
         messages.TrackNewVideoCount().send_to_backend()
         self.runUrgentCalls()
+
+class FeedUpdatePerformanceTest(FeedTestCase):
+    """Time updating a big feed whose entries don't have guids."""
+    ENTRY_COUNT = 5000
+
+    def write_feed(self, title_prefix):
+        items = []
+        for x in xrange(self.ENTRY_COUNT):
+            items.append("""\
+<item>
+ <title>%s %s</title>
+ <enclosure url="http://example.com/videos/%s.mpg" />
+</item>
+""" % (title_prefix, x, x))
+        self.write_file("""<?xml version="1.0"?>
+<rss version="2.0">
+   <channel>
+      <title>Big Feed</title>
+%s
+   </channel>
+</rss>""" % "".join(items))
+
+    def _run_test(self, title_prefix):
+        self.write_feed(u"Entry")
+        self.feed = self.make_feed()
+        self.assertEquals(models.Item.make_view().count(), self.ENTRY_COUNT)
+        self.write_feed(title_prefix)
+        stats_path = self.make_temp_path(".prof")
+        start = time.time()
+        cProfile.runctx("self.update_feed(self.feed)", globals(), locals(),
+                stats_path)
+        print '%s entries updated in %.3f secs' % (self.ENTRY_COUNT,
+                time.time() - start)
+        stats = pstats.Stats(stats_path)
+        stats.strip_dirs().sort_stats("cumulative").print_stats(0.1)
+        self.assertEquals(models.Item.make_view().count(), self.ENTRY_COUNT)
+
+    def test_unchanged_entries(self):
+        self._run_test(u"Entry")
+
+    def test_changed_titles(self):
+        # entries only match their items by enclosure
+        self._run_test(u"New Entry")
+
+class KeepAliveStubFeedHandler(StubFeedHandler):
+    protocol_version = "HTTP/1.1"
+
+class FeedRefreshPerformanceTest(EventLoopTest):
+    """Time refreshing a lot of feeds from a local server, and check how
+    many connections httpclient reused.
+    """
+    FEED_COUNT = 200
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.server = StubFeedServer(latency=0,
+                handler_class=KeepAliveStubFeedHandler)
+        self.server.start()
+        self.queue = feedupdate.FeedUpdateQueue()
+        self.finished_count = 0
+
+    def tearDown(self):
+        self.server.stop()
+        EventLoopTest.tearDown(self)
+
+    def on_update_finished(self, feed):
+        self.finished_count += 1
+        if self.finished_count == len(self.feeds):
+            self.stopEventLoop(abnormal=False)
+
+    @uses_httpclient
+    def test_refresh_feeds(self):
+        port = self.server.server_address[1]
+        self.feeds = []
+        for i in xrange(self.FEED_COUNT):
+            feed = HTTPFeed(i, u'http://127.0.0.1:%d/feed%d.rss' % (port, i))
+            feed.connect('update-finished', self.on_update_finished)
+            self.feeds.append(feed)
+        httpclient.curl_manager.reset_connection_stats()
+        start = time.time()
+        for feed in self.feeds:
+            self.queue.schedule_update(0, feed, feed.update)
+        self.runEventLoop(timeout=120)
+        print '%s feeds refreshed in %.3f secs' % (self.FEED_COUNT,
+                time.time() - start)
+        stats = httpclient.get_connection_stats()
+        for key in sorted(stats):
+            print '%s: %s' % (key, stats[key])
+        self.assertEquals(self.finished_count, self.FEED_COUNT)
+        self.assert_(stats['connections_reused'] > 0)
+
+class CountingFileWriteBuffer(httpclient.FileWriteBuffer):
+    write_count = 0
+
+    def flush(self):
+        if self.chunks:
+            CountingFileWriteBuffer.write_count += 1
+        httpclient.FileWriteBuffer.flush(self)
+
+class DownloadWritePerformanceTest(EventLoopTest):
+    """Download several files at once and check how many write calls we made
+    and how fragmented the files ended up.  Compares unbuffered writes
+    (HTTP_WRITE_BUFFER_SIZE of 0) with the default buffer.
+    """
+    DOWNLOAD_COUNT = 20
+
+    def setUp(self):
+        EventLoopTest.setUp(self)
+        self.start_http_server()
+        self.real_file_write_buffer = httpclient.FileWriteBuffer
+        httpclient.FileWriteBuffer = CountingFileWriteBuffer
+        self.download_path = resources.path(
+                'testdata/httpserver/linux-screen.jpg')
+
+    def tearDown(self):
+        httpclient.FileWriteBuffer = self.real_file_write_buffer
+        app.config.set(prefs.HTTP_WRITE_BUFFER_SIZE,
+                prefs.HTTP_WRITE_BUFFER_SIZE.default)
+        EventLoopTest.tearDown(self)
+
+    def count_extents(self, path):
+        try:
+            output = subprocess.Popen(['filefrag', path],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE).communicate()[0]
+        except OSError:
+            return None
+        match = re.search(r'(\d+) extents? found', output)
+        if match is None:
+            return None
+        return int(match.group(1))
+
+    def run_downloads(self, buffer_size):
+        app.config.set(prefs.HTTP_WRITE_BUFFER_SIZE, buffer_size)
+        CountingFileWriteBuffer.write_count = 0
+        self.finished_count = 0
+        paths = [self.make_temp_path('.jpg')
+                for i in xrange(self.DOWNLOAD_COUNT)]
+        def callback(info):
+            self.finished_count += 1
+            if self.finished_count == self.DOWNLOAD_COUNT:
+                self.stopEventLoop(abnormal=False)
+        def errback(error):
+            raise AssertionError("download error: %s" % error)
+        start = time.time()
+        for path in paths:
+            httpclient.grab_url(self.httpserver.build_url('linux-screen.jpg'),
+                    callback, errback, write_file=path)
+        self.runEventLoop(timeout=60)
+        elapsed = time.time() - start
+        extents = [self.count_extents(path) for path in paths]
+        if None in extents:
+            extents = 'unknown'
+        else:
+            extents = sum(extents)
+        print ('buffer: %sKB  %s downloads in %.3f secs  writes: %s  '
+                'extents: %s' % (buffer_size, self.DOWNLOAD_COUNT, elapsed,
+                    CountingFileWriteBuffer.write_count, extents))
+        for path in paths:
+            self.assertEquals(open(path, 'rb').read(),
+                    open(self.download_path, 'rb').read())
+        return CountingFileWriteBuffer.write_count
+
+    @uses_httpclient
+    def test_write_buffer(self):
+        unbuffered_writes = self.run_downloads(0)
+        buffered_writes = self.run_downloads(
+                prefs.HTTP_WRITE_BUFFER_SIZE.default)
+        self.assert_(buffered_writes < unbuffered_writes)
+
+class JoiningNetworkBuffer(object):
+    """The old NetworkBuffer read code, which joins all pending data for
+    each read.  NetworkBufferPerformanceTest compares against it.
+    """
+    def __init__(self):
+        self.chunks = []
+        self.length = 0
+
+    def addData(self, data):
+        self.chunks.append(data)
+        self.length += len(data)
+
+    def read(self, size=None):
+        self.chunks = [''.join(self.chunks)]
+        rv = self.chunks[0][:size]
+        self.chunks[0] = self.chunks[0][len(rv):]
+        self.length -= len(rv)
+        return rv
+
+class NetworkBufferPerformanceTest(MiroTestCase):
+    """Time reading a burst of size-prefixed frames, the way the downloader
+    daemon reads commands.
+    """
+    FRAME_COUNT = 500
+    FRAME_SIZE = 2048
+    READ_SIZE = 4096
+
+    def make_stream(self):
+        frames = []
+        for i in xrange(self.FRAME_COUNT):
+            body = chr(i % 256) * self.FRAME_SIZE
+            frames.append(struct.pack("I", len(body)) + body)
+        return ''.join(frames)
+
+    def read_frames(self, buf, stream):
+        start = time.time()
+        # the whole burst arrives before we get to process it
+        for pos in xrange(0, len(stream), self.READ_SIZE):
+            buf.addData(stream[pos:pos+self.READ_SIZE])
+        frames = []
+        while buf.length >= 4:
+            (size,) = struct.unpack("I", buf.read(4))
+            frames.append(buf.read(size))
+        return frames, time.time() - start
+
+    def test_frames(self):
+        stream = self.make_stream()
+        frames, new_time = self.read_frames(net.NetworkBuffer(), stream)
+        old_frames, old_time = self.read_frames(JoiningNetworkBuffer(),
+                stream)
+        print
+        print "NetworkBuffer: %.4f secs  joining buffer: %.4f secs" % (
+                new_time, old_time)
+        self.assertEquals(len(frames), self.FRAME_COUNT)
+        self.assertEquals(frames, old_frames)
+
+class ProtocolPerformanceTest(MiroTestCase):
+    """Compare sending status updates for a lot of downloads with the
+    protocol against pickling the whole command.
+    """
+    DOWNLOAD_COUNT = 500
+    UPDATE_COUNT = 20
+
+    def make_updates(self):
+        updates = []
+        for i in xrange(self.UPDATE_COUNT):
+            statuses = []
+            for j in xrange(self.DOWNLOAD_COUNT):
+                statuses.append(make_status(u'download%08d' % j,
+                    current_size=i * 1024 * 512, eta=float(120 - i)))
+            updates.append(command.BatchUpdateDownloadStatus(None, statuses))
+        return updates
+
+    def send_pickled(self, updates):
+        start = time.time()
+        total = 0
+        received = []
+        for comm in updates:
+            data = cPickle.dumps(comm, cPickle.HIGHEST_PROTOCOL)
+            total += len(data)
+            received.append(cPickle.loads(data))
+        return received, total, time.time() - start
+
+    def send_protocol(self, updates):
+        encoder = protocol.FrameEncoder()
+        decoder = protocol.FrameDecoder()
+        start = time.time()
+        sizes = []
+        received = []
+        for comm in updates:
+            data = encoder.encode([comm])
+            sizes.append(len(data))
+            received.extend(decoder.decode(data))
+        return received, sizes, time.time() - start
+
+    def test_status_updates(self):
+        updates = self.make_updates()
+        received, sizes, new_time = self.send_protocol(updates)
+        new_size = sum(sizes)
+        old_received, old_size, old_time = self.send_pickled(updates)
+        print
+        print "protocol: %d bytes %.4f secs  pickle: %d bytes %.4f secs" % (
+                new_size, new_time, old_size, old_time)
+        self.assertEquals([c.args for c in received],
+                [c.args for c in old_received])
+        # only currentSize and eta change after the first update, so the
+        # later frames leave out most of the fields
+        for size in sizes[1:]:
+            self.assert_(size < sizes[0] / 2)
+        self.assert_(new_size < old_size)
@@ -0,0 +1,256 @@
+import cPickle
+import datetime
+
+from miro.dl_daemon import command
+from miro.dl_daemon import protocol
+from miro.test.framework import MiroTestCase
+
+def make_status(dlid, current_size=0, **kwargs):
+    status = {
+        'dlid': dlid,
+        'url': u'http://example.com/%s.ogv' % dlid,
+        'state': u'downloading',
+        'totalSize': 100 * 1024 * 1024,
+        'currentSize': current_size,
+        'eta': 120.5,
+        'rate': 1024.0 * 512,
+        'uploaded': 0,
+        'filename': '/home/miro/Incomplete Downloads/%s.ogv.part' % dlid,
+        'startTime': 1290000000.0,
+        'endTime': 1290000000.0,
+        'shortFilename': '%s.ogv' % dlid,
+        'reasonFailed': u'No Error',
+        'shortReasonFailed': u'No Error',
+        'dlerType': 'HTTP',
+        'retryTime': None,
+        'retryCount': -1,
+        'channelName': None,
+        'segmentMap': None,
+    }
+    status.update(kwargs)
+    return status
+
+class ProtocolTest(MiroTestCase):
+    def setUp(self):
+        MiroTestCase.setUp(self)
+        self.encoder = protocol.FrameEncoder()
+        self.decoder = protocol.FrameDecoder()
+
+    def round_trip(self, commands):
+        return self.decoder.decode(self.encoder.encode(commands))
+
+    def round_trip_statuses(self, statuses):
+        comm = command.BatchUpdateDownloadStatus(None, statuses)
+        [decoded] = self.round_trip([comm])
+        self.assertEquals(type(decoded), command.BatchUpdateDownloadStatus)
+        return decoded.args[0]
+
+    def test_command(self):
+        comm = command.UpdateConfigCommand(None, 'key', u'value')
+        [decoded] = self.round_trip([comm])
+        self.assertEquals(type(decoded), command.UpdateConfigCommand)
+        self.assertEquals(decoded.args, ('key', u'value'))
+        self.assertEquals(decoded.kws, {})
+        self.assertEquals(decoded.daemon, None)
+
+    def test_kws(self):
+        comm = command.StartNewDownloadCommand(None, u'http://example.com/',
+                u'download1', channelName=u'channel')
+        [decoded] = self.round_trip([comm])
+        self.assertEquals(decoded.args, (u'http://example.com/',
+            u'download1'))
+        self.assertEquals(decoded.kws, {'channelName': u'channel'})
+
+    def test_batching(self):
+        commands = [
+            command.UpdateConfigCommand(None, 'key', u'value'),
+            command.UpdateDownloadStatus(None, make_status(u'download1')),
+            command.BatchUpdateDownloadStatus(None,
+                [make_status(u'download2'), make_status(u'download3')]),
+            command.ShutDownResponseCommand(None),
+        ]
+        decoded = self.round_trip(commands)
+        self.assertEquals([type(c) for c in decoded],
+                [type(c) for c in commands])
+        self.assertEquals(decoded[1].args[0], make_status(u'download1'))
+        self.assertEquals(decoded[2].args[0],
+                [make_status(u'download2'), make_status(u'download3')])
+
+    def test_status_types(self):
+        status = make_status(u'download1', totalSize=2**40,
+                retryTime=datetime.datetime(2010, 11, 1, 12, 30),
+                activity=u'connecting', metainfo='d4:infod6:lengthi5eee',
+                fastResumeVersion=3)
+        [decoded] = self.round_trip_statuses([status])
+        self.assertEquals(decoded, status)
+        for key, value in status.items():
+            self.assertEquals(type(decoded[key]), type(value))
+
+    def test_unchanged_fields_omitted(self):
+        first = self.encoder.encode([command.UpdateDownloadStatus(None,
+            make_status(u'download1'))])
+        second = self.encoder.encode([command.UpdateDownloadStatus(None,
+            make_status(u'download1', current_size=1024))])
+        self.assert_(len(second) < len(first) / 3)
+        record_type, payload = self.encoder.encode_command(
+                command.UpdateDownloadStatus(None,
+                    make_status(u'download1', current_size=2048)))
+        self.assertEquals(record_type, protocol.RECORD_STATUS)
+        [(dlid, present, sent, values, extras)] = cPickle.loads(payload)
+        self.assertEquals(values, (2048,))
+
+    def test_unchanged_fields_restored(self):
+        statuses = [make_status(u'download1'), make_status(u'download2')]
+        self.assertEquals(self.round_trip_statuses(statuses), statuses)
+        statuses = [make_status(u'download1', current_size=1024),
+                make_status(u'download2', state=u'paused', rate=0.0)]
+        self.assertEquals(self.round_trip_statuses(statuses), statuses)
+        # the same data again should give us full dicts too
+        self.assertEquals(self.round_trip_statuses(statuses), statuses)
+
+    def test_type_change_sent(self):
+        # 0 == 0.0 == False, but we should still send the new value
+        self.round_trip_statuses([make_status(u'download1', rate=0)])
+        [decoded] = self.round_trip_statuses(
+                [make_status(u'download1', rate=0.0)])
+        self.assertEquals(type(decoded['rate']), float)
+
+    def test_removed_fields(self):
+        # metainfo is only sent when it changes, make sure we don't fill it
+        # in when it's not there.
+        status = make_status(u'download1', metainfo='d4:infod6:lengthi5eee')
+        self.assertEquals(self.round_trip_statuses([status]), [status])
+        status = make_status(u'download1')
+        self.assertEquals(self.round_trip_statuses([status]), [status])
+
+    def test_extra_fields(self):
+        status = make_status(u'download1', someNewField=u'value')
+        self.assertEquals(self.round_trip_statuses([status]), [status])
+
+    def test_decoded_statuses_are_copies(self):
+        self.round_trip_statuses([make_status(u'download1')])
+        [decoded] = self.round_trip_statuses(
+                [make_status(u'download1', current_size=1024)])
+        # RemoteDownloader.update_status() changes the dict it's given
+        decoded['url'] = u'changed'
+        [decoded] = self.round_trip_statuses(
+                [make_status(u'download1', current_size=2048)])
+        self.assertEquals(decoded['url'], make_status(u'download1')['url'])
+
+    def test_forget(self):
+        self.round_trip_statuses([make_status(u'download1'),
+            make_status(u'download2')])
+        [decoded] = self.round_trip([
+            command.ForgetDownloadStatusCommand(None, u'download1')])
+        self.assertEquals(type(decoded), command.ForgetDownloadStatusCommand)
+        self.assertEquals(self.encoder.sent_statuses.keys(), [u'download2'])
+        self.assertEquals(self.decoder.received_statuses.keys(),
+                [u'download2'])
+        # the next status for the download should be sent in full
+        record_type, payload = self.encoder.encode_command(
+                command.UpdateDownloadStatus(None, make_status(u'download1')))
+        [(dlid, present, sent, values, extras)] = cPickle.loads(payload)
+        self.assertEquals(sent, present)
+
+    def test_version_mismatch(self):
+        data = self.encoder.encode([command.ShutDownCommand(None)])
+        data = chr(protocol.PROTOCOL_VERSION + 1) + data[1:]
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode, data)
+
+    def test_truncated_frame(self):
+        data = self.encoder.encode([command.ShutDownCommand(None)])
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode,
+                data[:-1])
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode,
+                data + 'x')
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode, '')
+
+    def make_frame(self, records):
+        parts = [protocol.FRAME_HEADER.pack(protocol.PROTOCOL_VERSION,
+            len(records))]
+        for record_type, payload in records:
+            parts.append(protocol.RECORD_HEADER.pack(record_type,
+                len(payload)))
+            parts.append(payload)
+        return ''.join(parts)
+
+    def test_unknown_command(self):
+        data = cPickle.dumps(('NotACommand', (), {}))
+        frame = self.make_frame([(protocol.RECORD_COMMAND, data)])
+        self.assertEquals(self.decoder.decode(frame), [])
+        self.assertRaises(protocol.ProtocolError,
+                self.decoder.decode_record, protocol.RECORD_COMMAND, data)
+
+    def test_bad_command(self):
+        for data in (('UpdateConfigCommand',), None,
+                ('UpdateConfigCommand', (), 'not a dict'),
+                ('ForgetDownloadStatusCommand', (), {})):
+            self.assertRaises(protocol.ProtocolError,
+                    self.decoder.decode_record, protocol.RECORD_COMMAND,
+                    cPickle.dumps(data))
+
+    def test_bad_record_skipped(self):
+        # one bad record shouldn't cost us the rest of the frame
+        records = [self.encoder.encode_command(c) for c in (
+            command.UpdateConfigCommand(None, 'key', u'value'),
+            command.UpdateDownloadStatus(None, make_status(u'download1')))]
+        records.insert(1, (protocol.RECORD_COMMAND,
+            cPickle.dumps(('UpdateConfigCommand', None, {}))))
+        records.insert(1, (protocol.RECORD_COMMAND, 'garbage'))
+        decoded = self.decoder.decode(self.make_frame(records))
+        self.assertEquals([type(c) for c in decoded],
+                [command.UpdateConfigCommand, command.UpdateDownloadStatus])
+        self.assertEquals(decoded[1].args[0], make_status(u'download1'))
+        self.assertEquals(self.decoder.pop_resync_dlids(), [])
+
+    def test_bad_status_row_skipped(self):
+        self.round_trip_statuses([make_status(u'download1'),
+            make_status(u'download2')])
+        record_type, payload = self.encoder.encode_command(
+                command.BatchUpdateDownloadStatus(None,
+                    [make_status(u'download1', current_size=1024),
+                        make_status(u'download2', current_size=1024)]))
+        rows = cPickle.loads(payload)
+        dlid, present, sent, values, extras = rows[0]
+        rows[0] = (dlid, present, sent, (), extras)
+        frame = self.make_frame([(record_type, cPickle.dumps(rows))])
+        [decoded] = self.decoder.decode(frame)
+        self.assertEquals(decoded.args[0],
+                [make_status(u'download2', current_size=1024)])
+        self.assertEquals(self.decoder.pop_resync_dlids(), [u'download1'])
+        self.assertEquals(self.decoder.pop_resync_dlids(), [])
+
+    def test_missing_previous_status(self):
+        # a decoder that didn't see the first status can't fill in the
+        # unchanged fields.
+        self.encoder.encode([command.UpdateDownloadStatus(None,
+            make_status(u'download1'))])
+        data = self.encoder.encode([command.UpdateDownloadStatus(None,
+            make_status(u'download1', current_size=1024))])
+        self.assertEquals(self.decoder.decode(data), [])
+        self.assertEquals(self.decoder.pop_resync_dlids(), [u'download1'])
+
+    def test_resync(self):
+        self.round_trip_statuses([make_status(u'download1'),
+            make_status(u'download2')])
+        # lose a frame
+        self.encoder.encode([command.BatchUpdateDownloadStatus(None,
+            [make_status(u'download1', current_size=1024)])])
+        self.assertRaises(protocol.ProtocolError, self.decoder.decode,
+                self.encoder.encode([command.ShutDownCommand(None)])[:-1])
+        self.assertEquals(self.decoder.received_statuses, {})
+        dlids = self.decoder.pop_resync_dlids()
+        self.assertEquals(sorted(dlids), [u'download1', u'download2'])
+        # statuses sent before the encoder hears about the resync don't
+        # decode ...
+        self.assertEquals(self.round_trip([command.UpdateDownloadStatus(None,
+            make_status(u'download1', current_size=1024))]), [])
+        self.assertEquals(self.decoder.pop_resync_dlids(), [u'download1'])
+        # ... but after ResyncDownloadStatusCommand, the next status is
+        # complete
+        for dlid in dlids:
+            self.encoder.forget(dlid)
+        statuses = [make_status(u'download1', current_size=2048),
+                make_status(u'download2', current_size=2048)]
+        self.assertEquals(self.round_trip_statuses(statuses), statuses)
+        self.assertEquals(self.decoder.pop_resync_dlids(), [])
@@ -58,3 +58,48 @@ class SchedulerTest(EventLoopTest):
         self.runEventLoop()
         totalCalls = len(timeouts) * threadCount + 1
         self.assertEquals(len(self.got_args), totalCalls)
+
+class ThreadPoolTest(EventLoopTest):
+    def setUp(self):
+        self.results = []
+        self.errors = []
+        EventLoopTest.setUp(self)
+
+    def callback(self, result):
+        self.results.append(result)
+        if len(self.results) + len(self.errors) >= self.expected:
+            eventloop.shutdown()
+
+    def errback(self, error):
+        self.errors.append(error)
+        if len(self.results) + len(self.errors) >= self.expected:
+            eventloop.shutdown()
+
+    def test_pools(self):
+        self.expected = 4
+        for pool_name in ('default', 'dns', 'parse', 'fileio'):
+            eventloop.call_in_thread(self.callback, self.errback,
+                    lambda x: x * 2, "pool test", 21, pool_name=pool_name)
+        self.runEventLoop()
+        self.assertEquals(self.results, [42] * 4)
+        self.assertEquals(self.errors, [])
+
+    def test_unknown_pool(self):
+        self.assertRaises(ValueError, eventloop.call_in_thread,
+                self.callback, self.errback, lambda: None, "bad pool",
+                pool_name='no-such-pool')
+
+    def test_stats(self):
+        self.expected = 3
+        for i in range(3):
+            eventloop.call_in_thread(self.callback, self.errback,
+                    sleep, "stats test", 0.05, pool_name='parse')
+        self.runEventLoop()
+        stats = eventloop.thread_pool_stats()
+        self.assertEquals(stats['parse']['calls_finished'], 3)
+        self.assertEquals(stats['parse']['queue_depth'], 0)
+        self.assertEquals(stats['parse']['busy_threads'], 0)
+        self.assert_(stats['parse']['utilization'] > 0.0)
+        self.assert_(stats['parse']['max_wait_time'] >=
+                stats['parse']['avg_wait_time'])
+        self.assertEquals(stats['dns']['calls_finished'], 0)
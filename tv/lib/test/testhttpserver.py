@@ -7,17 +7,24 @@ The code here is based off of the standard SimpleHTTPServer code.
 import BaseHTTPServer
 import hashlib
 import cgi
+import gzip
 import os
 import posixpath
 import random
 import urllib
 import shutil
 import socket
+import SocketServer
 import threading
+import time
+from cStringIO import StringIO
 
 from miro.plat import utils
 from miro.plat import resources
 
+# size of the chunks we send when the server has latency set
+LATENCY_CHUNK_SIZE = 4096
+
 def md5(d):
     return hashlib.md5(d).hexdigest()
 
@@ -63,13 +70,23 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 data = f.read(count)
                 if self.server.pause_after >= 0:
                     data = data[:self.server.pause_after]
-                self.wfile.write(data)
+                self.write_data(data)
             f.close()
         if self.server.close_connection:
             self.close_connection = 1
             self.rfile.close()
             self.wfile.close()
 
+    def write_data(self, data):
+        if self.server.latency <= 0:
+            self.wfile.write(data)
+            return
+        # Pretend that we're on a slow link: each connection can only send
+        # LATENCY_CHUNK_SIZE bytes per round trip.
+        for pos in xrange(0, len(data), LATENCY_CHUNK_SIZE):
+            time.sleep(self.server.latency)
+            self.wfile.write(data[pos:pos+LATENCY_CHUNK_SIZE])
+
     def do_GET(self):
         """Serve a GET request."""
         self.server.last_info = {
@@ -194,7 +211,8 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     'opaque="5ccc069c403ebaf9f0171e9517f40e41"' %
                     self.digest_nonce))
 
-        elif 'range' in self.headers and self.server.allow_resume:
+        elif ('range' in self.headers and self.server.allow_resume and
+                not self.server.ignore_range):
             range = self.headers['range']
             if range.startswith("bytes="):
                 byte_range = range[len('bytes='):]
@@ -202,10 +220,10 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 if start != '':
                     self.start_pos = int(start)
                 if end != '':
-                    self.end_pos = int(end)
+                    # HTTP ranges include the last byte
+                    self.end_pos = int(end) + 1
                 code = 206
                 path = self.translate_path(self.path)
-                headers_to_send.append(('Content-Range', range))
         else:
             code = 200
             path = self.translate_path(self.path)
@@ -215,18 +233,42 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         except IOError:
             self.send_error(404, "File not found")
             return None
+        fs = os.fstat(f.fileno())
+        last_modified = self.date_time_string(fs.st_mtime)
+        if (code == 200 and
+                self.headers.get('if-modified-since') == last_modified):
+            f.close()
+            self.send_response(304)
+            for key, value in self.server.headers_to_send:
+                self.send_header(key, value)
+            self.end_headers()
+            return None
         self.send_response(code)
         if location_header is not None:
             self.send_header("Location", location_header)
-        fs = os.fstat(f.fileno())
         length = fs[6]
+        if (code == 200 and self.server.allow_compression and
+                'gzip' in self.headers.get('accept-encoding', '')):
+            f = self.gzip_file(f)
+            length = len(f.getvalue())
+            headers_to_send.append(('Content-Encoding', 'gzip'))
+        if code == 206:
+            first = max(self.start_pos, 0)
+            if self.end_pos > 0:
+                last = min(self.end_pos, length) - 1
+            else:
+                last = length - 1
+            headers_to_send.append(('Content-Range',
+                'bytes %d-%d/%d' % (first, last, length)))
         if self.end_pos > 0:
             length = min(self.end_pos, length)
         if self.start_pos > 0:
             length -= self.start_pos
         if 'content-length' not in self.server.headers_to_send:
             self.send_header("Content-Length", str(length))
-        self.send_header("Last-Modified", self.date_time_string(fs.st_mtime))
+        if self.server.allow_resume:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", last_modified)
         for key, value in self.server.headers_to_send:
             self.send_header(key, value)
         for key, value in headers_to_send:
@@ -234,6 +276,15 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
         self.end_headers()
         return f
 
+    def gzip_file(self, f):
+        data = StringIO()
+        gzip_file = gzip.GzipFile(mode='wb', fileobj=data)
+        gzip_file.write(f.read())
+        gzip_file.close()
+        f.close()
+        data.seek(0)
+        return data
+
     def parse_client_digest_auth(self):
         try:
             client_auth = self.headers['authorization']
@@ -272,10 +323,20 @@ class MiroHTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def log_error(self, *args):
         pass
 
+class ThreadingHTTPServer(SocketServer.ThreadingMixIn,
+        BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
 class HTTPServer(threading.Thread):
-    def __init__(self):
+    def __init__(self, threaded=False):
+        """Create a HTTPServer.
+
+        :param threaded: handle each connection in its own thread.  Use this
+            for tests that open several connections at once.
+        """
         threading.Thread.__init__(self)
         self.event = threading.Event()
+        self.threaded = threaded
 
     def start(self):
         threading.Thread.start(self)
@@ -293,14 +354,21 @@ class HTTPServer(threading.Thread):
         else:
             utils.finish_thread_loop(self)
             raise AssertionError("Can't find an open port")
-        self.httpserver = BaseHTTPServer.HTTPServer(('', self.port),
+        if self.threaded:
+            server_class = ThreadingHTTPServer
+        else:
+            server_class = BaseHTTPServer.HTTPServer
+        self.httpserver = server_class(('', self.port),
                 MiroHTTPRequestHandler)
         self.httpserver.allow_head = True
         self.httpserver.headers_to_send = []
         self.httpserver.port = self.port
         self.httpserver.close_connection = False
         self.httpserver.allow_resume = True
+        self.httpserver.ignore_range = False
         self.httpserver.pause_after = -1
+        self.httpserver.allow_compression = False
+        self.httpserver.latency = 0
         self.event.set()
         try:
             self.httpserver.serve_forever()
@@ -350,5 +418,20 @@ class HTTPServer(threading.Thread):
     def disable_resume(self):
         self.httpserver.allow_resume = False
 
+    def ignore_range(self):
+        """Keep sending Accept-Ranges, but answer range requests with the
+        whole file and a 200 status.
+        """
+        self.httpserver.ignore_range = True
+
     def pause_after(self, bytes):
         self.httpserver.pause_after = bytes
+
+    def enable_compression(self):
+        self.httpserver.allow_compression = True
+
+    def set_latency(self, latency):
+        """Wait latency seconds before sending each LATENCY_CHUNK_SIZE
+        bytes of a response body.
+        """
+        self.httpserver.latency = latency
@@ -273,22 +273,32 @@ def get_torrent_info_hash(path):
         # file is too large, bailout.  (see #12301)
         raise ValueError("%s is not a valid torrent" % path)
 
-    import libtorrent as lt
     f = open(path, 'rb')
     try:
         data = f.read(MAX_TORRENT_SIZE)
-        if not data or data[0] != 'd':
-            # File doesn't start with 'd', bailout  (see #12301)
-            raise ValueError("%s is not a valid torrent" % path)
-        metainfo = lt.bdecode(data)
-        try:
-            infohash = metainfo['info']
-        except StandardError:
-            raise ValueError("%s is not a valid torrent" % path)
-        infohash = sha(lt.bencode(infohash)).digest()
-        return infohash
     finally:
         f.close()
+    try:
+        return get_metainfo_info_hash(data)
+    except ValueError:
+        raise ValueError("%s is not a valid torrent" % path)
+
+def get_metainfo_info_hash(data):
+    """Get the info hash for the contents of a torrent file.
+
+    :returns: the info hash as a binary string
+    :raises ValueError: if data isn't valid torrent metainfo
+    """
+    if not data or data[0] != 'd':
+        # Data doesn't start with 'd', bailout  (see #12301)
+        raise ValueError("not a valid torrent")
+    import libtorrent as lt
+    metainfo = lt.bdecode(data)
+    try:
+        infohash = metainfo['info']
+    except StandardError:
+        raise ValueError("not a valid torrent")
+    return sha(lt.bencode(infohash)).digest()
 
 def gather_media_files(path):
     """Gather media files on the disk in a directory tree.
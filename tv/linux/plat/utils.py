@@ -26,6 +26,8 @@
 # this exception statement from your version. If you delete this exception
 # statement from all source files in the program, then also delete it here.
 
+import ctypes
+import ctypes.util
 import errno
 import signal
 import os
@@ -80,6 +82,43 @@ def get_available_bytes_for_movies():
     statinfo = os.statvfs(movie_dir)
     return statinfo.f_frsize * statinfo.f_bavail
 
+# fallocate() mode that reserves disk blocks without changing the file size.
+# HTTP resume uses the file size to know how much data we have, so we can't
+# let it change.
+FALLOC_FL_KEEP_SIZE = 1
+_fallocate = None
+
+def _load_fallocate():
+    global _fallocate
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        _fallocate = libc.fallocate64
+    except (OSError, AttributeError):
+        _fallocate = False
+        return
+    _fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64,
+            ctypes.c_int64]
+    _fallocate.restype = ctypes.c_int
+
+def preallocate_file(fileobj, offset, length):
+    """Reserve disk space for length bytes of fileobj, starting at offset.
+
+    :returns: True if the space was reserved, False if the filesystem doesn't
+        support preallocation
+    :raises IOError: the space couldn't be reserved (errno is ENOSPC if the
+        disk is full)
+    """
+    if _fallocate is None:
+        _load_fallocate()
+    if not _fallocate:
+        return False
+    if _fallocate(fileobj.fileno(), FALLOC_FL_KEEP_SIZE, offset, length) == 0:
+        return True
+    err = ctypes.get_errno()
+    if err in (errno.EOPNOTSUPP, errno.ENOSYS):
+        return False
+    raise IOError(err, os.strerror(err))
+
 def locale_initialized():
     """Returns whether or not the locale has been initialized.
 
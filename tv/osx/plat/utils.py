@@ -98,6 +98,15 @@ def get_available_bytes_for_movies():
     del pool
     return available
 
+def preallocate_file(fileobj, offset, length):
+    """Reserve disk space for length bytes of fileobj, starting at offset.
+
+    Not implemented on OS X.
+
+    :returns: False
+    """
+    return False
+
 def locale_initialized():
     return _locale_initialized
 
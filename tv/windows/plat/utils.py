@@ -84,6 +84,15 @@ def get_available_bytes_for_movies():
         return 100 * 1024 * 1024 * 1024
     return availableSpace.value
 
+def preallocate_file(fileobj, offset, length):
+    """Reserve disk space for length bytes of fileobj, starting at offset.
+
+    Not implemented on windows.
+
+    :returns: False
+    """
+    return False
+
 #############################################################################
 # Windows specific locale                                                   #
 #############################################################################